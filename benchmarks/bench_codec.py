@@ -0,0 +1,280 @@
+#!/usr/bin/env python
+"""
+Micro-benchmarks for the Cast protocol codec (cc_message) and CCMediaController.read_message.
+
+Runs offline against a set of realistic frames (a heartbeat, a large RECEIVER_STATUS and a MEDIA_STATUS
+with queue items) and reports operations per second and per-message latency for each codec operation.
+
+    python benchmarks/bench_codec.py
+    python benchmarks/bench_codec.py --json results.json
+    python benchmarks/bench_codec.py --compare results.json
+    python benchmarks/bench_codec.py --trace trace.jsonl
+
+Results saved with --json on one commit can be compared against another commit's run with --compare.
+With --trace, the messages received in a trace recorded with stream2chromecast.py --trace are used instead of
+the built-in frames: the largest message of each type, and the whole received stream replayed in order.
+
+"""
+
+
+# Copyright (C) 2014-2016 Pat Carter
+#
+# This file is part of Stream2chromecast.
+#
+# Stream2chromecast is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Stream2chromecast is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Stream2chromecast.  If not, see <http://www.gnu.org/licenses/>.
+
+
+
+import argparse
+import gc
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from stream2chromecast import cc_message
+from stream2chromecast import cc_tracer
+from stream2chromecast.cc_media_controller import CCMediaController
+
+RECEIVER_NS = "urn:x-cast:com.google.cast.receiver"
+MEDIA_NS = "urn:x-cast:com.google.cast.media"
+HEARTBEAT_NS = "urn:x-cast:com.google.cast.tp.heartbeat"
+
+
+def receiver_status_payload():
+    """ a RECEIVER_STATUS as sent by a device running the media player alongside a few other apps """
+
+    applications = []
+    for i in range(6):
+        applications.append({
+            "appId": "CC1AD845" if i == 0 else "APP%05d" % i,
+            "displayName": "Default Media Receiver" if i == 0 else "Application %d" % i,
+            "iconUrl": "https://lh3.googleusercontent.com/%s" % ("x" * 120),
+            "isIdleScreen": False,
+            "launchedFromCloud": False,
+            "namespaces": [{"name": "urn:x-cast:com.google.cast.%s" % name}
+                           for name in ("debugoverlay", "cac", "broadcast", "media", "remotecontrol")],
+            "sessionId": "7d9fcb0e-1b3a-4bb6-9a3c-%012d" % i,
+            "statusText": "Ready To Cast",
+            "transportId": "7d9fcb0e-1b3a-4bb6-9a3c-%012d" % i,
+        })
+
+    return {"requestId": 2, "type": "RECEIVER_STATUS",
+            "status": {"applications": applications,
+                       "userEq": {},
+                       "volume": {"controlType": "attenuation", "level": 0.4,
+                                  "muted": False, "stepInterval": 0.05}}}
+
+
+def media_status_payload():
+    """ a MEDIA_STATUS for a playing queue of items """
+
+    items = []
+    for i in range(20):
+        items.append({
+            "itemId": i + 1,
+            "autoplay": True,
+            "startTime": 0,
+            "orderId": i,
+            "media": {"contentId": "http://192.168.1.20:45678/media/library/episode_%02d.mp4" % i,
+                      "contentType": "video/mp4",
+                      "streamType": "BUFFERED",
+                      "duration": 2712.37 + i,
+                      "metadata": {"metadataType": 1, "title": "Episode %d" % i,
+                                   "subtitle": "A long running series", "images": []}},
+        })
+
+    status = {"mediaSessionId": 1, "playbackRate": 1, "playerState": "PLAYING",
+              "currentTime": 1234.5678, "supportedMediaCommands": 274447,
+              "volume": {"level": 1, "muted": False}, "activeTrackIds": [1],
+              "currentItemId": 3, "repeatMode": "REPEAT_OFF", "items": items,
+              "media": items[2]["media"]}
+
+    return {"type": "MEDIA_STATUS", "status": [status], "requestId": 0}
+
+
+def sample_frames():
+    """ returns (name, source id, destination id, namespace, payload) for each benchmark frame """
+
+    return [
+        ("heartbeat", "receiver-0", "sender-0", HEARTBEAT_NS, json.dumps({"type": "PING"})),
+        ("receiver_status", "receiver-0", "sender-0", RECEIVER_NS, json.dumps(receiver_status_payload())),
+        ("media_status", "7d9fcb0e-1b3a-4bb6-9a3c-000000000000", "sender-0", MEDIA_NS,
+         json.dumps(media_status_payload())),
+    ]
+
+
+def trace_frames(path):
+    """ the frames received in a trace - returns the largest frame of each message type in the same form as
+        sample_frames, and the received stream as a whole """
+
+    largest = {}
+    stream = ""
+
+    for record in cc_tracer.load_trace(path):
+        if record['dir'] != "recv" or 'payload_type' in record:
+            # only string payloads are benchmarked
+            continue
+
+        frame = (record['src'].encode("utf-8"), record['dst'].encode("utf-8"), record['ns'].encode("utf-8"),
+                 cc_tracer.record_payload(record))
+        stream += cc_tracer.record_frame(record)
+
+        name = "trace_" + (record.get('type') or "unknown").lower()
+        if name not in largest or len(frame[3]) > len(largest[name][3]):
+            largest[name] = frame
+
+    return [(name,) + largest[name] for name in sorted(largest)], stream
+
+
+class ReplaySocket(object):
+    """ stands in for the device socket, returning the same stream of frames over and over """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.ptr = 0
+
+    def recv(self, length):
+        if self.ptr >= len(self.stream):
+            self.ptr = 0
+
+        data = self.stream[self.ptr:self.ptr + length]
+        self.ptr += len(data)
+
+        return data
+
+
+class OfflineController(CCMediaController):
+    """ a CCMediaController which doesn't look for a device """
+
+    def get_device(self, device_name, use_cache=True):
+        return "127.0.0.1"
+
+
+def measure(func, min_time=0.2, repeat=5):
+    """ time func - returns the fastest per-call time over several runs of enough calls to take min_time """
+
+    timer = timeit.Timer(func)
+
+    number = 1
+    while timer.timeit(number) < min_time / 10:
+        number *= 10
+
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        times = [timer.timeit(number) / number for i in range(repeat)]
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+    return min(times), sorted(times)[len(times) // 2]
+
+
+def benchmarks(frames, stream=None):
+    """ returns (name, function, frame size) for every operation on every frame, and for reading the
+        messages of a recorded stream in turn if one is given """
+
+    cases = []
+
+    for name, source_id, destination_id, namespace, payload in frames:
+        frame = cc_message.format_message(source_id, destination_id, namespace, payload)
+        body = frame[4:]
+
+        cases.append(("format_message/" + name,
+                      lambda s=source_id, d=destination_id, n=namespace, p=payload:
+                          cc_message.format_message(s, d, n, p),
+                      len(frame)))
+
+        cases.append(("extract_message/" + name,
+                      lambda b=body: cc_message.extract_message(b),
+                      len(frame)))
+
+        cases.append(("extract_message_strict/" + name,
+                      lambda b=body: cc_message.extract_message(b, strict=True),
+                      len(frame)))
+
+        controller = OfflineController()
+        controller.sock = ReplaySocket(frame)
+        cases.append(("read_message/" + name, controller.read_message, len(frame)))
+
+    if stream:
+        controller = OfflineController()
+        controller.sock = ReplaySocket(stream)
+        cases.append(("read_message/trace_stream", controller.read_message, None))
+
+    return cases
+
+
+def run(frames, min_time, stream=None):
+    """ run every benchmark, printing and returning the results """
+
+    results = {}
+
+    print "%-40s %12s %12s %12s" % ("benchmark", "ops/sec", "best (us)", "median (us)")
+
+    for name, func, size in benchmarks(frames, stream):
+        best, median = measure(func, min_time=min_time)
+
+        results[name] = {'ops_per_sec': 1 / best, 'best_us': best * 1e6, 'median_us': median * 1e6,
+                         'frame_bytes': size}
+
+        print "%-40s %12.0f %12.2f %12.2f" % (name, 1 / best, best * 1e6, median * 1e6)
+
+    return results
+
+
+def compare(results, baseline):
+    """ print the change in speed of each benchmark relative to a saved run """
+
+    print
+    print "%-40s %12s %12s %8s" % ("benchmark", "baseline", "current", "change")
+
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+
+        before = baseline[name]['ops_per_sec']
+        after = results[name]['ops_per_sec']
+        print "%-40s %12.0f %12.0f %+7.1f%%" % (name, before, after, (after - before) * 100 / before)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Cast protocol codec benchmarks")
+    parser.add_argument("--json", help="save the results to a file", default=None)
+    parser.add_argument("--compare", help="compare the results with those saved in a file", default=None)
+    parser.add_argument("--min-time", type=float, default=0.2,
+                        help="seconds each timing run should last")
+    parser.add_argument("--trace", help="benchmark the messages received in a trace file", default=None)
+    args = parser.parse_args()
+
+    if args.trace:
+        frames, stream = trace_frames(args.trace)
+        results = run(frames, args.min_time, stream)
+    else:
+        results = run(sample_frames(), args.min_time)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({'python': sys.version, 'results': results}, f, indent=1, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare, "r") as f:
+            compare(results, json.load(f)['results'])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+"""
+Measures how long the command line takes to start for each command, and which modules it spends the time importing.
+
+Each command is run in a fresh interpreter which parses its arguments and imports the function that carries it
+out (without running it), recording the time spent importing every module. The wall time of the whole process,
+interpreter start included, is reported as the median of a number of runs and checked against a budget - the
+script exits with status 1 when a command is over it.
+
+    python benchmarks/bench_startup.py
+    python benchmarks/bench_startup.py --budget-ms 80 --repeat 20
+    python benchmarks/bench_startup.py --profile pause
+
+"""
+
+
+# Copyright (C) 2014-2016 Pat Carter
+#
+# This file is part of Stream2chromecast.
+#
+# Stream2chromecast is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Stream2chromecast is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Stream2chromecast.  If not, see <http://www.gnu.org/licenses/>.
+
+
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+
+# the command lines measured - the arguments after the script name
+COMMANDS = {
+    'status': ["status", "-d", "device"],
+    'pause': ["pause", "-d", "device"],
+    'volup': ["volup", "-d", "device"],
+    'setvol': ["setvol", "0.5", "-d", "device"],
+    'devices_list': ["devices_list"],
+    'play': ["play", "media.mp4", "-d", "device"],
+    'playurl': ["playurl", "http://example.com/media.mp4", "-d", "device"],
+}
+
+# run in the child interpreter: argv[1] is the repository root and argv[2] the command line as JSON
+CHILD = r"""
+import __builtin__
+import json
+import sys
+import time
+
+clock = time.time
+start = clock()
+
+real_import = __builtin__.__import__
+stack = []
+modules = {}  # module name -> [self seconds, cumulative seconds]
+
+
+def imported_name(name, globals, fromlist, level, new):
+    # the module the import statement asked for, among those it loaded
+    candidates = []
+    package = (globals or {}).get("__name__", "")
+    if (globals or {}).get("__path__") is None:
+        package = package.rpartition(".")[0]
+
+    for prefix in ([package] if level != 0 and package else []) + [""]:
+        base = ".".join(part for part in (prefix, name) if part)
+        candidates.append(base)
+        candidates.extend(base + "." + item if base else item for item in (fromlist or ()))
+
+    for candidate in candidates:
+        if candidate in new:
+            return candidate
+
+    return min(new, key=len)
+
+
+def timed_import(name, globals=None, locals=None, fromlist=None, level=-1):
+    before = set(sys.modules)
+    stack.append(0.0)
+    import_start = clock()
+    try:
+        return real_import(name, globals, locals, fromlist, level)
+    finally:
+        elapsed = clock() - import_start
+        children = stack.pop()
+        if len(stack) > 0:
+            stack[-1] += elapsed
+
+        new = [module for module in set(sys.modules) - before if sys.modules[module] is not None]
+        if len(new) > 0:
+            entry = modules.setdefault(imported_name(name, globals, fromlist, level, new), [0.0, 0.0])
+            entry[0] += elapsed - children
+            entry[1] += elapsed
+
+__builtin__.__import__ = timed_import
+
+sys.path.insert(0, sys.argv[1])
+from stream2chromecast import cli
+cli.load_function(cli.parse_args(json.loads(sys.argv[2])).function)
+
+total = clock() - start
+__builtin__.__import__ = real_import
+
+print json.dumps({'total_ms': total * 1000,
+                  'modules': len([module for module in sys.modules.values() if module is not None]),
+                  'imports': dict((name, [t * 1000 for t in times]) for name, times in modules.items())})
+"""
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def measure(argv, python=sys.executable):
+    """ run a command's startup once - returns the wall time (ms) and the child's report """
+
+    start = time.time()
+    output = subprocess.check_output([python, "-c", CHILD, ROOT, json.dumps(argv)])
+    wall = (time.time() - start) * 1000
+
+    return wall, json.loads(output)
+
+
+def interpreter_ms(python=sys.executable, repeat=5):
+    """ the median wall time (ms) of starting an interpreter which does nothing, for reference """
+
+    times = []
+    for i in range(repeat):
+        start = time.time()
+        subprocess.check_call([python, "-c", "pass"])
+        times.append((time.time() - start) * 1000)
+
+    return median(times)
+
+
+def run_command(argv, repeat):
+    """ the median wall time and import time (ms) of a command, its module count and the import times
+        of the run with the median wall time """
+
+    runs = sorted((measure(argv) for i in range(repeat)), key=lambda run: run[0])
+    wall, report = runs[len(runs) // 2]
+
+    return {'wall_ms': wall,
+            'startup_ms': median([run[1]['total_ms'] for run in runs]),
+            'modules': report['modules'],
+            'imports': report['imports']}
+
+
+def print_profile(command, result, count=25):
+    print "%s: %.1f ms, %d modules" % (command, result['startup_ms'], result['modules'])
+    print
+    print "%10s %10s  %s" % ("self ms", "cumul ms", "module")
+
+    imports = sorted(result['imports'].items(), key=lambda item: item[1][1], reverse=True)
+    for name, (self_ms, cumulative_ms) in imports[:count]:
+        print "%10.2f %10.2f  %s" % (self_ms, cumulative_ms, name)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Command line startup benchmarks")
+    parser.add_argument("--commands", default=",".join(sorted(COMMANDS)),
+                        help="comma separated commands to measure (%s)" % ", ".join(sorted(COMMANDS)))
+    parser.add_argument("--repeat", type=int, default=10, help="runs of each command")
+    parser.add_argument("--budget-ms", type=float, default=50,
+                        help="the wall time, interpreter start included, each command should start within")
+    parser.add_argument("--profile", metavar="COMMAND", default=None,
+                        help="list the modules a command spends the most time importing")
+    parser.add_argument("--json", help="save the results to a file", default=None)
+    args = parser.parse_args()
+
+    if args.profile is not None:
+        if args.profile not in COMMANDS:
+            parser.error("unknown command: %s" % args.profile)
+
+        print_profile(args.profile, run_command(COMMANDS[args.profile], args.repeat))
+        return
+
+    commands = [command.strip() for command in args.commands.split(",")]
+    for command in commands:
+        if command not in COMMANDS:
+            parser.error("unknown command: %s" % command)
+
+    print "interpreter start: %.1f ms, budget: %.1f ms" % (interpreter_ms(), args.budget_ms)
+    print
+    print "%-14s %10s %10s %8s" % ("command", "wall ms", "import ms", "modules")
+
+    results = {}
+    over_budget = []
+    for command in commands:
+        result = results[command] = run_command(COMMANDS[command], args.repeat)
+
+        flag = ""
+        if result['wall_ms'] > args.budget_ms:
+            over_budget.append(command)
+            flag = "  over budget"
+
+        print "%-14s %10.1f %10.1f %8d%s" % (command, result['wall_ms'], result['startup_ms'], result['modules'], flag)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({'python': sys.version, 'budget_ms': args.budget_ms, 'results': results}, f,
+                      indent=1, sort_keys=True)
+
+    if len(over_budget) > 0:
+        print
+        print "over budget:", ", ".join(over_budget)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
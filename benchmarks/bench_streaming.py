@@ -0,0 +1,380 @@
+#!/usr/bin/env python
+"""
+Throughput and concurrency benchmarks for the HTTP streaming server.
+
+Starts the streaming server in a separate process against a generated media file and drives it with a number
+of loopback clients, reporting the aggregate and per-stream throughput, time to first byte percentiles and
+the CPU time and memory used by the server. Besides clients reading as fast as they can, some clients can be
+made to read slowly, to stall part way through, or to seek with Range requests.
+
+Transcoded streams are served through TranscodingRequestHandler. By default the transcoder is a synthetic
+stand-in which copies the file, so the benchmark runs without ffmpeg; use --transcoder ffmpeg for the real one.
+
+    python benchmarks/bench_streaming.py --clients 1,4,16
+    python benchmarks/bench_streaming.py --mode transcode --clients 8 --slow 2 --stall 1 --seek 1
+    python benchmarks/bench_streaming.py --json results.json
+
+"""
+
+
+# Copyright (C) 2014-2016 Pat Carter
+#
+# This file is part of Stream2chromecast.
+#
+# Stream2chromecast is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Stream2chromecast is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Stream2chromecast.  If not, see <http://www.gnu.org/licenses/>.
+
+
+
+import argparse
+import httplib
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from stream2chromecast import stream2chromecast
+
+# copies the file (or stdin, when given pipe:0 like ffmpeg) to stdout, standing in for ffmpeg - the transcode
+# options are passed as extra arguments
+SYNTHETIC_TRANSCODER = ('"%s" -c "import shutil, sys; '
+                        'src = sys.stdin if sys.argv[1] == \'pipe:0\' else open(sys.argv[1], \'rb\'); '
+                        'shutil.copyfileobj(src, sys.stdout, 65536)"' % sys.executable) + ' "%s" %s'
+
+READ_SIZE = 65536
+
+
+def percentile(values, fraction):
+    """ the value below which the given fraction of the values lie (nearest rank) """
+
+    if len(values) == 0:
+        return None
+
+    ordered = sorted(values)
+    index = min(int(fraction * len(ordered)), len(ordered) - 1)
+
+    return ordered[index]
+
+
+def create_media(directory, size):
+    """ write a file of random data standing in for a media file - returns its path """
+
+    filepath = os.path.join(directory, "media.mp4")
+
+    with open(filepath, "wb") as f:
+        remaining = size
+        while remaining > 0:
+            block = os.urandom(min(remaining, 1024 * 1024))
+            f.write(block)
+            remaining -= len(block)
+
+    return filepath
+
+
+class BenchRequestHandler(stream2chromecast.TranscodingRequestHandler):
+    """ serves the benchmark file directly at /file and through the transcoder at /transcode """
+
+    def get_filepath(self):
+        path = self.path.split("?")[0]
+
+        if path == "/file":
+            self.transcode = False
+        elif path == "/transcode":
+            self.transcode = True
+        else:
+            return None
+
+        return self.server.filepath
+
+    def write_response(self, filepath):
+        if self.transcode:
+            stream2chromecast.TranscodingRequestHandler.write_response(self, filepath)
+        else:
+            stream2chromecast.RequestHandler.write_response(self, filepath)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(filepath, transcoder_command, conn):
+    """ run the streaming server until told to stop, then report the resources it used (child process) """
+
+    # the request handlers report each request on stdout
+    devnull = open(os.devnull, "w")
+    os.dup2(devnull.fileno(), sys.stdout.fileno())
+
+    BenchRequestHandler.transcoder_command = transcoder_command
+
+    server = stream2chromecast.StreamingServer(("127.0.0.1", 0), BenchRequestHandler)
+    server.filepath = filepath
+
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    conn.send(server.server_port)
+    conn.recv()
+
+    server.shutdown()
+
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    conn.send({'server_cpu': usage.ru_utime + usage.ru_stime,
+               'transcoder_cpu': children.ru_utime + children.ru_stime,
+               'max_rss_kb': usage.ru_maxrss})
+
+
+class Client(threading.Thread):
+    """ one streaming client - reads the whole stream in the way its kind dictates
+
+        fast  - reads as fast as possible
+        slow  - reads at slow_rate bytes per second
+        stall - reads a quarter of the stream, stops reading for stall_time seconds, then reads the rest
+        seek  - makes Range requests for several points through the file, reading the first block of each
+    """
+
+    def __init__(self, port, path, kind, size, slow_rate=256 * 1024, stall_time=2.0, seeks=4):
+        threading.Thread.__init__(self)
+        self.daemon = True
+
+        self.port = port
+        self.path = path
+        self.kind = kind
+        self.size = size
+        self.slow_rate = slow_rate
+        self.stall_time = stall_time
+        self.seeks = seeks
+
+        self.bytes_read = 0
+        self.ttfbs = []
+        self.duration = None
+        self.ranges_honoured = 0
+        self.error = None
+
+    def request(self, headers={}):
+        """ send a request - returns the connection, the response and the time to the first byte of the body """
+
+        conn = httplib.HTTPConnection("127.0.0.1", self.port, timeout=60)
+        start = time.time()
+        conn.request("GET", self.path, headers=headers)
+        response = conn.getresponse()
+
+        data = response.read(1)
+        ttfb = time.time() - start
+        self.bytes_read += len(data)
+
+        return conn, response, ttfb
+
+    def run(self):
+        start = time.time()
+
+        try:
+            if self.kind == "seek":
+                self.run_seeks()
+            else:
+                self.run_stream()
+        except Exception as e:
+            self.error = "%s: %s" % (e.__class__.__name__, e)
+
+        self.duration = time.time() - start
+
+    def run_stream(self):
+        conn, response, ttfb = self.request()
+        self.ttfbs.append(ttfb)
+
+        started = time.time()
+        stalled = False
+
+        while True:
+            data = response.read(READ_SIZE)
+            if len(data) == 0:
+                break
+
+            self.bytes_read += len(data)
+
+            if self.kind == "slow":
+                delay = started + float(self.bytes_read) / self.slow_rate - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+
+            elif self.kind == "stall" and not stalled and self.bytes_read >= self.size // 4:
+                time.sleep(self.stall_time)
+                stalled = True
+
+        conn.close()
+
+    def run_seeks(self):
+        for i in range(self.seeks):
+            offset = self.size * (i + 1) // (self.seeks + 1)
+
+            conn, response, ttfb = self.request({"Range": "bytes=%d-" % offset})
+            self.ttfbs.append(ttfb)
+
+            if response.status == 206:
+                self.ranges_honoured += 1
+
+            self.bytes_read += len(response.read(READ_SIZE))
+            conn.close()
+
+
+def run_scenario(filepath, size, mode, transcoder_command, kinds, options):
+    """ run one set of concurrent clients against a fresh server - returns the results """
+
+    parent_conn, child_conn = multiprocessing.Pipe()
+    server = multiprocessing.Process(target=serve, args=(filepath, transcoder_command, child_conn))
+    server.start()
+
+    try:
+        port = parent_conn.recv()
+
+        path = "/file" if mode == "file" else "/transcode"
+        clients = [Client(port, path, kind, size, slow_rate=options.slow_rate,
+                          stall_time=options.stall_time, seeks=options.seeks) for kind in kinds]
+
+        start = time.time()
+        for client in clients:
+            client.start()
+        for client in clients:
+            client.join()
+        wall_time = time.time() - start
+
+        parent_conn.send("stop")
+        usage = parent_conn.recv()
+    finally:
+        server.join(5)
+        if server.is_alive():
+            server.terminate()
+
+    streams = [client for client in clients if client.kind != "seek" and client.error is None]
+    total_bytes = sum(client.bytes_read for client in clients)
+    ttfbs = [ttfb for client in clients for ttfb in client.ttfbs]
+    seek_ttfbs = [ttfb for client in clients if client.kind == "seek" for ttfb in client.ttfbs]
+
+    results = {'clients': len(clients),
+               'kinds': dict((kind, kinds.count(kind)) for kind in set(kinds)),
+               'errors': [client.error for client in clients if client.error is not None],
+               'wall_time': wall_time,
+               'total_mb': total_bytes / 1e6,
+               'throughput_mb_s': total_bytes / 1e6 / wall_time,
+               'stream_mb_s': [client.bytes_read / 1e6 / client.duration for client in streams],
+               'ttfb_p50_ms': None, 'ttfb_p95_ms': None, 'ttfb_p99_ms': None,
+               'seek_ttfb_p95_ms': None,
+               'ranges_honoured': sum(client.ranges_honoured for client in clients),
+               'cpu_s': usage['server_cpu'] + usage['transcoder_cpu'],
+               'cpu_s_per_stream': (usage['server_cpu'] + usage['transcoder_cpu']) / max(len(clients), 1),
+               'server_max_rss_mb': usage['max_rss_kb'] / 1024.0}
+
+    for name, fraction in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99)):
+        if len(ttfbs) > 0:
+            results['ttfb_%s_ms' % name] = percentile(ttfbs, fraction) * 1000
+
+    if len(seek_ttfbs) > 0:
+        results['seek_ttfb_p95_ms'] = percentile(seek_ttfbs, 0.95) * 1000
+
+    incomplete = [client for client in streams if client.bytes_read < size and mode == "file"]
+    if len(incomplete) > 0:
+        results['errors'].append("%d streams ended early" % len(incomplete))
+
+    return results
+
+
+def client_kinds(count, slow, stall, seek):
+    """ the kind of each client - the slow, stalling and seeking clients replace fast ones """
+
+    kinds = ["slow"] * slow + ["stall"] * stall + ["seek"] * seek
+    kinds = kinds[:count]
+
+    return kinds + ["fast"] * (count - len(kinds))
+
+
+def print_results(name, results):
+    def ms(value):
+        return "-" if value is None else "%.1f" % value
+
+    stream_rates = results['stream_mb_s']
+    mean_rate = sum(stream_rates) / len(stream_rates) if len(stream_rates) > 0 else 0
+
+    print "%-22s %8.1f %10.1f %8s %8s %8s %8s %9.3f %8.1f %s" % (
+        name, results['throughput_mb_s'], mean_rate,
+        ms(results['ttfb_p50_ms']), ms(results['ttfb_p95_ms']), ms(results['ttfb_p99_ms']),
+        ms(results['seek_ttfb_p95_ms']), results['cpu_s_per_stream'], results['server_max_rss_mb'],
+        "; ".join(results['errors']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="HTTP streaming server benchmarks")
+    parser.add_argument("--mode", choices=["file", "transcode", "both"], default="file",
+                        help="serve the file directly, through the transcoder, or run both")
+    parser.add_argument("--transcoder", choices=["synthetic", "ffmpeg", "avconv"], default="synthetic",
+                        help="transcoder used for transcoded streams (default: a stand-in copying the file)")
+    parser.add_argument("--clients", default="1,4,16",
+                        help="comma separated numbers of concurrent clients - one run for each")
+    parser.add_argument("--size", type=float, default=64, help="size of the generated media file in megabytes")
+    parser.add_argument("--slow", type=int, default=0, help="number of clients reading slowly")
+    parser.add_argument("--slow-rate", type=int, default=1024 * 1024, help="bytes per second read by slow clients")
+    parser.add_argument("--stall", type=int, default=0, help="number of clients stalling part way through")
+    parser.add_argument("--stall-time", type=float, default=2.0, help="seconds for which stalling clients stop")
+    parser.add_argument("--seek", type=int, default=0, help="number of clients making Range requests")
+    parser.add_argument("--seeks", type=int, default=4, help="Range requests made by each seeking client")
+    parser.add_argument("--json", help="save the results to a file", default=None)
+    args = parser.parse_args()
+
+    transcoder_command = SYNTHETIC_TRANSCODER
+    if args.transcoder == "ffmpeg":
+        transcoder_command = stream2chromecast.FFMPEG
+    elif args.transcoder == "avconv":
+        transcoder_command = stream2chromecast.AVCONV
+
+    modes = ["file", "transcode"] if args.mode == "both" else [args.mode]
+    counts = [int(count) for count in args.clients.split(",")]
+
+    directory = tempfile.mkdtemp(prefix="bench_streaming")
+    try:
+        size = int(args.size * 1024 * 1024)
+        filepath = create_media(directory, size)
+
+        print "%-22s %8s %10s %8s %8s %8s %8s %9s %8s" % ("scenario", "MB/s", "stream MB/s", "ttfb50",
+                                                         "ttfb95", "ttfb99", "seek95", "cpu/strm", "rss MB")
+
+        all_results = {}
+        for mode in modes:
+            for count in counts:
+                kinds = client_kinds(count, args.slow, args.stall, args.seek)
+                name = "%s/%d" % (mode, count)
+
+                results = run_scenario(filepath, size, mode, transcoder_command, kinds, args)
+                all_results[name] = results
+                print_results(name, results)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    if args.seek > 0 and sum(results['ranges_honoured'] for results in all_results.values()) == 0:
+        print
+        print "Range requests are answered with the whole stream (no 206 responses)"
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({'python': sys.version, 'transcoder': args.transcoder, 'results': all_results},
+                      f, indent=1, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
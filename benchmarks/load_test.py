@@ -0,0 +1,300 @@
+#!/usr/bin/env python
+"""
+Load tests driving a fleet of simulated Chromecast devices through the public API.
+
+Starts a number of simulated devices (see stream2chromecast/cc_simulator.py) on consecutive loopback addresses
+and runs each workload in turn with a number of concurrent workers, reporting for every operation the number
+made, the error rate, the throughput and the latency percentiles.
+
+Workloads:
+    discover    - network searches (cc_device_finder.search_network) expecting every device to respond
+    find        - looking devices up by name on the network (cc_device_finder.find_device, bypassing the cache)
+    find_cached - looking devices up by name (cc_device_finder.find_device), from the cache after the first search
+    play        - loading media on the devices (CCMediaController.load), served by the streaming server
+    status      - polling the devices' status (CCMediaController.get_status)
+    volume      - changing the devices' volume (CCMediaController.set_volume)
+
+    python benchmarks/load_test.py --devices 20 --concurrency 10
+    python benchmarks/load_test.py --devices 50 --workloads discover,status --duration 30 --persistent
+
+"""
+
+
+# Copyright (C) 2014-2016 Pat Carter
+#
+# This file is part of Stream2chromecast.
+#
+# Stream2chromecast is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Stream2chromecast is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Stream2chromecast.  If not, see <http://www.gnu.org/licenses/>.
+
+
+
+import argparse
+import itertools
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import urllib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from bench_streaming import create_media, percentile
+from stream2chromecast import cc_device_finder
+from stream2chromecast import stream2chromecast
+from stream2chromecast.cc_media_controller import CCMediaController
+from stream2chromecast.cc_simulator import Simulator
+
+WORKLOADS = ("discover", "find", "find_cached", "play", "status", "volume")
+
+
+class QuietRequestHandler(stream2chromecast.RequestHandler):
+    """ the streaming server's request handler, without the access log """
+
+    def log_message(self, format, *args):
+        pass
+
+
+class LoadTest(object):
+    """ runs workloads against a set of simulated devices, recording the latency and outcome of each operation """
+
+    def __init__(self, simulator, media_url, persistent=False, search_time=5):
+        self.simulator = simulator
+        self.devices = simulator.devices
+        self.media_url = media_url
+        self.persistent = persistent
+        self.search_time = search_time
+
+        self.lock = threading.Lock()
+        self.controllers = {}  # device ip -> (CCMediaController, lock) when connections are persistent
+        self.samples = {}      # operation -> list of (latency, error)
+
+    def record(self, operation, latency, error):
+        with self.lock:
+            self.samples.setdefault(operation, []).append((latency, error))
+
+    def controller(self, device):
+        """ a controller for the device - a new one for each operation unless connections are persistent """
+
+        if not self.persistent:
+            return CCMediaController(device_name=device.ip), None
+
+        with self.lock:
+            if device.ip not in self.controllers:
+                self.controllers[device.ip] = (CCMediaController(device_name=device.ip, persistent=True),
+                                               threading.Lock())
+
+            return self.controllers[device.ip]
+
+    def with_controller(self, device, operation):
+        cast, lock = self.controller(device)
+
+        if lock is None:
+            try:
+                return operation(cast)
+            finally:
+                cast.close_socket(force=True)
+
+        with lock:
+            return operation(cast)
+
+    # operations - each raises an exception on failure
+
+    def op_discover(self, device):
+        found = cc_device_finder.search_network(device_limit=len(self.devices), time_limit=self.search_time)
+        missing = len(set(d.ip for d in self.devices) - set(found))
+        if missing > 0:
+            raise RuntimeError("%d devices did not respond" % missing)
+
+    def op_find(self, device):
+        self.find(device, use_cache=False)
+
+    def op_find_cached(self, device):
+        self.find(device, use_cache=True)
+
+    def find(self, device, use_cache):
+        ip_addr, name = cc_device_finder.find_device(name=device.name, time_limit=self.search_time,
+                                                     use_cache=use_cache)
+        if ip_addr != device.ip:
+            raise RuntimeError("%s found at %s" % (device.name, ip_addr))
+
+    def op_play(self, device):
+        self.with_controller(device, lambda cast: cast.load(self.media_url, "video/mp4", None, None))
+
+    def op_status(self, device):
+        self.with_controller(device, lambda cast: cast.get_status())
+
+    def op_volume(self, device):
+        self.with_controller(device, lambda cast: cast.set_volume(round(random.random(), 2)))
+
+    def run_workload(self, workload, concurrency, duration, iterations):
+        """ run an operation from concurrency threads until duration seconds have passed or each thread
+            has made iterations operations - returns the elapsed time """
+
+        operation = getattr(self, "op_" + workload)
+        device_cycle = itertools.cycle(self.devices)
+        cycle_lock = threading.Lock()
+        deadline = time.time() + duration
+
+        def worker():
+            count = 0
+            while time.time() < deadline and (iterations is None or count < iterations):
+                with cycle_lock:
+                    device = next(device_cycle)
+
+                start = time.time()
+                error = None
+                try:
+                    operation(device)
+                except SystemExit as e:
+                    # the controller exits when it can't find or reach a device
+                    error = str(e.code)
+                except Exception as e:
+                    error = "%s: %s" % (e.__class__.__name__, e)
+
+                self.record(workload, time.time() - start, error)
+                count += 1
+
+        threads = [threading.Thread(target=worker) for i in range(concurrency)]
+
+        start = time.time()
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        return time.time() - start
+
+    def close(self):
+        for cast, lock in self.controllers.values():
+            cast.close_socket(force=True)
+
+
+def summarise(samples, elapsed):
+    """ the count, error rate, throughput and latency percentiles of one operation's samples """
+
+    latencies = [latency for latency, error in samples if error is None]
+    errors = [error for latency, error in samples if error is not None]
+
+    summary = {'count': len(samples),
+               'errors': len(errors),
+               'error_rate': float(len(errors)) / len(samples) if len(samples) > 0 else 0.0,
+               'ops_per_sec': len(samples) / elapsed if elapsed > 0 else 0.0,
+               'first_errors': sorted(set(errors))[:5]}
+
+    for name, fraction in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99), ("max", 1.0)):
+        value = percentile(latencies, fraction)
+        summary[name + '_ms'] = None if value is None else value * 1000
+
+    return summary
+
+
+def print_summary(workload, summary, out=sys.stdout):
+    def ms(value):
+        return "-" if value is None else "%.1f" % value
+
+    print >> out, "%-10s %7d %7d %7.1f%% %9.1f %9s %9s %9s %9s" % (
+        workload, summary['count'], summary['errors'], summary['error_rate'] * 100, summary['ops_per_sec'],
+        ms(summary['p50_ms']), ms(summary['p95_ms']), ms(summary['p99_ms']), ms(summary['max_ms']))
+
+    for error in summary['first_errors']:
+        print >> out, "    error:", error
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load tests against a fleet of simulated Chromecast devices")
+    parser.add_argument("--devices", type=int, default=10, help="number of simulated devices")
+    parser.add_argument("--base-ip", default="127.0.0.2", help="loopback address of the first device")
+    parser.add_argument("--workloads", default=",".join(WORKLOADS),
+                        help="comma separated workloads to run in turn (%s)" % ", ".join(WORKLOADS))
+    parser.add_argument("--concurrency", type=int, default=10, help="concurrent workers in each workload")
+    parser.add_argument("--duration", type=float, default=10, help="seconds each workload runs for")
+    parser.add_argument("--iterations", type=int, default=None,
+                        help="operations made by each worker (default: as many as the duration allows)")
+    parser.add_argument("--persistent", action="store_true",
+                        help="keep one connection open to each device instead of connecting for every operation")
+    parser.add_argument("--bitrate", type=int, default=None, help="bits per second at which the devices fetch media")
+    parser.add_argument("--media-size", type=float, default=1, help="size of the played media in megabytes")
+    parser.add_argument("--json", help="save the results to a file", default=None)
+    args = parser.parse_args()
+
+    workloads = [workload.strip() for workload in args.workloads.split(",")]
+    for workload in workloads:
+        if workload not in WORKLOADS:
+            parser.error("unknown workload: %s" % workload)
+
+    directory = tempfile.mkdtemp(prefix="load_test")
+
+    # keep the simulated devices out of the user's device cache
+    cc_device_finder.CACHE_FILE = os.path.join(directory, "device_cache")
+
+    filepath = create_media(directory, int(args.media_size * 1024 * 1024))
+
+    server = stream2chromecast.StreamingServer(("", 0), QuietRequestHandler)
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+
+    media_path = urllib.quote(filepath)
+    server.media[media_path] = {'filepath': filepath}
+    media_url = "http://127.0.0.1:%d%s" % (server.server_port, media_path)
+
+    simulator = Simulator(count=args.devices, base_ip=args.base_ip, bitrate=args.bitrate)
+    simulator.start()
+
+    load_test = LoadTest(simulator, media_url, persistent=args.persistent)
+    results = {}
+
+    print "%d simulated devices, %d workers, %s connections" % (args.devices, args.concurrency,
+                                                                  "persistent" if args.persistent else "new")
+    print
+    print "%-10s %7s %7s %8s %9s %9s %9s %9s %9s" % ("operation", "count", "errors", "err rate", "ops/sec",
+                                                      "p50 ms", "p95 ms", "p99 ms", "max ms")
+
+    # the library and the streaming server report their progress on stdout - this is left redirected
+    # until the end, as the devices may still be fetching media when they are stopped
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    try:
+        for workload in workloads:
+            elapsed = load_test.run_workload(workload, args.concurrency, args.duration, args.iterations)
+
+            results[workload] = summarise(load_test.samples.get(workload, []), elapsed)
+            print_summary(workload, results[workload], stdout)
+    finally:
+        load_test.close()
+        simulator.stop()
+        server.shutdown()
+        shutil.rmtree(directory, ignore_errors=True)
+
+    device_stats = [device.stats for device in simulator.devices]
+    ttfbs = [ttfb for stats in device_stats for ttfb in stats['time_to_first_byte']]
+    if len(ttfbs) > 0:
+        print >> stdout
+        print >> stdout, "media fetched by the devices: %.1f MB, time to first byte p50 %.1f ms, p95 %.1f ms" % (
+            sum(stats['bytes_fetched'] for stats in device_stats) / 1e6,
+            percentile(ttfbs, 0.5) * 1000, percentile(ttfbs, 0.95) * 1000)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({'python': sys.version, 'devices': args.devices, 'concurrency': args.concurrency,
+                       'persistent': args.persistent, 'results': results}, f, indent=1, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
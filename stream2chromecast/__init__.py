@@ -1,7 +1,58 @@
-from .stream2chromecast import (
-    get_status, list_devices, pause, play, playurl, run, set_volume,
-    stop, unpause, volume_down, volume_up
-)
+# the commands are imported when they are first called, so that importing the package
+# (as the console script does) doesn't load the streaming server and everything it needs
+
+from .cli import run
+
+
+def get_status(*args, **kwargs):
+    from .controls import get_status
+    return get_status(*args, **kwargs)
+
+
+def list_devices(*args, **kwargs):
+    from .stream2chromecast import list_devices
+    return list_devices(*args, **kwargs)
+
+
+def pause(*args, **kwargs):
+    from .controls import pause
+    return pause(*args, **kwargs)
+
+
+def play(*args, **kwargs):
+    from .stream2chromecast import play
+    return play(*args, **kwargs)
+
+
+def playurl(*args, **kwargs):
+    from .stream2chromecast import playurl
+    return playurl(*args, **kwargs)
+
+
+def set_volume(*args, **kwargs):
+    from .controls import set_volume
+    return set_volume(*args, **kwargs)
+
+
+def stop(*args, **kwargs):
+    from .controls import stop
+    return stop(*args, **kwargs)
+
+
+def unpause(*args, **kwargs):
+    from .controls import unpause
+    return unpause(*args, **kwargs)
+
+
+def volume_down(*args, **kwargs):
+    from .controls import volume_down
+    return volume_down(*args, **kwargs)
+
+
+def volume_up(*args, **kwargs):
+    from .controls import volume_up
+    return volume_up(*args, **kwargs)
+
 
 __all__ = [
     'get_status',
@@ -1,4 +1,4 @@
-from .stream2chromecast import run
+from .cli import run
 
 if __name__ == '__main__':
     run()
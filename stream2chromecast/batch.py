@@ -0,0 +1,220 @@
+"""
+Runs a script of control commands against one or more Chromecast devices over kept-alive connections.
+
+Each line of the script holds one command, optionally followed by -d/--device_name to choose the device:
+
+    pause -d living_room
+    setvol 0.3
+    wait PLAYING 20
+    sleep 1.5
+    status
+
+Blank lines and lines starting with # are ignored.
+
+version 0.1
+
+"""
+
+
+# Copyright (C) 2014-2016 Pat Carter
+#
+# This file is part of Stream2chromecast.
+#
+# Stream2chromecast is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Stream2chromecast is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Stream2chromecast.  If not, see <http://www.gnu.org/licenses/>.
+
+
+
+import inspect
+import shlex
+import socket
+import ssl
+import sys
+import time
+
+from .cc_media_controller import CCMediaController
+
+
+class BatchError(Exception):
+    pass
+
+
+class BatchRunner(object):
+    """ executes batch commands, keeping one open connection per device """
+
+    def __init__(self, device_name=None):
+        """ initialise - device_name is used for commands which don't name a device """
+
+        self.default_device = device_name
+        self.controllers = {}
+
+    def get_controller(self, device_name):
+        """ return the kept-alive connection to a device """
+
+        if device_name is None:
+            device_name = self.default_device
+
+        if device_name not in self.controllers:
+            self.controllers[device_name] = CCMediaController(device_name=device_name, persistent=True)
+
+        return self.controllers[device_name]
+
+    def drop_controller(self, device_name):
+        """ close and forget a device connection which has failed, so that the next command reconnects """
+
+        if device_name is None:
+            device_name = self.default_device
+
+        cast = self.controllers.pop(device_name, None)
+        if cast is not None:
+            try:
+                cast.close_socket(force=True)
+            except (socket.error, ssl.SSLError):
+                pass
+
+    def close(self):
+        """ close all the device connections """
+
+        for cast in self.controllers.values():
+            cast.close_socket(force=True)
+
+        self.controllers = {}
+
+    def do_pause(self, cast):
+        cast.pause()
+
+    def do_continue(self, cast):
+        cast.play()
+
+    def do_stop(self, cast):
+        cast.stop()
+
+    def do_status(self, cast):
+        print cast.get_status()
+
+    def do_setvol(self, cast, volume):
+        cast.set_volume(float(volume))
+
+    def do_volup(self, cast):
+        cast.set_volume_up()
+
+    def do_voldown(self, cast):
+        cast.set_volume_down()
+
+    def do_mute(self, cast):
+        cast.set_volume(0)
+
+    def do_playurl(self, cast, url, mimetype="video/mp4"):
+        cast.load(url, mimetype, None, None)
+
+    def do_wait(self, cast, states, timeout=None):
+        """ wait until the player is in one of the comma separated states, following the status pushed by the
+            device """
+
+        states = [state.upper() for state in states.split(",")]
+
+        if timeout is not None:
+            timeout = float(timeout)
+
+        # the media player closing its connection leaves the player idle
+        event = cast.watch(lambda event: event['type'] == "CLOSED" or event.get('state') in states, timeout)
+
+        if event is None:
+            raise BatchError("timed out waiting for %s" % " or ".join(states))
+
+        if event['type'] == "CLOSED" and "IDLE" not in states:
+            raise BatchError("the media player closed while waiting for %s" % " or ".join(states))
+
+    def execute(self, line):
+        """ run one line of the script """
+
+        words = shlex.split(line, comments=True)
+        if len(words) == 0:
+            return
+
+        device_name = None
+        args = []
+        while len(words) > 0:
+            word = words.pop(0)
+            if word in ("-d", "--device_name"):
+                if len(words) == 0:
+                    raise BatchError("%s requires a device name" % word)
+                device_name = words.pop(0)
+            else:
+                args.append(word)
+
+        if len(args) == 0:
+            raise BatchError("missing command")
+
+        command = args.pop(0)
+
+        if command == "sleep":
+            if len(args) != 1:
+                raise BatchError("sleep takes one argument")
+            time.sleep(float(args[0]))
+            return
+
+        handler = getattr(self, "do_" + command, None)
+        if handler is None:
+            raise BatchError("unknown command: %s" % command)
+
+        # the handler's parameters are self, the device connection and then the command's own arguments
+        spec = inspect.getargspec(handler)
+        max_args = len(spec.args) - 2
+        min_args = max_args - len(spec.defaults or ())
+        if not min_args <= len(args) <= max_args:
+            raise BatchError("wrong number of arguments for %s" % command)
+
+        try:
+            handler(self.get_controller(device_name), *args)
+        except (socket.error, ssl.SSLError) as e:
+            self.drop_controller(device_name)
+            raise BatchError("device connection failed: %s" % e)
+        except SystemExit as e:
+            # the device wasn't found, or the media player couldn't be launched
+            self.drop_controller(device_name)
+            raise BatchError(e.code)
+
+    def run(self, lines, keep_going=False):
+        """ run every line of a script - returns the number of failed lines """
+
+        failures = 0
+
+        for line_no, line in enumerate(lines, 1):
+            try:
+                self.execute(line)
+            except (BatchError, ValueError) as e:
+                print >> sys.stderr, "line %d: %s" % (line_no, e)
+                failures += 1
+                if not keep_going:
+                    break
+
+        return failures
+
+
+def run_batch(script="-", device_name=None, keep_going=False):
+    """ run a batch script from a file, or from stdin if the filename is - """
+
+    runner = BatchRunner(device_name=device_name)
+
+    try:
+        if script == "-":
+            failures = runner.run(sys.stdin, keep_going)
+        else:
+            with open(script, "r") as f:
+                failures = runner.run(f, keep_going)
+    finally:
+        runner.close()
+
+    if failures > 0:
+        sys.exit("%d batch command(s) failed" % failures)
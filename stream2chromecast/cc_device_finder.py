@@ -28,165 +28,710 @@ Parts of this are adapted from code found in PyChromecast - https://github.com/b
 
 
 
-import datetime
-import httplib
+import array
+import fcntl
+import json
 import os
+import Queue
 import select
 import socket
-import urlparse
-from xml.etree import ElementTree
+import struct
+import threading
+import time
 
 CACHE_FILE = "~/.cc_device_cache"
 
+SSDP_ADDR = "239.255.255.250"
+SSDP_PORT = 1900
+DIAL_SERVICE = "urn:dial-multiscreen-org:service:dial:1"
 
-def search_network(device_limit=None, time_limit=5):
-    """ SSDP discovery """
+# seconds after the start of a search at which the M-SEARCH request is sent again, in case it was lost
+SSDP_RETRANSMITS = (0.25, 0.75, 1.75, 3.75)
 
-    addrs = []
+# largest possible UDP datagram
+MAX_DATAGRAM_SIZE = 65507
+
+# linux ioctls and interface flags used to find the network interfaces
+SIOCGIFCONF = 0x8912
+SIOCGIFFLAGS = 0x8913
+IFF_UP = 0x1
+IFF_LOOPBACK = 0x8
+IFF_MULTICAST = 0x1000
+
+# seconds for which a cached device address is used without checking it
+CACHE_TTL = 24 * 60 * 60
+
+# the details kept for each device in the cache
+CACHE_FIELDS = ("ip", "port", "uuid", "model")
+
+_cache_lock = threading.Lock()
+
+# longest time a search waits before checking whether it has been asked to stop
+STOP_CHECK_INTERVAL = 0.1
+
+# seconds allowed for each step (connect, send, receive) of a device description request
+DESCRIPTION_TIMEOUT = 2
+
+# number of device descriptions fetched at the same time
+DESCRIPTION_WORKERS = 16
+
+UPNP_DEVICE_NS = "{urn:schemas-upnp-org:device-1-0}"
+
+# the discovery backends used when none are specified - any of "ssdp" and "mdns"
+DISCOVERY_METHODS = ("ssdp",)
+
+# the running cc_discovery_service.DiscoveryService, whose device table is used in place of searching
+discovery_service = None
+
+
+def _load_monotonic():
+    """ returns a function reading a clock which is unaffected by changes to the system time """
+
+    import ctypes
+    import ctypes.util
+
+    class timespec(ctypes.Structure):
+        _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+    CLOCK_MONOTONIC = 1
+
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        clock_gettime = libc.clock_gettime
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+    except (OSError, AttributeError):
+        # the clock isn't available on this platform - fall back to the system time
+        return time.time
+
+    def monotonic():
+        t = timespec()
+        if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(t)) != 0:
+            return time.time()
+        return t.tv_sec + t.tv_nsec * 1e-9
+
+    return monotonic
+
+
+_monotonic = getattr(time, "monotonic", None)
 
-    start_time = datetime.datetime.now()
+
+def monotonic():
+    """ the monotonic clock's time - the clock is loaded on first use, keeping ctypes out of commands
+        which never search the network """
+
+    global _monotonic
+
+    if _monotonic is None:
+        _monotonic = _load_monotonic()
+
+    return _monotonic()
+
+
+def get_multicast_interfaces():
+    """ returns the ipv4 addresses of the network interfaces which are up and can send multicast,
+        or [None] (meaning the default interface) if they can't be listed """
 
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        # each ifreq structure is a 16 byte name followed by a 16 (or 24 on 64 bit systems) byte union
+        ifreq_size = 40 if struct.calcsize("P") == 8 else 32
+        buf = array.array("B", "\0" * ifreq_size * 64)
+        ifconf = struct.pack("iP", buf.buffer_info()[1], buf.buffer_info()[0])
+        length = struct.unpack("iP", fcntl.ioctl(sock.fileno(), SIOCGIFCONF, ifconf))[0]
+
+        data = buf.tostring()
+        addrs = []
+        for offset in range(0, length, ifreq_size):
+            name = data[offset:offset + 16]
+            addr = socket.inet_ntoa(data[offset + 20:offset + 24])
+
+            flags = struct.unpack("H", fcntl.ioctl(sock.fileno(), SIOCGIFFLAGS, name + "\0" * 16)[16:18])[0]
+            if flags & IFF_UP and flags & IFF_MULTICAST and not flags & IFF_LOOPBACK and addr not in addrs:
+                addrs.append(addr)
+    except (IOError, OSError, struct.error):
+        return [None]
+    finally:
+        sock.close()
+
+    if len(addrs) == 0:
+        return [None]
+
+    return addrs
+
+
+def extract_ssdp_headers(data):
+    """ extracts the start line and the headers (with upper case names) of an SSDP message """
+
+    lines = data.split("\r\n")
+
+    headers = {}
+    for line in lines[1:]:
+        if ":" in line:
+            key, value = line.split(":", 1)
+            headers[key.strip().upper()] = value.strip()
+
+    return lines[0], headers
+
+
+def open_search_socket(interface_addr):
+    """ open a socket sending multicast on the interface with the given address (or the default interface) """
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 2)
+
+    if interface_addr is not None:
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(interface_addr))
+        sock.bind((interface_addr, 0))
+
     sock.setblocking(0)
 
-    req = "\r\n".join(['M-SEARCH * HTTP/1.1',
-                       'HOST: 239.255.255.250:1900',
-                       'MAN: "ssdp:discover"',
-                       'MX: 1',
-                       'ST: urn:dial-multiscreen-org:service:dial:1',
-                       '', ''])
+    return sock
+
+
+def search_network(device_limit=None, time_limit=5):
+    """ SSDP discovery """
+
+    return list(iter_search_network(device_limit=device_limit, time_limit=time_limit))
 
-    sock.sendto(req, ("239.255.255.250", 1900))
 
-    while True:
-        time_remaining = time_limit - (datetime.datetime.now() - start_time).seconds
-        if time_remaining <= 0:
-            break
+def iter_search_network(device_limit=None, time_limit=5, stop_event=None):
+    """ SSDP discovery - yields the address of each device as it responds 
+    
+        The search request is sent on every multicast capable interface, and sent again at the times
+        in SSDP_RETRANSMITS in case it or the responses are lost. Devices are recognised by their USN,
+        so each is reported once.
+        The search ends after time_limit seconds, once device_limit devices have responded,
+        or when stop_event (a threading.Event) is set.
+    """
 
-        readable = select.select([sock], [], [], time_remaining)[0]
+    # imported here as commands which find the device in the cache never search the network
+    import urlparse
 
-        if sock in readable:
-            st, addr = None, None
+    start_time = monotonic()
+    deadline = start_time + time_limit
 
-            data = sock.recv(1024)
+    req = "\r\n".join(['M-SEARCH * HTTP/1.1',
+                       'HOST: %s:%d' % (SSDP_ADDR, SSDP_PORT),
+                       'MAN: "ssdp:discover"',
+                       'MX: 1',
+                       'ST: ' + DIAL_SERVICE,
+                       '', ''])
 
-            for line in data.split("\r\n"):
-                line = line.replace(" ", "")
+    socks = []
+    for interface_addr in get_multicast_interfaces():
+        try:
+            socks.append(open_search_socket(interface_addr))
+        except socket.error:
+            pass
 
-                if line.upper().startswith("LOCATION:"):
-                    addr = urlparse.urlparse(line[9:].strip()).hostname
+    if len(socks) == 0:
+        socks.append(open_search_socket(None))
 
-                elif line.upper().startswith("ST:"):
-                    st = line[3:].strip()
+    send_times = [0] + [delay for delay in SSDP_RETRANSMITS if delay < time_limit]
 
-            if addr is not None and st == "urn:dial-multiscreen-org:service:dial:1":
+    seen_usns = set()
+    addrs = []
+
+    try:
+        while True:
+            now = monotonic()
+            if now >= deadline or (stop_event is not None and stop_event.is_set()):
+                break
+
+            while len(send_times) > 0 and now >= start_time + send_times[0]:
+                send_times.pop(0)
+                for sock in socks:
+                    try:
+                        sock.sendto(req, (SSDP_ADDR, SSDP_PORT))
+                    except socket.error:
+                        pass
+
+            wait_until = deadline
+            if len(send_times) > 0:
+                wait_until = min(wait_until, start_time + send_times[0])
+
+            timeout = max(wait_until - now, 0)
+            if stop_event is not None:
+                timeout = min(timeout, STOP_CHECK_INTERVAL)
+
+            readable = select.select(socks, [], [], timeout)[0]
+
+            for sock in readable:
+                try:
+                    data = sock.recv(MAX_DATAGRAM_SIZE)
+                except socket.error:
+                    continue
+
+                headers = extract_ssdp_headers(data)[1]
+                if headers.get("ST") != DIAL_SERVICE:
+                    continue
+
+                addr = urlparse.urlparse(headers.get("LOCATION", "")).hostname
+                if addr is None:
+                    continue
+
+                # responses to the retransmitted requests repeat the same USN
+                usn = headers.get("USN", addr)
+                if usn in seen_usns:
+                    continue
+                seen_usns.add(usn)
+
+                if addr in addrs:
+                    continue
                 addrs.append(addr)
 
+                yield addr
+
                 if device_limit and len(addrs) == device_limit:
-                    break
+                    return
+    finally:
+        for sock in socks:
+            sock.close()
 
-    sock.close()
 
-    return addrs
+def get_device_info(ip_addr, timeout=DESCRIPTION_TIMEOUT):
+    """ get the details of the device at an IP address from its device description 
+        - returns None if the device doesn't respond with one """
 
-
-def get_device_name(ip_addr):
-    """ get the device friendly name for an IP address """
+    import httplib
+    from xml.etree import ElementTree
 
     try:
-        conn = httplib.HTTPConnection(ip_addr + ":8008")
+        conn = httplib.HTTPConnection(ip_addr + ":8008", timeout=timeout)
         conn.request("GET", "/ssdp/device-desc.xml")
         resp = conn.getresponse()
 
-        if resp.status == 200:
-            status_doc = resp.read()
-            try:
-                xml = ElementTree.fromstring(status_doc)
+        if resp.status != 200:
+            return None
 
-                device_element = xml.find("{urn:schemas-upnp-org:device-1-0}" + "device")
+        status_doc = resp.read()
+        application_url = resp.getheader("Application-URL")
+        conn.close()
 
-                return device_element.find("{urn:schemas-upnp-org:device-1-0}" + "friendlyName").text
+        xml = ElementTree.fromstring(status_doc)
+        device_element = xml.find(UPNP_DEVICE_NS + "device")
 
-            except ElementTree.ParseError:
-                return ""
-        else:
-            return ""
     except:
-        # unable to get a name - this might be for many reasons 
+        # unable to get a description - this might be for many reasons 
         # e.g. a non chromecast device on the network that responded to the search
+        return None
+
+    if device_element is None:
+        return None
+
+    def text(element, tag):
+        return (element.findtext(UPNP_DEVICE_NS + tag) or "").strip()
+
+    udn = text(device_element, "UDN")
+    if udn.startswith("uuid:"):
+        udn = udn[5:]
+
+    # the capabilities are the services listed in the description, plus DIAL if it is advertised
+    capabilities = []
+    if application_url:
+        capabilities.append("dial")
+
+    for service in device_element.findall(UPNP_DEVICE_NS + "serviceList/" + UPNP_DEVICE_NS + "service"):
+        service_type = text(service, "serviceType")
+        if service_type:
+            capabilities.append(service_type)
+
+    return {'ip': ip_addr,
+            'name': text(device_element, "friendlyName"),
+            'model': text(device_element, "modelName"),
+            'manufacturer': text(device_element, "manufacturer"),
+            'device_type': text(device_element, "deviceType"),
+            'uuid': udn,
+            'capabilities': capabilities}
+
+
+def get_device_name(ip_addr, timeout=DESCRIPTION_TIMEOUT):
+    """ get the device friendly name for an IP address """
+
+    info = get_device_info(ip_addr, timeout=timeout)
+    if info is None:
         return ""
 
+    return info['name']
 
-def check_cache(name):
-    """ check the search results cache file """
 
-    result = None
+class DescriptionFetcher(object):
+    """ fetches device descriptions on at most max_workers threads as hosts are added, calling
+        callback(ip address, device info) as each one completes """
+
+    def __init__(self, callback, max_workers=DESCRIPTION_WORKERS, timeout=DESCRIPTION_TIMEOUT):
+        """ initialise """
+
+        self.callback = callback
+        self.max_workers = max_workers
+        self.timeout = timeout
+
+        self.tasks = Queue.Queue()
+        self.workers = []
+        self.closed = False
+
+    def add(self, host):
+        """ fetch the description of a host, starting another worker if the limit hasn't been reached """
+
+        if self.closed:
+            return
+
+        self.tasks.put(host)
+
+        if len(self.workers) < self.max_workers:
+            thread = threading.Thread(target=self.worker)
+            thread.daemon = True
+            thread.start()
+            self.workers.append(thread)
+
+    def worker(self):
+        while True:
+            host = self.tasks.get()
+            if host is None:
+                return
+
+            self.callback(host, get_device_info(host, timeout=self.timeout))
+
+    def close(self, cancel=False):
+        """ let the workers finish once the hosts added so far have been fetched - or straight away if cancelled
+            (the fetches in progress still complete) """
+
+        self.closed = True
+
+        if cancel:
+            try:
+                while True:
+                    self.tasks.get_nowait()
+            except Queue.Empty:
+                pass
+
+        for thread in self.workers:
+            self.tasks.put(None)
+
+    def join(self):
+        """ wait for the workers to finish """
+
+        for thread in self.workers:
+            thread.join()
+
+
+def iter_device_infos(hosts, max_workers=DESCRIPTION_WORKERS, timeout=DESCRIPTION_TIMEOUT):
+    """ fetch the descriptions of several devices, max_workers at a time, 
+        yielding (ip address, device info) as each one completes """
+
+    hosts = list(hosts)
+
+    results = Queue.Queue()
+    fetcher = DescriptionFetcher(lambda host, info: results.put((host, info)), max_workers, timeout)
+
+    for host in hosts:
+        fetcher.add(host)
+    fetcher.close()
+
+    for i in range(len(hosts)):
+        yield results.get()
+
+    fetcher.join()
+
+
+def get_device_infos(hosts, max_workers=DESCRIPTION_WORKERS, timeout=DESCRIPTION_TIMEOUT):
+    """ fetch the descriptions of several devices in parallel - returns a map of ip addresses to device info 
+        (None for hosts which don't provide a description) """
+
+    return dict(iter_device_infos(hosts, max_workers=max_workers, timeout=timeout))
+
+
+def iter_discover(methods=None, device_limit=None, time_limit=5, stop_event=None):
+    """ search the network with several discovery backends at once, 
+        yielding (ip address, device info) for each device as it responds
+        
+        The device info is None for devices found by SSDP, whose details need a separate request (get_device_info).
+        The search ends after time_limit seconds, once device_limit devices have responded,
+        or when stop_event (a threading.Event) is set.
+    """
+
+    if methods is None:
+        methods = DISCOVERY_METHODS
+
+    results = Queue.Queue()
+    backends_stop = threading.Event()
+
+    def ssdp():
+        for host in iter_search_network(time_limit=time_limit, stop_event=backends_stop):
+            results.put((host, None))
+
+    def mdns():
+        from . import cc_mdns
+
+        for info in cc_mdns.iter_search_mdns(time_limit=time_limit, stop_event=backends_stop):
+            results.put((info['ip'], info))
+
+    def run_backend(backend):
+        try:
+            backend()
+        finally:
+            results.put(None)
+
+    backends = {"ssdp": ssdp, "mdns": mdns}
+    for method in methods:
+        thread = threading.Thread(target=run_backend, args=(backends[method],))
+        thread.daemon = True
+        thread.start()
+
+    found = set()
+    running = len(methods)
+
+    try:
+        while running > 0:
+            if stop_event is not None and stop_event.is_set():
+                break
+
+            try:
+                result = results.get(True, STOP_CHECK_INTERVAL)
+            except Queue.Empty:
+                continue
+
+            if result is None:
+                running -= 1
+                continue
+
+            # a device may be found by more than one backend
+            if result[0] in found:
+                continue
+
+            found.add(result[0])
+            yield result
+
+            if device_limit and len(found) == device_limit:
+                break
+    finally:
+        backends_stop.set()
+
+
+def search_network_for_name(name, time_limit=6, methods=None):
+    """ discovery which looks up each device's name as soon as it responds, stopping as soon as the 
+        named device is found - returns a map of device names to device info """
+
+    results = Queue.Queue()
+    stop_event = threading.Event()
+
+    # the descriptions are fetched on a limited number of threads, however many devices respond
+    fetcher = DescriptionFetcher(lambda host, info: results.put(("info", info)))
+
+    def search():
+        try:
+            for host, info in iter_discover(methods=methods, time_limit=time_limit, stop_event=stop_event):
+                results.put(("found", None))
+
+                # devices found by mDNS already have their details
+                if info is not None:
+                    results.put(("info", info))
+                    continue
+
+                fetcher.add(host)
+        finally:
+            results.put(("done", None))
+
+    search_thread = threading.Thread(target=search)
+    search_thread.daemon = True
+    search_thread.start()
+
+    result_map = {}
+    pending = 0
+    searching = True
+
+    while searching or pending > 0:
+        event, info = results.get()
+
+        if event == "found":
+            pending += 1
+
+        elif event == "info":
+            pending -= 1
+            if info is not None and info['name'] != "":
+                result_map[info['name']] = info
+
+                if info['name'] == name:
+                    break
+
+        elif event == "done":
+            searching = False
+
+    stop_event.set()
+    fetcher.close(cancel=True)
+
+    return result_map
+
+
+def load_cache():
+    """ read the cached network search results - returns a map of device names to cache entries """
 
     filepath = os.path.expanduser(CACHE_FILE)
     try:
         with open(filepath, "r") as f:
-            for line in f.readlines():
-                if "\t" in line:
-                    line_split = line.strip().split("\t", 1)
-                    if len(line_split) > 1:
-                        hostname, host = line_split
-                        if name == hostname:
-                            # name is found - check that the host responds with the same name
-                            device_name = get_device_name(host)
-                            print "Device name response:", device_name
-                            if name == device_name and device_name != "":
-                                result = host
-                                break
+            contents = f.read()
     except IOError:
+        return {}
+
+    try:
+        return json.loads(contents)['devices']
+    except (ValueError, KeyError, TypeError):
         pass
 
-    return result
+    # older versions saved one device per line - hostname[tab]ip_addr
+    entries = {}
+    for line in contents.splitlines():
+        line_split = line.strip().split("\t", 1)
+        if len(line_split) > 1:
+            hostname, host = line_split
+            entries[hostname] = {'ip': host, 'last_seen': 0}
+
+    return entries
 
 
-def save_cache(host_map):
-    """ save the search results for quick access later """
+def save_cache(entries):
+    """ write the cache atomically, so that other processes never read a partly written file """
+
+    import tempfile
 
     filepath = os.path.expanduser(CACHE_FILE)
-    with open(filepath, "w") as f:
-        for key in host_map.keys():
-            if len(key) > 0 and len(host_map[key]) > 0:
-                # file format: hostname[tab]ip_addr
-                f.write(key + "\t" + host_map[key] + "\n")
 
+    fd, temp_path = tempfile.mkstemp(prefix=".cc_device_cache", dir=os.path.dirname(filepath))
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump({'version': 1, 'devices': entries}, f, indent=1, sort_keys=True)
+
+        os.rename(temp_path, filepath)
+    except:
+        os.remove(temp_path)
+        raise
+
+
+def update_cache(infos):
+    """ merge the details of devices which have just been seen into the cache """
+
+    now = time.time()
+
+    with _cache_lock:
+        entries = load_cache()
+
+        for info in infos:
+            if info is None or info.get('name', "") == "":
+                continue
+
+            entry = entries.setdefault(info['name'], {})
+            for field in CACHE_FIELDS:
+                if info.get(field) is not None:
+                    entry[field] = info[field]
+            entry['last_seen'] = now
+
+        save_cache(entries)
+
+
+def remove_from_cache(name):
+    """ forget a device which no longer answers to its cached address """
+
+    with _cache_lock:
+        entries = load_cache()
+        if entries.pop(name, None) is not None:
+            save_cache(entries)
+
+
+def check_cache(name):
+    """ look a device up in the cache - returns its details, with 'stale' set if it is older than CACHE_TTL, 
+        or None if it isn't cached """
+
+    entry = load_cache().get(name)
+    if entry is None or 'ip' not in entry:
+        return None
+
+    info = dict(entry)
+    info['name'] = name
+    info['cached'] = True
+    info['stale'] = time.time() - entry.get('last_seen', 0) > CACHE_TTL
+
+    return info
+
+
+def validate_cache_entry(info):
+    """ check that a cached device still answers with its name, refreshing or removing its entry """
+
+    current = get_device_info(info['ip'])
+
+    if current is not None and current['name'] == info['name']:
+        update_cache([dict(current, port=info.get('port'))])
+    else:
+        remove_from_cache(info['name'])
+
+
+def validate_cache_entry_async(info):
+    """ check a cached device in the background, so the check doesn't delay connecting to it """
+
+    thread = threading.Thread(target=validate_cache_entry, args=(info,))
+    thread.daemon = True
+    thread.start()
+
+    return thread
 
-def find_device(name=None, time_limit=6):
-    """ find the first device (quick) or search by name (slower)"""
+
+def find_device(name=None, time_limit=6, methods=None, use_cache=True):
+    """ find the first device (quick) or search by name (slower) - returns the ip address and name """
+
+    info = find_device_info(name=name, time_limit=time_limit, methods=methods, use_cache=use_cache)
+    if info is None:
+        return None, None
+
+    return info['ip'], info['name']
+
+
+def find_device_info(name=None, time_limit=6, methods=None, use_cache=True):
+    """ find the first device (quick) or search by name (slower) - returns the device info, or None 
+    
+        A device found in the cache is returned without being checked. If its entry is older than CACHE_TTL 
+        it is checked in the background, and the caller should search again with use_cache=False 
+        if it can't connect to the device.
+    """
+
+    # a running discovery service already knows the devices on the network
+    if discovery_service is not None and use_cache:
+        info = discovery_service.find(name)
+        if info is not None:
+            return info
 
     if name is None or name == "":
         # no name specified so find the first device that responds
         print "searching the network for a Chromecast device"
-        hosts = search_network(device_limit=1)
-        if len(hosts) > 0:
-            return hosts[0], get_device_name(hosts[0])
-        else:
-            return None, None
+        for host, info in iter_discover(methods=methods, device_limit=1):
+            if info is None:
+                info = get_device_info(host) or {'ip': host, 'name': ""}
+            return info
+
+        return None
     else:
         # name specified, check the cached network search results file
-        ip_addr = check_cache(name)
-        if ip_addr is not None:
+        info = None
+        if use_cache:
+            info = check_cache(name)
+
+        if info is not None:
             # address found in cache
             print "found device in cache:", name
-            return ip_addr, name
+
+            if info['stale']:
+                validate_cache_entry_async(info)
+
+            return info
         else:
             # no cached results found run a full network search
             print "searching the network for:", name
-            result_map = {}
 
-            hosts = search_network(time_limit=time_limit)
-            for host in hosts:
-                device_name = get_device_name(host)
-                if device_name != "":
-                    result_map[device_name] = host
+            result_map = search_network_for_name(name, time_limit=time_limit, methods=methods)
 
-            save_cache(result_map)
+            # the search may have stopped early, so this is merged with the cached devices it didn't get to
+            update_cache(result_map.values())
 
             if name in result_map.keys():
                 print "found device:", name
-                return result_map[name], name
+                return result_map[name]
             else:
-                return None, None
+                return None
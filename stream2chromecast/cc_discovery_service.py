@@ -0,0 +1,308 @@
+"""
+Keeps a live table of the Chromecast devices on the local network in the background.
+
+The service listens for SSDP NOTIFY and mDNS announcements, searches the network again at intervals and
+forgets devices which haven't been seen for a while. While it is running, cc_device_finder.find_device
+answers from its table instead of searching.
+
+version 0.1
+
+"""
+
+
+# Copyright (C) 2014-2016 Pat Carter
+#
+# This file is part of Stream2chromecast.
+#
+# Stream2chromecast is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Stream2chromecast is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Stream2chromecast.  If not, see <http://www.gnu.org/licenses/>.
+
+
+
+import select
+import socket
+import threading
+import time
+import urlparse
+from struct import pack
+
+from . import cc_device_finder
+from . import cc_mdns
+
+# seconds between searches of the network
+SEARCH_INTERVAL = 60
+
+# seconds each search listens for responses
+SEARCH_TIME = 5
+
+# seconds after which a device which hasn't been seen is forgotten
+MAX_AGE = 3 * SEARCH_INTERVAL
+
+_service = None
+
+
+def open_multicast_listener(group, port):
+    """ open a socket receiving the datagrams sent to a multicast group, shared with any other listeners """
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if hasattr(socket, "SO_REUSEPORT"):
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
+    sock.bind(("", port))
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, socket.inet_aton(group) + pack("=I", socket.INADDR_ANY))
+    sock.setblocking(0)
+
+    return sock
+
+
+def extract_notify(data):
+    """ extracts the headers of an SSDP NOTIFY message - returns None for any other message """
+
+    start_line, headers = cc_device_finder.extract_ssdp_headers(data)
+    if not start_line.upper().startswith("NOTIFY"):
+        return None
+
+    return headers
+
+
+class DiscoveryService(object):
+    """ maintains a table of the devices on the network, keyed by ip address """
+
+    def __init__(self, methods=None, search_interval=SEARCH_INTERVAL, max_age=MAX_AGE):
+        """ initialise """
+
+        if methods is None:
+            methods = cc_device_finder.DISCOVERY_METHODS
+
+        self.methods = methods
+        self.search_interval = search_interval
+        self.max_age = max_age
+
+        self.devices = {}
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.searched = threading.Event()
+        self.threads = []
+
+    def start(self):
+        """ start searching and listening, and let find_device use the device table """
+
+        for target in (self.search_loop, self.listen_loop):
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+        cc_device_finder.discovery_service = self
+
+    def stop(self):
+        """ stop the background threads """
+
+        if cc_device_finder.discovery_service is self:
+            cc_device_finder.discovery_service = None
+
+        self.stop_event.set()
+
+        for thread in self.threads:
+            thread.join()
+
+        self.threads = []
+
+    def add_device(self, info):
+        """ record a device which has just been seen """
+
+        if info is None or info.get('name', "") == "":
+            return
+
+        info = dict(info, last_seen=time.time())
+
+        with self.lock:
+            known = self.devices.get(info['ip'])
+            if known is not None and 'port' in known and 'port' not in info:
+                info['port'] = known['port']
+
+            self.devices[info['ip']] = info
+
+    def refresh_device(self, ip_addr):
+        """ update the last seen time of a known device, or fetch the details of a new one """
+
+        with self.lock:
+            if ip_addr in self.devices:
+                self.devices[ip_addr]['last_seen'] = time.time()
+                return
+
+        thread = threading.Thread(target=lambda: self.add_device(cc_device_finder.get_device_info(ip_addr)))
+        thread.daemon = True
+        thread.start()
+
+    def remove_device(self, ip_addr):
+        """ forget a device which has announced that it is leaving """
+
+        with self.lock:
+            self.devices.pop(ip_addr, None)
+
+    def expire_devices(self):
+        """ forget the devices which haven't been seen within max_age seconds """
+
+        oldest = time.time() - self.max_age
+
+        with self.lock:
+            for ip_addr, info in self.devices.items():
+                if info['last_seen'] < oldest:
+                    del self.devices[ip_addr]
+
+    def search(self):
+        """ search the network, adding every device which responds """
+
+        found = []
+        for ip_addr, info in cc_device_finder.iter_discover(methods=self.methods, time_limit=SEARCH_TIME,
+                                                            stop_event=self.stop_event):
+            if info is not None:
+                self.add_device(info)
+            else:
+                found.append(ip_addr)
+
+        with self.lock:
+            new = [ip_addr for ip_addr in found if ip_addr not in self.devices]
+            for ip_addr in found:
+                if ip_addr in self.devices:
+                    self.devices[ip_addr]['last_seen'] = time.time()
+
+        for ip_addr, info in cc_device_finder.iter_device_infos(new):
+            self.add_device(info)
+
+    def search_loop(self):
+        """ search the network every search_interval seconds """
+
+        while not self.stop_event.is_set():
+            try:
+                self.search()
+            except socket.error:
+                pass
+
+            self.expire_devices()
+            self.searched.set()
+
+            self.stop_event.wait(self.search_interval)
+
+    def listen_loop(self):
+        """ handle the SSDP and mDNS announcements made by devices """
+
+        socks = {}
+        groups = (("ssdp", cc_device_finder.SSDP_ADDR, cc_device_finder.SSDP_PORT),
+                  ("mdns", cc_mdns.MDNS_ADDR, cc_mdns.MDNS_PORT))
+
+        for name, group, port in groups:
+            if name not in self.methods:
+                continue
+            try:
+                socks[open_multicast_listener(group, port)] = name
+            except socket.error:
+                # announcements are only an optimisation - the periodic searches still find the devices
+                pass
+
+        try:
+            while not self.stop_event.is_set() and len(socks) > 0:
+                readable = select.select(socks.keys(), [], [], cc_device_finder.STOP_CHECK_INTERVAL * 10)[0]
+
+                for sock in readable:
+                    try:
+                        data, addr = sock.recvfrom(9000)
+                    except socket.error:
+                        continue
+
+                    # one bad packet from any host on the network mustn't stop the listening
+                    try:
+                        if socks[sock] == "ssdp":
+                            self.handle_notify(data)
+                        else:
+                            self.handle_mdns(data, addr[0])
+                    except Exception as e:
+                        print "ignoring a bad %s packet from %s: %s: %s" % (socks[sock], addr[0],
+                                                                            e.__class__.__name__, e)
+        finally:
+            for sock in socks:
+                sock.close()
+
+    def handle_notify(self, data):
+        """ handle an SSDP NOTIFY message """
+
+        headers = extract_notify(data)
+        if headers is None or headers.get("NT") != cc_device_finder.DIAL_SERVICE:
+            return
+
+        ip_addr = urlparse.urlparse(headers.get("LOCATION", "")).hostname
+        if ip_addr is None:
+            return
+
+        if headers.get("NTS") == "ssdp:byebye":
+            self.remove_device(ip_addr)
+        else:
+            self.refresh_device(ip_addr)
+
+    def handle_mdns(self, data, sender_ip):
+        """ handle an mDNS announcement or response """
+
+        for info in cc_mdns.ServiceCollector().add_response(data, sender_ip):
+            self.add_device(info)
+
+    def get_devices(self):
+        """ the details of every device currently on the network """
+
+        with self.lock:
+            return [dict(info) for info in self.devices.values()]
+
+    def find(self, name=None, wait=SEARCH_TIME):
+        """ the details of the named device (or any device if no name is given), or None if it isn't known
+            - waits up to wait seconds for the first search to complete if the device isn't in the table yet """
+
+        for attempt in range(2):
+            for info in self.get_devices():
+                if name is None or name == "" or info['name'] == name:
+                    return info
+
+            if self.searched.is_set():
+                break
+
+            self.searched.wait(wait)
+
+        return None
+
+
+def start_service(methods=None, search_interval=SEARCH_INTERVAL, max_age=MAX_AGE):
+    """ start the discovery service for this process if it isn't already running, and return it """
+
+    global _service
+
+    if _service is None:
+        _service = DiscoveryService(methods=methods, search_interval=search_interval, max_age=max_age)
+        _service.start()
+
+    return _service
+
+
+def get_service():
+    """ the running discovery service, or None """
+
+    return _service
+
+
+def stop_service():
+    """ stop the discovery service if it is running """
+
+    global _service
+
+    if _service is not None:
+        _service.stop()
+        _service = None
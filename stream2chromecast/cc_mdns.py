@@ -0,0 +1,321 @@
+"""
+Locates Chromecast devices on the local network using multicast DNS (the _googlecast._tcp service).
+
+Each response carries the device's friendly name, model and id in its TXT record and the Cast port in its
+SRV record, so no further request is needed to identify a device.
+
+version 0.1
+
+See RFC 6762 (Multicast DNS) and RFC 1035 (Domain Names) for the message format.
+
+"""
+
+
+# Copyright (C) 2014-2016 Pat Carter
+#
+# This file is part of Stream2chromecast.
+#
+# Stream2chromecast is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Stream2chromecast is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Stream2chromecast.  If not, see <http://www.gnu.org/licenses/>.
+
+
+
+import select
+import socket
+import time
+from struct import pack, unpack
+
+MDNS_ADDR = "224.0.0.251"
+MDNS_PORT = 5353
+
+SERVICE_NAME = "_googlecast._tcp.local"
+
+TYPE_A = 1
+TYPE_PTR = 12
+TYPE_TXT = 16
+TYPE_SRV = 33
+CLASS_IN = 1
+
+# seconds after which the query is sent again, in case it or the responses were lost
+RESEND_INTERVAL = 1
+
+# longest time a search waits before checking whether it has been asked to stop
+STOP_CHECK_INTERVAL = 0.1
+
+
+class MDNSError(Exception):
+    pass
+
+
+# Sent messages
+
+def format_name(name):
+    """ formats a domain name as a sequence of length-prefixed labels """
+
+    result = ""
+    for label in name.split("."):
+        result += pack("B", len(label)) + label
+
+    return result + "\0"
+
+
+def format_query(name, record_type):
+    """ formats a query for a single question """
+
+    header = pack(">HHHHHH", 0, 0, 1, 0, 0, 0)  # id, flags, questions, answers, authority, additional
+
+    return header + format_name(name) + pack(">HH", record_type, CLASS_IN)
+
+
+# Received messages
+
+def extract_name(data, ptr):
+    """ extracts a possibly compressed domain name - returns the name and the position after it """
+
+    labels = []
+    end_ptr = None
+    jumps = 0
+
+    while True:
+        if ptr >= len(data):
+            raise MDNSError("name runs past the end of the message")
+
+        length = ord(data[ptr])
+
+        if length & 0xC0 == 0xC0:
+            # compression pointer to a name earlier in the message
+            if ptr + 2 > len(data):
+                raise MDNSError("name pointer runs past the end of the message")
+
+            if end_ptr is None:
+                end_ptr = ptr + 2
+
+            jumps += 1
+            if jumps > 32:
+                raise MDNSError("name compression loop")
+
+            ptr = unpack(">H", data[ptr:ptr + 2])[0] & 0x3FFF
+
+        elif length == 0:
+            ptr += 1
+            break
+
+        else:
+            if ptr + 1 + length > len(data):
+                raise MDNSError("label runs past the end of the message")
+
+            labels.append(data[ptr + 1:ptr + 1 + length])
+            ptr += 1 + length
+
+    if end_ptr is None:
+        end_ptr = ptr
+
+    return ".".join(labels), end_ptr
+
+
+def extract_txt(rdata):
+    """ extracts the key=value strings of a TXT record """
+
+    values = {}
+
+    ptr = 0
+    while ptr < len(rdata):
+        length = ord(rdata[ptr])
+        entry = rdata[ptr + 1:ptr + 1 + length]
+        ptr += 1 + length
+
+        if "=" in entry:
+            key, value = entry.split("=", 1)
+            values[key.lower()] = value
+
+    return values
+
+
+def extract_records(data):
+    """ extracts the resource records from a response - returns a list of (name, type, record data)
+        where the record data has been decoded for A, PTR, TXT and SRV records """
+
+    if len(data) < 12:
+        raise MDNSError("message too short")
+
+    questions, answers, authority, additional = unpack(">HHHH", data[4:12])
+
+    ptr = 12
+    for i in range(questions):
+        name, ptr = extract_name(data, ptr)
+        ptr += 4
+
+    records = []
+
+    for i in range(answers + authority + additional):
+        name, ptr = extract_name(data, ptr)
+
+        if ptr + 10 > len(data):
+            raise MDNSError("record runs past the end of the message")
+
+        record_type, record_class, ttl, length = unpack(">HHIH", data[ptr:ptr + 10])
+        ptr += 10
+
+        if ptr + length > len(data):
+            raise MDNSError("record data runs past the end of the message")
+
+        rdata = data[ptr:ptr + length]
+        value = rdata
+
+        if record_type == TYPE_A and length == 4:
+            value = socket.inet_ntoa(rdata)
+
+        elif record_type == TYPE_PTR:
+            value = extract_name(data, ptr)[0]
+
+        elif record_type == TYPE_TXT:
+            value = extract_txt(rdata)
+
+        elif record_type == TYPE_SRV:
+            if length < 7:
+                raise MDNSError("SRV record too short")
+
+            priority, weight, port = unpack(">HHH", rdata[:6])
+            value = (port, extract_name(data, ptr + 6)[0])
+
+        records.append((name.lower(), record_type, value))
+        ptr += length
+
+    return records
+
+
+class ServiceCollector(object):
+    """ assembles device details from records which may arrive spread over several responses """
+
+    def __init__(self):
+        """ initialise """
+
+        self.instances = {}  # service instance name -> partial device info
+        self.addresses = {}  # host name -> ip address
+        self.reported = set()
+
+    def add_response(self, data, sender_ip):
+        """ add the records of a response - returns the devices which have become complete """
+
+        try:
+            records = extract_records(data)
+        except MDNSError:
+            return []
+
+        touched = set()
+
+        for name, record_type, value in records:
+            if record_type == TYPE_A:
+                self.addresses[name] = value
+
+            elif record_type == TYPE_PTR and name == SERVICE_NAME.lower():
+                self.instances.setdefault(value.lower(), {'sender': sender_ip})
+                touched.add(value.lower())
+
+            elif record_type == TYPE_TXT and name.endswith(SERVICE_NAME.lower()):
+                self.instances.setdefault(name, {'sender': sender_ip})['txt'] = value
+                touched.add(name)
+
+            elif record_type == TYPE_SRV and name.endswith(SERVICE_NAME.lower()):
+                self.instances.setdefault(name, {'sender': sender_ip})['srv'] = value
+                touched.add(name)
+
+        complete = []
+
+        for instance in touched:
+            info = self.device_info(instance)
+            if info is not None and instance not in self.reported:
+                self.reported.add(instance)
+                complete.append(info)
+
+        return complete
+
+    def device_info(self, instance):
+        """ the details of a service instance, or None if its TXT record hasn't been received """
+
+        partial = self.instances[instance]
+        if 'txt' not in partial:
+            return None
+
+        txt = partial['txt']
+
+        port = 8009
+        ip_addr = partial['sender']
+        if 'srv' in partial:
+            port, target = partial['srv']
+            ip_addr = self.addresses.get(target.lower(), ip_addr)
+
+        return {'ip': ip_addr,
+                'port': port,
+                'name': txt.get('fn', ""),
+                'model': txt.get('md', ""),
+                'uuid': txt.get('id', ""),
+                'capabilities': ["cast"]}
+
+
+def iter_search_mdns(device_limit=None, time_limit=5, stop_event=None):
+    """ mDNS discovery - yields the details of each device as it responds
+
+        The search ends after time_limit seconds, once device_limit devices have responded,
+        or when stop_event (a threading.Event) is set.
+    """
+
+    deadline = time.time() + time_limit
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 255)
+    sock.setblocking(0)
+
+    # sent from an ephemeral port, this is a "legacy unicast" query which devices answer directly
+    query = format_query(SERVICE_NAME, TYPE_PTR)
+
+    collector = ServiceCollector()
+    found = 0
+    next_send = 0
+
+    try:
+        while True:
+            now = time.time()
+            if now >= deadline or (stop_event is not None and stop_event.is_set()):
+                break
+
+            if now >= next_send:
+                try:
+                    sock.sendto(query, (MDNS_ADDR, MDNS_PORT))
+                except socket.error:
+                    pass
+                next_send = now + RESEND_INTERVAL
+
+            timeout = min(deadline, next_send) - now
+            if stop_event is not None:
+                timeout = min(timeout, STOP_CHECK_INTERVAL)
+
+            readable = select.select([sock], [], [], max(timeout, 0))[0]
+
+            if sock in readable:
+                data, addr = sock.recvfrom(9000)
+
+                for info in collector.add_response(data, addr[0]):
+                    yield info
+
+                    found += 1
+                    if device_limit and found == device_limit:
+                        return
+    finally:
+        sock.close()
+
+
+def search_mdns(device_limit=None, time_limit=5):
+    """ mDNS discovery - returns the details of the devices which respond """
+
+    return list(iter_search_mdns(device_limit=device_limit, time_limit=time_limit))
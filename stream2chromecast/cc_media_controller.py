@@ -27,24 +27,133 @@ version 0.2.1
 
 import json
 import re
+import select
 import socket
 import ssl
 import sys
+import threading
 import time
 
 import cc_device_finder
 import cc_message
+import timing
 
 MEDIAPLAYER_APPID = "CC1AD845"
 
+# seconds allowed for the connection to the device to be made
+CONNECT_TIMEOUT = 5
 
-class CCMediaController:
-    def __init__(self, device_name=None):
+# seconds without any message from the device before a heartbeat PING is sent while watching for events
+HEARTBEAT_INTERVAL = 10
+
+# number of unanswered heartbeats after which the connection is considered dead
+HEARTBEAT_LIMIT = 2
+
+# media player messages reporting a failed request
+MEDIA_ERRORS = ("LOAD_FAILED", "LOAD_CANCELLED", "INVALID_PLAYER_STATE", "INVALID_REQUEST")
+
+# the running cc_tracer.Tracer, set by cc_tracer.start() and stop() - the tracer module is only imported when
+# a trace is asked for
+tracer = None
+
+
+def reconnecting(method):
+    """ retry an operation once on a new connection if a kept-alive connection has been dropped by the device """
+
+    def wrapper(self, *args, **kwargs):
+        if self.persistent and self.sock is not None:
+            try:
+                return method(self, *args, **kwargs)
+            except socket.error:
+                self.close_socket(force=True)
+
+        return method(self, *args, **kwargs)
+
+    wrapper.__name__ = method.__name__
+    wrapper.__doc__ = method.__doc__
+    return wrapper
+
+
+class StatusStore(object):
+    """ holds the most recent status of each kind reported by a device, with the time it was received """
+
+    def __init__(self):
         """ initialise """
 
+        self.values = {}
+        self.timestamps = {}
+        self.subscribers = []
+        self.lock = threading.Lock()
+
+    def update(self, kind, value):
+        """ record a status value, notifying the subscribers if it has changed """
+
+        with self.lock:
+            changed = kind not in self.values or self.values[kind] != value
+            previous = self.values.get(kind)
+
+            self.values[kind] = value
+            self.timestamps[kind] = time.time()
+
+            subscribers = list(self.subscribers)
+
+        if changed:
+            for callback in subscribers:
+                callback(kind, value, previous)
+
+    def get(self, kind, default=None):
+        """ the last value recorded for a kind of status """
+
+        return self.values.get(kind, default)
+
+    def age(self, kind):
+        """ seconds since a kind of status was last recorded - None if it never has been """
+
+        timestamp = self.timestamps.get(kind)
+        if timestamp is None:
+            return None
+
+        return time.time() - timestamp
+
+    def is_fresh(self, kind, max_age):
+        """ whether a kind of status was recorded less than max_age seconds ago """
+
+        age = self.age(kind)
+        return age is not None and age < max_age
+
+    def subscribe(self, callback):
+        """ call callback(kind, value, previous_value) whenever a status changes """
+
+        with self.lock:
+            self.subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        """ stop notifying a subscriber """
+
+        with self.lock:
+            self.subscribers.remove(callback)
+
+
+class CCMediaController:
+    def __init__(self, device_name=None, persistent=False, status_max_age=0):
+        """ initialise 
+        
+            persistent - keep the connection to the device open between operations
+            status_max_age - seconds for which status reported by the device is reused by get_status and get_volume
+        """
+
+        self.port = 8009
+        self.device_name = device_name
+        self.device_cached = False
         self.host = self.get_device(device_name)
 
+        self.persistent = persistent
         self.sock = None
+        self.connected_destinations = set()
+        self.client_address = None
+
+        self.status_max_age = status_max_age
+        self.status_store = StatusStore()
 
         self.request_id = 1
         self.source_id = "sender-0"
@@ -56,7 +165,8 @@ class CCMediaController:
         
     
     
-    def get_device(self, device_name):
+    @timing.timed("discovery")
+    def get_device(self, device_name, use_cache=True):
         """ get the device ip address """
 
         is_ip_addr = device_name is not None and re.match("[0-9]+.[0-9]+.[0-9]+.[0-9]+$", device_name) is not None
@@ -68,11 +178,15 @@ class CCMediaController:
             except socket.error:
                 sys.exit("No Chromecast found on ip:" + host)
         else:
-            host, name = cc_device_finder.find_device(name=device_name)
-            if host is None:
+            info = cc_device_finder.find_device_info(name=device_name, use_cache=use_cache)
+            if info is None:
                 sys.exit("No Chromecast found on the network")
 
-            print "device name:", name
+            host = info['ip']
+            self.port = info.get('port') or self.port
+            self.device_cached = info.get('cached', False)
+
+            print "device name:", info['name']
 
         return host
 
@@ -80,27 +194,58 @@ class CCMediaController:
         """ open a socket if there is not currently one open """
 
         if self.sock is None:
-            self.sock = socket.socket()
-            self.sock = ssl.wrap_socket(self.sock)
+            try:
+                sock = self.connect_socket()
+            except socket.error:
+                if not self.device_cached:
+                    raise
+
+                # the device's cached address is out of date
+                print "device not found at its cached address - searching the network"
+                cc_device_finder.remove_from_cache(self.device_name)
+                self.host = self.get_device(self.device_name, use_cache=False)
 
-            self.sock.connect((self.host, 8009))
+                sock = self.connect_socket()
 
-    def close_socket(self):
-        """ close the socket if there is one open """
+            self.sock = sock
+            self.client_address = sock.getsockname()
+
+    @timing.timed("tls_connect")
+    def connect_socket(self):
+        """ make a TLS connection to the device """
+
+        sock = ssl.wrap_socket(socket.socket())
+        sock.settimeout(CONNECT_TIMEOUT)
+        sock.connect((self.host, self.port))
+        sock.settimeout(None)
+
+        return sock
+
+    def close_socket(self, force=False):
+        """ close the socket if there is one open - a persistent connection is only closed if forced """
+
+        if self.persistent and not force:
+            return
 
         if self.sock is not None:
             self.sock.close()
 
         self.sock = None
+        self.connected_destinations = set()
 
-    def send_data(self, namespace, data_dict):
+    def send_data(self, namespace, data_dict, destination_id=None):
         """ send data to the device in binary format"""
 
+        if destination_id is None:
+            destination_id = self.destination_id
+
         data = json.dumps(data_dict)
 
-        # print "Sending: ", namespace, data
+        msg = cc_message.format_message(self.source_id, destination_id, namespace, data)
 
-        msg = cc_message.format_message(self.source_id, self.destination_id, namespace, data)
+        if tracer is not None:
+            tracer.record_sent(self.host, self.client_address[1], self.source_id, destination_id,
+                               namespace, data, len(msg))
 
         self.sock.write(msg)
 
@@ -109,14 +254,17 @@ class CCMediaController:
 
         data = ""
         while len(data) < 4:
-            data += self.sock.recv(4)
+            data += self.recv(4 - len(data))
 
         msg_length, data = cc_message.extract_length_header(data)
         while len(data) < msg_length:
-            data += self.sock.recv(2048)
+            data += self.recv(min(2048, msg_length - len(data)))
 
         message_dict = cc_message.extract_message(data)
 
+        if tracer is not None:
+            tracer.record_received(self.host, self.client_address[1], message_dict, msg_length + 4)
+
         message = {}
 
         try:
@@ -124,11 +272,53 @@ class CCMediaController:
         except:
             pass
 
-        # print message_dict['namespace']
-        # print json.dumps(message, indent=4, separators=(',', ': '))
-
         return message
 
+    def recv(self, length):
+        """ read up to length bytes from the socket, raising an error if the device has closed the connection """
+
+        data = self.sock.recv(length)
+        if len(data) == 0:
+            raise socket.error("connection closed by the device")
+
+        return data
+
+    def message_ready(self, timeout):
+        """ wait up to timeout seconds for a message to arrive - returns False if there is none """
+
+        if self.sock.pending() > 0:
+            return True
+
+        return len(select.select([self.sock], [], [], timeout)[0]) > 0
+
+    def read_pending(self):
+        """ handle the messages already waiting on the connection without blocking - heartbeats are answered and
+            pushed status is recorded - the connection is closed if the device has dropped it """
+
+        try:
+            while self.sock is not None and self.message_ready(0):
+                self.handle_message(self.read_message())
+        except socket.error:
+            self.close_socket(force=True)
+
+    def handle_message(self, msg):
+        """ answer heartbeats and record any status update in a message - returns the message type """
+
+        msg_type = msg.get("type", msg.get("responseType", ""))
+
+        if msg_type == "PING":
+            data = {"type": "PONG"}
+            namespace = "urn:x-cast:com.google.cast.tp.heartbeat"
+            self.send_data(namespace, data)
+
+        elif msg_type == "RECEIVER_STATUS":
+            self.update_receiver_status_data(msg)
+
+        elif msg_type == "MEDIA_STATUS":
+            self.update_media_status_data(msg)
+
+        return msg_type
+
     def get_response(self, request_id):
         """ get the response matching the original request id """
 
@@ -138,25 +328,13 @@ class CCMediaController:
         while len(resp) == 0:
             msg = self.read_message()
 
-            msg_type = msg.get("type", msg.get("responseType", ""))
-
-            if msg_type == "PING":
-                data = {"type": "PONG"}
-                namespace = "urn:x-cast:com.google.cast.tp.heartbeat"
-                self.send_data(namespace, data)
-
+            if self.handle_message(msg) == "PING":
                 # if 30 ping/pong messages are received without a response to the request_id, 
                 # assume no response is coming
                 count += 1
                 if count == 30:
                     return resp
 
-            elif msg_type == "RECEIVER_STATUS":
-                self.update_receiver_status_data(msg)
-
-            elif msg_type == "MEDIA_STATUS":
-                self.update_media_status_data(msg)
-
             if "requestId" in msg.keys() and msg['requestId'] == request_id:
                 resp = msg
 
@@ -165,12 +343,13 @@ class CCMediaController:
     def send_msg_with_response(self, namespace, data):
         """ send a request to the device and wait for a response matching the request id """
 
-        self.request_id += 1
-        data['requestId'] = self.request_id
+        with timing.span("request:" + data.get("type", "")):
+            self.request_id += 1
+            data['requestId'] = self.request_id
 
-        self.send_data(namespace, data)
+            self.send_data(namespace, data)
 
-        return self.get_response(self.request_id)
+            return self.get_response(self.request_id)
 
     def update_receiver_status_data(self, msg):
         """ update the status for the Media Player app if it is running """
@@ -188,6 +367,10 @@ class CCMediaController:
             if 'volume' in status:
                 self.volume_status = status['volume']
 
+        self.status_store.update("receiver", self.receiver_app_status)
+        self.status_store.update("applications", self.current_applications)
+        self.status_store.update("volume", self.volume_status)
+
     def update_media_status_data(self, msg):
         """ update the media status if there is any media loaded """
 
@@ -197,6 +380,8 @@ class CCMediaController:
         if len(status) > 0:
             self.media_status = status[0]  # status is an array - selecting the first result..?
 
+        self.status_store.update("media", self.media_status)
+
     def connect(self, destination_id):
         """ connect to to the receiver or the media transport """
 
@@ -205,10 +390,17 @@ class CCMediaController:
 
         self.destination_id = destination_id
 
+        # a kept-alive connection only needs to connect to each destination once
+        if destination_id in self.connected_destinations:
+            return
+
         data = {"type": "CONNECT", "origin": {}}
         namespace = "urn:x-cast:com.google.cast.tp.connection"
         self.send_data(namespace, data)
 
+        if self.persistent:
+            self.connected_destinations.add(destination_id)
+
     def get_receiver_status(self):
         """ send a status request to the receiver """
 
@@ -223,6 +415,8 @@ class CCMediaController:
         namespace = "urn:x-cast:com.google.cast.media"
         self.send_msg_with_response(namespace, data)
 
+    @timing.timed("controller.load")
+    @reconnecting
     def load(self, content_url, content_type, sub, sub_language):
         """ Launch the player app, load & play a URL """
 
@@ -286,19 +480,27 @@ class CCMediaController:
         resp = self.send_msg_with_response(namespace, data)
 
 
-        # wait for the player to return "BUFFERING", "PLAYING" or "IDLE"
+        # wait for the player to report "BUFFERING", "PLAYING" or "IDLE" - the device pushes each change of state
         if resp.get("type", "") == "MEDIA_STATUS":
             player_state = ""
-            while player_state != "PLAYING" and player_state != "IDLE" and player_state != "BUFFERING":
-                time.sleep(2)
+            if self.media_status is not None:
+                player_state = self.media_status.get("playerState", "")
 
-                self.get_media_status()
+            with timing.span("wait_for_player"):
+                while player_state != "PLAYING" and player_state != "IDLE" and player_state != "BUFFERING":
+                    if self.message_ready(HEARTBEAT_INTERVAL):
+                        self.handle_message(self.read_message())
+                    else:
+                        # nothing has been pushed for a while, so ask
+                        self.get_media_status()
 
-                if self.media_status is not None:
-                    player_state = self.media_status.get("playerState", "")
+                    if self.media_status is not None:
+                        player_state = self.media_status.get("playerState", "")
 
         self.close_socket()
 
+    @timing.timed("controller.control")
+    @reconnecting
     def control(self, command, parameters={}):
         """ send a control command to the player """
 
@@ -329,33 +531,62 @@ class CCMediaController:
 
         self.close_socket()
 
-    def get_status(self):
-        """ get the receiver and media status """
+    def status_is_fresh(self, max_age):
+        """ whether the stored receiver status (and media status, if the player is running) is recent enough """
 
-        self.connect("receiver-0")
+        if self.client_address is None or not self.status_store.is_fresh("receiver", max_age):
+            return False
 
-        self.get_receiver_status()
+        return self.receiver_app_status is None or self.status_store.is_fresh("media", max_age)
+
+    def subscribe(self, callback):
+        """ call callback(kind, value, previous_value) when the "receiver", "media", "volume" or "applications" 
+            status reported by the device changes """
+
+        self.status_store.subscribe(callback)
+
+    def unsubscribe(self, callback):
+        """ stop notifying a subscriber """
+
+        self.status_store.unsubscribe(callback)
+
+    @timing.timed("controller.get_status")
+    @reconnecting
+    def get_status(self, max_age=None):
+        """ get the receiver and media status - the stored status is used if it is less than max_age seconds old
+            (status_max_age by default) """
+
+        if max_age is None:
+            max_age = self.status_max_age
+
+        # status the device has pushed since the last call may be waiting unread on a kept-alive connection
+        self.read_pending()
+
+        if not self.status_is_fresh(max_age):
+            self.connect("receiver-0")
+
+            self.get_receiver_status()
+
+            if self.receiver_app_status is not None:
+                transport_id = str(self.receiver_app_status['transportId'])
+                self.connect(transport_id)
+                self.get_media_status()
+
+            self.close_socket()
 
-        if self.receiver_app_status is not None:
-            transport_id = str(self.receiver_app_status['transportId'])
-            self.connect(transport_id)
-            self.get_media_status()
-        
         application_list = []
         if self.current_applications is not None:
             for application in self.current_applications:
                 application_list.append({
-                    'appId':application.get('appId', ""), 
-                    'displayName':application.get('displayName', ""),  
+                    'appId':application.get('appId', ""),
+                    'displayName':application.get('displayName', ""),
                     'statusText':application.get('statusText', "")})
-        
-        status = {'receiver_status':self.receiver_app_status, 
-                  'media_status':self.media_status, 
-                  'host':self.host, 
-                  'client':self.sock.getsockname(),
+
+        status = {'receiver_status':self.receiver_app_status,
+                  'media_status':self.media_status,
+                  'host':self.host,
+                  'client':self.client_address,
                   'applications':application_list}
-                
-        self.close_socket()
 
         return status
 
@@ -373,6 +604,155 @@ class CCMediaController:
         else:
             return status['media_status'].get("playerState", "") == u"IDLE"
 
+    def current_player_state(self):
+        """ the player state according to the most recent status messages """
+
+        if self.receiver_app_status is None or self.media_status is None:
+            return "IDLE"
+
+        return self.media_status.get("playerState", "IDLE")
+
+    def read_events(self, timeout=None):
+        """ generator yielding the player events pushed by the device over the current connection - it ends once
+            timeout seconds have passed, if a timeout is given """
+
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+
+        self.connect("receiver-0")
+        self.get_receiver_status()
+
+        transport_id = None
+        if self.receiver_app_status is not None:
+            transport_id = str(self.receiver_app_status['transportId'])
+            self.connect(transport_id)
+            self.get_media_status()
+
+        state = self.current_player_state()
+        yield {'type': "STATE", 'state': state, 'previous': None, 'media_status': self.media_status}
+
+        missed_heartbeats = 0
+        while True:
+            wait = HEARTBEAT_INTERVAL
+            if deadline is not None:
+                wait = min(wait, deadline - time.time())
+                if wait <= 0:
+                    return
+
+            if not self.message_ready(wait):
+                if wait < HEARTBEAT_INTERVAL:
+                    # the timeout has passed, rather than a heartbeat interval
+                    return
+
+                missed_heartbeats += 1
+                if missed_heartbeats > HEARTBEAT_LIMIT:
+                    raise socket.error("no response from the device")
+
+                self.send_data("urn:x-cast:com.google.cast.tp.heartbeat", {"type": "PING"}, "receiver-0")
+                continue
+
+            missed_heartbeats = 0
+
+            msg = self.read_message()
+            msg_type = self.handle_message(msg)
+
+            if msg_type == "CLOSE":
+                yield {'type': "CLOSED"}
+                return
+
+            if msg_type in MEDIA_ERRORS:
+                yield {'type': "ERROR", 'error': msg_type, 'message': msg}
+
+            # follow the media player if it has been (re)launched since watching started
+            if self.receiver_app_status is not None and str(self.receiver_app_status['transportId']) != transport_id:
+                transport_id = str(self.receiver_app_status['transportId'])
+                self.connect(transport_id)
+                self.get_media_status()
+
+            previous, state = state, self.current_player_state()
+            if state != previous:
+                yield {'type': "STATE", 'state': state, 'previous': previous, 'media_status': self.media_status}
+
+    def events(self, reconnect_limit=3, timeout=None):
+        """ generator yielding player events from the status pushed by the device, holding one connection open
+            (for up to timeout seconds, if a timeout is given)
+
+            Each event is a dict with a 'type' of:
+                STATE  - the player state has changed to 'state' (the first event gives the initial state)
+                ERROR  - the media player reported an 'error' such as LOAD_FAILED
+                CLOSED - the device closed the connection
+
+            Dropped connections are reopened up to reconnect_limit times in a row.
+        """
+
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+
+        failures = 0
+        try:
+            while True:
+                remaining = None
+                if deadline is not None:
+                    remaining = max(deadline - time.time(), 0)
+
+                try:
+                    for event in self.read_events(remaining):
+                        failures = 0
+                        yield event
+                    return
+                except socket.error:
+                    self.close_socket(force=True)
+
+                    failures += 1
+                    if failures > reconnect_limit:
+                        raise
+
+                    time.sleep(1)
+        finally:
+            self.close_socket()
+
+    def watch(self, callback, timeout=None):
+        """ call callback with each player event until it returns True, returning the last event - None is
+            returned if timeout seconds pass first """
+
+        events = self.events(timeout=timeout)
+        try:
+            for event in events:
+                if callback(event):
+                    return event
+        finally:
+            events.close()
+
+    def wait_until_idle(self):
+        """ block until the player becomes idle or the device closes the connection, returning the final event """
+
+        return self.watch(lambda event: event['type'] == "CLOSED" or event.get('state') == "IDLE")
+
+    @reconnecting
+    def get_player_state(self):
+        """ return the media player state e.g. "PLAYING", "PAUSED", "BUFFERING" or "IDLE" """
+
+        self.connect("receiver-0")
+
+        self.get_receiver_status()
+
+        if self.receiver_app_status is None:
+            self.close_socket()
+            return "IDLE"
+
+        transport_id = str(self.receiver_app_status['transportId'])
+        self.connect(transport_id)
+        self.get_media_status()
+
+        self.close_socket()
+
+        if self.media_status is None:
+            return "IDLE"
+
+        return self.media_status.get("playerState", "IDLE")
+
     def pause(self):
         """ pause """
         self.control("PAUSE")
@@ -385,13 +765,20 @@ class CCMediaController:
         """ stop """
         self.control("STOP")
 
+    @timing.timed("controller.set_volume")
+    @reconnecting
     def set_volume(self, level):
         """ set the receiver volume - a float value in level for absolute level or "+" / "-" indicates up or down"""
 
+        # volume changes pushed by the device may be waiting unread on a kept-alive connection
+        self.read_pending()
+
         self.connect("receiver-0")
 
         if level in ("+", "-"):
-            self.get_receiver_status()
+            # the stored volume is used if it is fresh enough
+            if not self.status_store.is_fresh("volume", self.status_max_age):
+                self.get_receiver_status()
 
             if self.volume_status is not None:
                 curr_level = self.volume_status['level']
@@ -406,9 +793,19 @@ class CCMediaController:
 
         self.close_socket()
 
-    def get_volume(self):
-        """ get the current volume level """
-        self.get_status()
+    @reconnecting
+    def get_volume(self, max_age=None):
+        """ get the current volume level - the stored level is used if it is less than max_age seconds old """
+
+        if max_age is None:
+            max_age = self.status_max_age
+
+        # the volume is part of the receiver status, so there is no need for the media status
+        self.read_pending()
+        if not self.status_store.is_fresh("volume", max_age):
+            self.connect("receiver-0")
+            self.get_receiver_status()
+            self.close_socket()
 
         vol = None
 
@@ -1,7 +1,7 @@
 """
 Translates messages sent to & received from a Chromecast in the protocol-buffers format.
 
-version 0.1
+version 0.2
 
 See https://developers.google.com/protocol-buffers/docs/encoding?hl=en
 
@@ -31,6 +31,31 @@ Thanks to TheCrazyT for this very helpful gist : https://gist.github.com/TheCraz
 
 from struct import pack, unpack
 
+# wire types
+WIRE_VARINT = 0
+WIRE_64BIT = 1
+WIRE_LENGTH_DELIMITED = 2
+WIRE_32BIT = 5
+
+# CastMessage payload types
+PAYLOAD_STRING = 0
+PAYLOAD_BINARY = 1
+
+# CastMessage field numbers and the key each is returned under by extract_message
+FIELDS = {1: 'protocol',
+          2: 'source_id',
+          3: 'destination_id',
+          4: 'namespace',
+          5: 'payload_type',
+          6: 'data',            # payload_utf8
+          7: 'data'}            # payload_binary
+
+REQUIRED_FIELDS = ('protocol', 'source_id', 'destination_id', 'namespace', 'payload_type')
+
+
+class CastMessageError(Exception):
+    pass
+
 
 # Sent messages
 
@@ -43,58 +68,60 @@ def format_field_id(field_no, field_type):
 def format_varint_value(int_value):
     """ returns a varint type integer from a python integer """
 
-    varint_result = ""
+    if int_value < 0:
+        # negative values are sent as 64 bit two's complement
+        int_value += 1 << 64
+
+    varint_result = []
 
     while int_value > 127:
-        varint_result += pack("B", int_value & 127 | 128)
+        varint_result.append(chr(int_value & 127 | 128))
         int_value >>= 7
 
-    varint_result += pack("B", int_value & 127)  # & 127 unnecessary?
+    varint_result.append(chr(int_value))
 
-    return varint_result
+    return "".join(varint_result)
 
 
 def format_int_field(field_number, field_data):
-    """ formats a protocol buffers Int field """
+    """ formats a protocol buffers Int (varint) field """
 
-    field = pack("B", format_field_id(field_number, 0))  # 0 = Int field type
-    field += pack("B", field_data)
-
-    return field
+    return format_varint_value(format_field_id(field_number, WIRE_VARINT)) + format_varint_value(field_data)
 
 
 def format_string_field(field_number, field_data):
     """ formats a protocol buffers length-delimited field """
 
-    field_data_len = format_varint_value(len(field_data))
-
-    field = pack("B", format_field_id(field_number, 2))  # 2 = Length-delimited field type
-    field += pack("%ds" % len(field_data_len), field_data_len)
-    field += pack("%ds" % len(field_data), field_data)
+    if isinstance(field_data, unicode):
+        field_data = field_data.encode("utf-8")
 
-    return field
+    return (format_varint_value(format_field_id(field_number, WIRE_LENGTH_DELIMITED)) +
+            format_varint_value(len(field_data)) +
+            field_data)
 
 
 def prepend_length_header(msg):
     """ prepends the message with a length value """
 
-    return pack(">I%ds" % len(msg), len(msg), msg)
+    return pack(">I", len(msg)) + msg
 
 
-def format_message(source_id, destination_id, namespace, data):
-    """ formats a message to be sent to the Chromecast """
+def format_message(source_id, destination_id, namespace, data, payload_type=PAYLOAD_STRING):
+    """ formats a message to be sent to the Chromecast - data is sent as payload_binary if payload_type is
+        PAYLOAD_BINARY, otherwise as payload_utf8 """
 
-    msg = ""
-    msg += format_int_field(1, 0)  # Protocol Version  =  0
-    msg += format_string_field(2, source_id)
-    msg += format_string_field(3, destination_id)
-    msg += format_string_field(4, namespace)
-    msg += format_int_field(5, 0)  # payload type : string  =  0
-    msg += format_string_field(6, data)
+    payload_field = 6
+    if payload_type == PAYLOAD_BINARY:
+        payload_field = 7
 
-    msg = prepend_length_header(msg)
+    msg = "".join([format_int_field(1, 0),  # Protocol Version  =  0 (CASTV2_1_0)
+                   format_string_field(2, source_id),
+                   format_string_field(3, destination_id),
+                   format_string_field(4, namespace),
+                   format_int_field(5, payload_type),
+                   format_string_field(payload_field, data)])
 
-    return msg
+    return prepend_length_header(msg)
 
 
 # Received messages
@@ -105,76 +132,152 @@ def extract_length_header(msg):
     if len(msg) < 4:
         return None
 
-    len_data = msg[:4]
-    remainder = ""
-    if len(msg) > 4:
-        remainder = msg[4:]
+    length = unpack(">I", msg[:4])[0]
+
+    return length, msg[4:]
+
+
+def extract_varint(data, ptr=0):
+    """ extracts a varint starting at ptr - returns the value and the position after it """
+
+    value = 0
+    shift = 0
+
+    while True:
+        if ptr >= len(data):
+            raise CastMessageError("truncated varint")
+
+        byte = ord(data[ptr])
+        ptr += 1
+
+        value |= (byte & 127) << shift
+        if not byte & 128:
+            return value, ptr
 
-    length = unpack(">I", len_data)[0]
+        shift += 7
+        if shift >= 64:
+            raise CastMessageError("varint too long")
 
-    return length, remainder
+
+def extract_field(data, ptr=0):
+    """ extracts the field starting at ptr - returns the field number, wire type, value
+        and the position after it. The values of fixed size fields are returned as unsigned integers """
+
+    key, ptr = extract_varint(data, ptr)
+    field_no, wire_type = key >> 3, key & 7
+
+    if wire_type == WIRE_VARINT:
+        value, ptr = extract_varint(data, ptr)
+
+    elif wire_type == WIRE_LENGTH_DELIMITED:
+        length, ptr = extract_varint(data, ptr)
+        if ptr + length > len(data):
+            raise CastMessageError("truncated field %d" % field_no)
+        value = data[ptr:ptr + length]
+        ptr += length
+
+    elif wire_type == WIRE_64BIT:
+        if ptr + 8 > len(data):
+            raise CastMessageError("truncated field %d" % field_no)
+        value = unpack("<Q", data[ptr:ptr + 8])[0]
+        ptr += 8
+
+    elif wire_type == WIRE_32BIT:
+        if ptr + 4 > len(data):
+            raise CastMessageError("truncated field %d" % field_no)
+        value = unpack("<I", data[ptr:ptr + 4])[0]
+        ptr += 4
+
+    else:
+        raise CastMessageError("unsupported wire type %d in field %d" % (wire_type, field_no))
+
+    return field_no, wire_type, value, ptr
+
+
+def extract_fields(data):
+    """ extracts every field of a message in the order they appear - returns a list of 
+        (field number, wire type, value) """
+
+    fields = []
+
+    ptr = 0
+    while ptr < len(data):
+        field_no, wire_type, value, ptr = extract_field(data, ptr)
+        fields.append((field_no, wire_type, value))
+
+    return fields
 
 
 def extract_field_id(data):
     """ extracts a field id from a received message """
 
-    byte = unpack("B", data)[0]
-    return byte >> 3, (byte & 7)
+    key = extract_varint(data)[0]
+    return key >> 3, (key & 7)
 
 
 def extract_int_field(data):
     """ extracts a protocol buffers Int field from a received message """
 
-    field_id = extract_field_id(data[0])
-    int_value = unpack("B", data[1])[0]
-
-    remainder = ""
-    if len(data) > 2:
-        remainder = data[2:]
+    field_no, wire_type, int_value, ptr = extract_field(data)
 
-    return field_id, int_value, remainder
+    return (field_no, wire_type), int_value, data[ptr:]
 
 
 def extract_string_field(data):
     """ extracts a protocol buffers length-delimited field from a received message """
 
-    field_id = extract_field_id(data[0])
+    field_no, wire_type, string, ptr = extract_field(data)
 
-    # extract varint length
-    length = 0
-    ptr = 1
-    byte = unpack("B", data[ptr])[0]
+    return (field_no, wire_type), string, data[ptr:]
 
-    while byte & 128:
-        length += byte & 127
-        length <<= 7
 
-        ptr += 1
-        byte = unpack("B", data[ptr])[0]
+def extract_message(data, strict=False):
+    """ extracts the message data from a Chromecast response message
+
+        The fields may be in any order and unknown fields are skipped. The payload is returned in 'data',
+        whether it was sent as payload_utf8 or payload_binary ('payload_type' tells which).
 
-    length += byte
+        In strict mode a CastMessageError is raised if the message is malformed or a required field is
+        missing or of the wrong type. Otherwise whatever could be decoded is returned, with defaults for
+        the missing fields.
+    """
 
-    ptr += 1
-    string_end_ptr = ptr + length
-    string = data[ptr:string_end_ptr]
+    resp = {'protocol': 0,
+            'source_id': "",
+            'destination_id': "",
+            'namespace': "",
+            'payload_type': PAYLOAD_STRING,
+            'data': ""}
+    found = set()
 
-    remainder = ""
-    if len(data) > string_end_ptr:
-        remainder = data[string_end_ptr:]
+    ptr = 0
+    while ptr < len(data):
+        try:
+            field_no, wire_type, value, ptr = extract_field(data, ptr)
+        except CastMessageError:
+            if strict:
+                raise
+            break
 
-    return field_id, string, remainder
+        key = FIELDS.get(field_no)
+        if key is None:
+            continue
 
+        expected_wire_type = WIRE_LENGTH_DELIMITED
+        if field_no in (1, 5):
+            expected_wire_type = WIRE_VARINT
 
-def extract_message(data):
-    """ extracts the message data from a Chromecast response message """
+        if wire_type != expected_wire_type:
+            if strict:
+                raise CastMessageError("field %d has wire type %d" % (field_no, wire_type))
+            continue
 
-    resp = {}
+        resp[key] = value
+        found.add(key)
 
-    field_id, resp['protocol'], data = extract_int_field(data)
-    field_id, resp['source_id'], data = extract_string_field(data)
-    field_id, resp['destination_id'], data = extract_string_field(data)
-    field_id, resp['namespace'], data = extract_string_field(data)
-    field_id, resp['payload_type'], data = extract_int_field(data)
-    field_id, resp['data'], data = extract_string_field(data)
+    if strict:
+        missing = [key for key in REQUIRED_FIELDS if key not in found]
+        if len(missing) > 0:
+            raise CastMessageError("missing fields: " + ", ".join(missing))
 
     return resp
@@ -0,0 +1,712 @@
+"""
+A stand-in for Chromecast devices, for testing and benchmarking without a real device on the network.
+
+Each simulated device answers SSDP searches, serves its device description on port 8008 and speaks the
+Cast protocol over TLS on port 8009 (CONNECT, heartbeats, GET_STATUS, LAUNCH, STOP, SET_VOLUME and the media
+player's LOAD, PAUSE, PLAY, STOP and SEEK, with pushed status updates). Loading media makes the device fetch
+the URL at a configurable bitrate, so streaming can be measured end to end.
+
+Several devices can run on one machine by giving each its own loopback address (127.0.0.2, 127.0.0.3, ...).
+
+    python -m stream2chromecast.cc_simulator --count 3 --bitrate 4000000
+
+version 0.1
+
+"""
+
+
+# Copyright (C) 2014-2016 Pat Carter
+#
+# This file is part of Stream2chromecast.
+#
+# Stream2chromecast is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Stream2chromecast is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Stream2chromecast.  If not, see <http://www.gnu.org/licenses/>.
+
+
+
+import argparse
+import BaseHTTPServer
+import itertools
+import json
+import os
+import select
+import shutil
+import socket
+import SocketServer
+import ssl
+import subprocess
+import tempfile
+import threading
+import time
+import urllib2
+import uuid
+from struct import pack
+
+from . import cc_device_finder
+from . import cc_message
+from .cc_media_controller import MEDIAPLAYER_APPID
+
+CONNECTION_NS = "urn:x-cast:com.google.cast.tp.connection"
+HEARTBEAT_NS = "urn:x-cast:com.google.cast.tp.heartbeat"
+RECEIVER_NS = "urn:x-cast:com.google.cast.receiver"
+MEDIA_NS = "urn:x-cast:com.google.cast.media"
+
+DESCRIPTION_PORT = 8008
+CAST_PORT = 8009
+
+# amount of media fetched in each read
+FETCH_CHUNK_SIZE = 65536
+
+DEVICE_DESCRIPTION = """<?xml version="1.0" encoding="utf-8"?>
+<root xmlns="urn:schemas-upnp-org:device-1-0">
+  <specVersion><major>1</major><minor>0</minor></specVersion>
+  <URLBase>http://%(ip)s:8008</URLBase>
+  <device>
+    <deviceType>urn:dial-multiscreen-org:device:dial:1</deviceType>
+    <friendlyName>%(name)s</friendlyName>
+    <manufacturer>Stream2chromecast</manufacturer>
+    <modelName>%(model)s</modelName>
+    <UDN>uuid:%(uuid)s</UDN>
+    <serviceList>
+      <service>
+        <serviceType>urn:dial-multiscreen-org:service:dial:1</serviceType>
+        <serviceId>urn:dial-multiscreen-org:serviceId:dial</serviceId>
+        <controlURL>/ssdp/notfound</controlURL>
+        <eventSubURL>/ssdp/notfound</eventSubURL>
+        <SCPDURL>/ssdp/notfound</SCPDURL>
+      </service>
+    </serviceList>
+  </device>
+</root>
+"""
+
+
+def generate_certificate(directory):
+    """ create a self-signed certificate for the Cast TLS server with openssl - returns the cert & key paths """
+
+    certfile = os.path.join(directory, "simulator-cert.pem")
+    keyfile = os.path.join(directory, "simulator-key.pem")
+
+    with open(os.devnull, "w") as devnull:
+        subprocess.check_call(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "2",
+                               "-subj", "/CN=stream2chromecast-simulator",
+                               "-keyout", keyfile, "-out", certfile], stdout=devnull, stderr=devnull)
+
+    return certfile, keyfile
+
+
+def read_frame(sock):
+    """ read one length-prefixed Cast frame - returns None when the connection is closed """
+
+    data = ""
+    length = None
+
+    while length is None or len(data) < length:
+        needed = 4 - len(data) if length is None else length - len(data)
+        chunk = sock.recv(min(needed, 65536))
+        if len(chunk) == 0:
+            return None
+
+        data += chunk
+
+        if length is None and len(data) == 4:
+            length = cc_message.extract_length_header(data)[0]
+            data = ""
+
+    return data
+
+
+class DescriptionRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ Handle HTTP requests for the device description """
+
+    def do_GET(self):
+        if self.path != "/ssdp/device-desc.xml":
+            self.send_error(404)
+            return
+
+        device = self.server.device
+        body = DEVICE_DESCRIPTION % {'ip': device.ip, 'name': device.name, 'model': device.model,
+                                     'uuid': device.uuid}
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/xml")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Application-URL", "http://%s:%d/apps/" % (device.ip, DESCRIPTION_PORT))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class CastConnection(SocketServer.BaseRequestHandler):
+    """ one sender's TLS connection to a simulated device """
+
+    def setup(self):
+        device = self.server.device
+
+        self.sock = ssl.wrap_socket(self.request, server_side=True,
+                                    certfile=device.certfile, keyfile=device.keyfile)
+        self.send_lock = threading.Lock()
+        self.virtual_connections = {}  # destination id -> sender id
+
+    def send(self, source_id, destination_id, namespace, payload):
+        """ send a message to the sender """
+
+        frame = cc_message.format_message(source_id, destination_id, namespace, json.dumps(payload))
+
+        with self.send_lock:
+            self.sock.sendall(frame)
+
+        self.server.device.record("sent", namespace, payload.get("type"))
+
+    def handle(self):
+        device = self.server.device
+        device.add_connection(self)
+
+        try:
+            while True:
+                frame = read_frame(self.sock)
+                if frame is None:
+                    break
+
+                message = cc_message.extract_message(frame)
+
+                try:
+                    payload = json.loads(message['data'])
+                except ValueError:
+                    continue
+
+                start = time.time()
+                self.handle_message(message, payload)
+                device.record("received", message['namespace'], payload.get("type"), time.time() - start)
+        except (socket.error, ssl.SSLError):
+            pass
+        finally:
+            device.remove_connection(self)
+
+    def handle_message(self, message, payload):
+        device = self.server.device
+
+        namespace = message['namespace']
+        destination_id = message['destination_id']
+        sender_id = message['source_id']
+        msg_type = payload.get("type")
+        request_id = payload.get("requestId", 0)
+
+        def reply(response):
+            response["requestId"] = request_id
+            self.send(destination_id, sender_id, namespace, response)
+
+        if namespace == CONNECTION_NS:
+            if msg_type == "CONNECT":
+                self.virtual_connections[destination_id] = sender_id
+            elif msg_type == "CLOSE":
+                self.virtual_connections.pop(destination_id, None)
+
+        elif namespace == HEARTBEAT_NS:
+            if msg_type == "PING":
+                self.send(destination_id, sender_id, namespace, {"type": "PONG"})
+
+        elif namespace == RECEIVER_NS:
+            if msg_type == "GET_STATUS":
+                reply(device.receiver_status())
+
+            elif msg_type == "LAUNCH":
+                device.launch(payload.get("appId"))
+                reply(device.receiver_status())
+                device.broadcast_receiver_status(exclude=self)
+
+            elif msg_type == "STOP":
+                device.stop_app()
+                reply(device.receiver_status())
+                device.broadcast_receiver_status(exclude=self)
+
+            elif msg_type == "SET_VOLUME":
+                device.set_volume(payload.get("volume", {}))
+                reply(device.receiver_status())
+                device.broadcast_receiver_status(exclude=self)
+
+            else:
+                reply({"type": "INVALID_REQUEST", "reason": "INVALID_COMMAND"})
+
+        elif namespace == MEDIA_NS:
+            if destination_id != device.transport_id:
+                reply({"type": "INVALID_REQUEST", "reason": "INVALID_SESSION"})
+
+            elif msg_type == "GET_STATUS":
+                reply(device.media_status())
+
+            elif msg_type == "LOAD":
+                device.load(payload.get("media", {}), payload.get("currentTime", 0))
+                reply(device.media_status())
+                device.broadcast_media_status(exclude=self)
+
+            elif msg_type in ("PAUSE", "PLAY", "STOP", "SEEK"):
+                if device.media_session_id is None:
+                    reply({"type": "INVALID_PLAYER_STATE"})
+                else:
+                    device.media_command(msg_type, payload)
+                    reply(device.media_status())
+                    device.broadcast_media_status(exclude=self)
+
+            else:
+                reply({"type": "INVALID_REQUEST", "reason": "INVALID_COMMAND"})
+
+
+class ThreadingTCPServer(SocketServer.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+class SimulatedDevice(object):
+    """ a simulated Chromecast listening on its own ip address """
+
+    def __init__(self, name, ip="127.0.0.2", bitrate=None, model="Chromecast Simulator",
+                 certfile=None, keyfile=None, cast_port=CAST_PORT):
+        """ initialise - bitrate (bits per second) limits how fast loaded media is fetched """
+
+        self.name = name
+        self.ip = ip
+        self.bitrate = bitrate
+        self.model = model
+        self.uuid = str(uuid.uuid4())
+        self.certfile = certfile
+        self.keyfile = keyfile
+        self.cast_port = cast_port
+
+        self.lock = threading.Lock()
+        self.connections = []
+        self.servers = []
+
+        self.app_id = None
+        self.session_id = None
+        self.transport_id = None
+        self.volume = {"level": 1.0, "muted": False}
+
+        self.media = None
+        self.media_session_id = None
+        self.media_session_ids = itertools.count(1)
+        self.player_state = "IDLE"
+        self.idle_reason = None
+        self.position = 0.0
+        self.playback = None
+
+        self.stats = {'messages_received': 0, 'messages_sent': 0, 'handling_time': 0.0,
+                      'loads': 0, 'time_to_first_byte': [], 'bytes_fetched': 0, 'fetch_time': 0.0}
+
+    def start(self):
+        """ start serving the device description and the Cast protocol """
+
+        description_server = BaseHTTPServer.HTTPServer((self.ip, DESCRIPTION_PORT), DescriptionRequestHandler)
+        cast_server = ThreadingTCPServer((self.ip, self.cast_port), CastConnection)
+
+        for server in (description_server, cast_server):
+            server.device = self
+            thread = threading.Thread(target=server.serve_forever)
+            thread.daemon = True
+            thread.start()
+            self.servers.append(server)
+
+    def stop(self):
+        """ stop the servers and any playback """
+
+        self.stop_playback()
+
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+
+        self.servers = []
+
+    def record(self, direction, namespace, msg_type, handling_time=0.0):
+        """ count a message handled by the device """
+
+        with self.lock:
+            self.stats['messages_' + direction] += 1
+            self.stats['handling_time'] += handling_time
+
+    def add_connection(self, connection):
+        with self.lock:
+            self.connections.append(connection)
+
+    def remove_connection(self, connection):
+        with self.lock:
+            if connection in self.connections:
+                self.connections.remove(connection)
+
+    # receiver
+
+    def receiver_status(self):
+        with self.lock:
+            applications = []
+            if self.app_id is not None:
+                applications.append({"appId": self.app_id,
+                                     "displayName": "Default Media Receiver",
+                                     "namespaces": [{"name": MEDIA_NS}],
+                                     "sessionId": self.session_id,
+                                     "statusText": "Ready To Cast",
+                                     "transportId": self.transport_id})
+
+            return {"type": "RECEIVER_STATUS",
+                    "status": {"applications": applications, "volume": dict(self.volume)}}
+
+    def launch(self, app_id):
+        self.stop_playback()
+
+        with self.lock:
+            self.app_id = app_id or MEDIAPLAYER_APPID
+            self.session_id = str(uuid.uuid4())
+            self.transport_id = self.session_id
+            self.media = None
+            self.media_session_id = None
+            self.player_state = "IDLE"
+            self.idle_reason = None
+
+    def stop_app(self):
+        self.stop_playback()
+
+        with self.lock:
+            self.app_id = None
+            self.session_id = None
+            self.transport_id = None
+            self.media = None
+            self.media_session_id = None
+            self.player_state = "IDLE"
+
+    def set_volume(self, volume):
+        with self.lock:
+            if "level" in volume:
+                self.volume["level"] = min(max(float(volume["level"]), 0.0), 1.0)
+            if "muted" in volume:
+                self.volume["muted"] = bool(volume["muted"])
+
+    # media player
+
+    def media_status(self):
+        with self.lock:
+            if self.media_session_id is None:
+                return {"type": "MEDIA_STATUS", "status": []}
+
+            status = {"mediaSessionId": self.media_session_id,
+                      "playbackRate": 1,
+                      "playerState": self.player_state,
+                      "currentTime": self.position,
+                      "supportedMediaCommands": 15,
+                      "volume": dict(self.volume),
+                      "media": self.media}
+
+            if self.player_state == "IDLE" and self.idle_reason is not None:
+                status["idleReason"] = self.idle_reason
+
+            return {"type": "MEDIA_STATUS", "status": [status]}
+
+    def load(self, media, current_time=0):
+        """ start fetching the media, as a device does when it starts playing """
+
+        self.stop_playback()
+
+        with self.lock:
+            self.media = media
+            self.media_session_id = next(self.media_session_ids)
+            self.player_state = "BUFFERING"
+            self.idle_reason = None
+            self.position = float(current_time or 0)
+            self.stats['loads'] += 1
+
+            playback = {'stop': threading.Event(), 'resume': threading.Event(), 'requested': time.time()}
+            playback['resume'].set()
+            self.playback = playback
+
+        thread = threading.Thread(target=self.fetch, args=(media.get("contentId", ""), playback))
+        thread.daemon = True
+        thread.start()
+
+    def stop_playback(self):
+        with self.lock:
+            playback = self.playback
+            self.playback = None
+
+        if playback is not None:
+            playback['stop'].set()
+            playback['resume'].set()
+
+    def media_command(self, command, payload):
+        with self.lock:
+            playback = self.playback
+
+            if command == "PAUSE" and self.player_state in ("PLAYING", "BUFFERING"):
+                self.player_state = "PAUSED"
+                if playback is not None:
+                    playback['resume'].clear()
+
+            elif command == "PLAY" and self.player_state == "PAUSED":
+                self.player_state = "PLAYING"
+                if playback is not None:
+                    playback['resume'].set()
+
+            elif command == "SEEK":
+                self.position = float(payload.get("currentTime", self.position))
+
+        if command == "STOP":
+            self.stop_playback()
+            self.set_idle("CANCELLED")
+
+    def set_idle(self, reason):
+        with self.lock:
+            self.player_state = "IDLE"
+            self.idle_reason = reason
+
+    def set_player_state(self, playback, state):
+        """ change the player state if the playback is still the current one """
+
+        with self.lock:
+            if self.playback is not playback or self.player_state == "PAUSED":
+                return False
+            self.player_state = state
+
+        return True
+
+    def fetch(self, url, playback):
+        """ fetch the media at the device's bitrate, updating the player state as a device would """
+
+        try:
+            response = urllib2.urlopen(url, timeout=30)
+
+            data = response.read(FETCH_CHUNK_SIZE)
+            first_byte = time.time()
+
+            with self.lock:
+                self.stats['time_to_first_byte'].append(first_byte - playback['requested'])
+
+            if self.set_player_state(playback, "PLAYING"):
+                self.broadcast_media_status()
+
+            fetched = 0
+            started = time.time()
+            paused_time = 0.0
+
+            while len(data) > 0 and not playback['stop'].is_set():
+                fetched += len(data)
+
+                if not playback['resume'].is_set():
+                    pause_start = time.time()
+                    playback['resume'].wait()
+                    paused_time += time.time() - pause_start
+
+                if self.bitrate:
+                    # keep the reads in step with the bitrate
+                    delay = started + paused_time + fetched * 8.0 / self.bitrate - time.time()
+                    if delay > 0:
+                        playback['stop'].wait(delay)
+
+                with self.lock:
+                    self.stats['bytes_fetched'] += len(data)
+                    if self.bitrate and self.playback is playback:
+                        self.position = fetched * 8.0 / self.bitrate
+
+                data = response.read(FETCH_CHUNK_SIZE)
+
+            with self.lock:
+                self.stats['fetch_time'] += time.time() - started
+
+            response.close()
+
+            if not playback['stop'].is_set():
+                with self.lock:
+                    current = self.playback is playback
+                if current:
+                    self.set_idle("FINISHED")
+                    self.broadcast_media_status()
+
+        except (urllib2.URLError, socket.error, ValueError):
+            with self.lock:
+                current = self.playback is playback
+            if current:
+                self.set_idle("ERROR")
+                self.broadcast_media_status()
+
+    # pushed status
+
+    def broadcast(self, destination_filter, namespace, payload, exclude=None):
+        """ push a status message to every sender connected to the given destination """
+
+        payload = dict(payload, requestId=0)
+
+        with self.lock:
+            connections = list(self.connections)
+
+        for connection in connections:
+            if connection is exclude:
+                continue
+
+            for destination_id, sender_id in connection.virtual_connections.items():
+                if destination_id == destination_filter:
+                    try:
+                        connection.send(destination_id, sender_id, namespace, payload)
+                    except (socket.error, ssl.SSLError):
+                        pass
+
+    def broadcast_receiver_status(self, exclude=None):
+        self.broadcast("receiver-0", RECEIVER_NS, self.receiver_status(), exclude)
+
+    def broadcast_media_status(self, exclude=None):
+        if self.transport_id is not None:
+            self.broadcast(self.transport_id, MEDIA_NS, self.media_status(), exclude)
+
+
+class SSDPResponder(object):
+    """ answers SSDP searches on behalf of a group of simulated devices """
+
+    def __init__(self, devices):
+        self.devices = devices
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if hasattr(socket, "SO_REUSEPORT"):
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
+        self.sock.bind(("", cc_device_finder.SSDP_PORT))
+
+        # join the group on every interface the searches may be sent from
+        for interface_addr in cc_device_finder.get_multicast_interfaces() + ["127.0.0.1"]:
+            if interface_addr is None:
+                interface_addr = "0.0.0.0"
+            membership = socket.inet_aton(cc_device_finder.SSDP_ADDR) + socket.inet_aton(interface_addr)
+            try:
+                self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+            except socket.error:
+                pass
+
+        self.thread = threading.Thread(target=self.serve)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.sock.close()
+
+    def serve(self):
+        while not self.stop_event.is_set():
+            if len(select.select([self.sock], [], [], 0.1)[0]) == 0:
+                continue
+
+            data, addr = self.sock.recvfrom(cc_device_finder.MAX_DATAGRAM_SIZE)
+            start_line, headers = cc_device_finder.extract_ssdp_headers(data)
+
+            if not start_line.upper().startswith("M-SEARCH"):
+                continue
+            if headers.get("ST") not in (cc_device_finder.DIAL_SERVICE, "ssdp:all"):
+                continue
+
+            for device in self.devices:
+                response = "\r\n".join(["HTTP/1.1 200 OK",
+                                        "CACHE-CONTROL: max-age=1800",
+                                        "EXT:",
+                                        "LOCATION: http://%s:%d/ssdp/device-desc.xml" % (device.ip, DESCRIPTION_PORT),
+                                        "ST: " + cc_device_finder.DIAL_SERVICE,
+                                        "USN: uuid:%s::%s" % (device.uuid, cc_device_finder.DIAL_SERVICE),
+                                        "", ""])
+                try:
+                    self.sock.sendto(response, addr)
+                except socket.error:
+                    pass
+
+
+class Simulator(object):
+    """ runs a group of simulated devices on consecutive loopback addresses """
+
+    def __init__(self, count=1, base_ip="127.0.0.2", name="Simulated Chromecast", bitrate=None,
+                 certfile=None, keyfile=None, ssdp=True):
+        """ initialise - devices after the first have their number appended to their name """
+
+        self.temp_dir = None
+        if certfile is None:
+            self.temp_dir = tempfile.mkdtemp(prefix="cc_simulator")
+            certfile, keyfile = generate_certificate(self.temp_dir)
+
+        first_ip = socket.inet_aton(base_ip)
+        self.devices = []
+        for i in range(count):
+            ip = socket.inet_ntoa(pack(">I", int(first_ip.encode("hex"), 16) + i))
+            device_name = name if i == 0 else "%s %d" % (name, i + 1)
+            self.devices.append(SimulatedDevice(device_name, ip, bitrate=bitrate,
+                                                certfile=certfile, keyfile=keyfile))
+
+        self.ssdp = None
+        if ssdp:
+            self.ssdp = SSDPResponder(self.devices)
+
+    def start(self):
+        for device in self.devices:
+            device.start()
+
+        if self.ssdp is not None:
+            self.ssdp.start()
+
+    def stop(self):
+        if self.ssdp is not None:
+            self.ssdp.stop()
+
+        for device in self.devices:
+            device.stop()
+
+        if self.temp_dir is not None:
+            shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate Chromecast devices on this machine")
+    parser.add_argument("--count", type=int, default=1, help="number of devices to simulate")
+    parser.add_argument("--ip", default="127.0.0.2", help="address of the first device")
+    parser.add_argument("--name", default="Simulated Chromecast", help="friendly name of the first device")
+    parser.add_argument("--bitrate", type=int, default=None,
+                        help="bits per second at which the devices fetch media (default: as fast as possible)")
+    parser.add_argument("--certfile", default=None, help="TLS certificate (default: generate one with openssl)")
+    parser.add_argument("--keyfile", default=None, help="TLS private key")
+    parser.add_argument("--no-ssdp", action="store_true", help="don't answer SSDP searches")
+    args = parser.parse_args()
+
+    simulator = Simulator(count=args.count, base_ip=args.ip, name=args.name, bitrate=args.bitrate,
+                          certfile=args.certfile, keyfile=args.keyfile, ssdp=not args.no_ssdp)
+    simulator.start()
+
+    for device in simulator.devices:
+        print "simulating:", device.name, "on", device.ip
+
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        print
+    finally:
+        simulator.stop()
+
+        for device in simulator.devices:
+            print device.name, json.dumps(device.stats)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,222 @@
+"""
+Records the Cast protocol messages exchanged with the devices, for diagnosing slow receivers.
+
+While tracing, every frame sent or received by CCMediaController is appended to a file as a line of JSON:
+the time, direction, device, source & destination ids, namespace, message type, request id, frame size and
+the payload itself. Responses carry the time since their request was sent, so the trace shows the round
+trip latency of each request. A trace can be summarised, and replayed into benchmarks/bench_codec.py.
+
+    stream2chromecast.py --trace trace.jsonl status
+    python -m stream2chromecast.cc_tracer trace.jsonl
+
+version 0.1
+
+"""
+
+
+# Copyright (C) 2014-2016 Pat Carter
+#
+# This file is part of Stream2chromecast.
+#
+# Stream2chromecast is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Stream2chromecast is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Stream2chromecast.  If not, see <http://www.gnu.org/licenses/>.
+
+
+
+import argparse
+import base64
+import json
+import threading
+import time
+
+from . import cc_media_controller
+from . import cc_message
+
+# the running tracer, which CCMediaController is given to check on every frame
+tracer = None
+
+
+class Tracer(object):
+    """ writes a trace record for each frame and matches responses to their requests """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "a")
+        self.lock = threading.Lock()
+        self.pending = {}  # (host, local port, request id) -> time the request was sent
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+    def write(self, record):
+        with self.lock:
+            self.file.write(json.dumps(record, sort_keys=True) + "\n")
+            self.file.flush()
+
+    def make_record(self, direction, host, local_port, source_id, destination_id, namespace, payload_type, data,
+                    frame_bytes):
+        record = {'t': time.time(),
+                  'dir': direction,
+                  'host': host,
+                  'conn': local_port,
+                  'src': source_id,
+                  'dst': destination_id,
+                  'ns': namespace,
+                  'bytes': frame_bytes}
+
+        message = {}
+        if payload_type == cc_message.PAYLOAD_STRING:
+            try:
+                message = json.loads(data)
+            except ValueError:
+                pass
+
+        if isinstance(message, dict):
+            record['type'] = message.get("type", message.get("responseType"))
+            record['request_id'] = message.get("requestId")
+
+        try:
+            record['payload'] = data.decode("utf-8")
+        except UnicodeDecodeError:
+            record['payload'] = base64.b64encode(data)
+            record['encoding'] = "base64"
+
+        if payload_type != cc_message.PAYLOAD_STRING:
+            record['payload_type'] = payload_type
+
+        return record
+
+    def record_sent(self, host, local_port, source_id, destination_id, namespace, data, frame_bytes):
+        """ trace a frame sent to a device over the connection from local_port """
+
+        record = self.make_record("send", host, local_port, source_id, destination_id, namespace,
+                                  cc_message.PAYLOAD_STRING, data, frame_bytes)
+
+        if record.get('request_id'):
+            with self.lock:
+                self.pending[(host, local_port, record['request_id'])] = record['t']
+
+        self.write(record)
+
+    def record_received(self, host, local_port, message_dict, frame_bytes):
+        """ trace a frame received from a device (as decoded by cc_message.extract_message) """
+
+        record = self.make_record("recv", host, local_port, message_dict['source_id'],
+                                  message_dict['destination_id'], message_dict['namespace'],
+                                  message_dict['payload_type'], message_dict['data'], frame_bytes)
+
+        # pushed status messages have a request id of 0
+        if record.get('request_id'):
+            with self.lock:
+                sent = self.pending.pop((host, local_port, record['request_id']), None)
+
+            if sent is not None:
+                record['latency_ms'] = (record['t'] - sent) * 1000
+
+        self.write(record)
+
+
+def start(path):
+    """ start tracing to a file """
+
+    global tracer
+
+    stop()
+    tracer = Tracer(path)
+    cc_media_controller.tracer = tracer
+
+    return tracer
+
+
+def stop():
+    """ stop tracing """
+
+    global tracer
+
+    if tracer is not None:
+        tracer.close()
+        tracer = None
+        cc_media_controller.tracer = None
+
+
+def load_trace(path):
+    """ yields the records of a trace file """
+
+    with open(path, "r") as f:
+        for line in f:
+            line = line.strip()
+            if line != "":
+                yield json.loads(line)
+
+
+def record_payload(record):
+    """ the payload of a traced frame as it was sent """
+
+    if record.get('encoding') == "base64":
+        return base64.b64decode(record['payload'])
+
+    return record['payload'].encode("utf-8")
+
+
+def record_frame(record):
+    """ the encoded frame of a trace record """
+
+    return cc_message.format_message(record['src'].encode("utf-8"), record['dst'].encode("utf-8"),
+                                     record['ns'].encode("utf-8"), record_payload(record),
+                                     record.get('payload_type', cc_message.PAYLOAD_STRING))
+
+
+def summarise(records):
+    """ the count, total bytes and round trip latencies (ms) of each message type, keyed by (direction, type) """
+
+    summary = {}
+
+    for record in records:
+        entry = summary.setdefault((record['dir'], record.get('type')), {'count': 0, 'bytes': 0, 'latencies': []})
+        entry['count'] += 1
+        entry['bytes'] += record['bytes']
+
+        if 'latency_ms' in record:
+            entry['latencies'].append(record['latency_ms'])
+
+    return summary
+
+
+def print_summary(summary):
+    print "%-5s %-24s %7s %10s %9s %9s %9s" % ("dir", "type", "count", "bytes", "p50 ms", "p95 ms", "max ms")
+
+    for (direction, msg_type), entry in sorted(summary.items()):
+        latencies = sorted(entry['latencies'])
+
+        if len(latencies) > 0:
+            p50 = "%.1f" % latencies[len(latencies) // 2]
+            p95 = "%.1f" % latencies[min(int(len(latencies) * 0.95), len(latencies) - 1)]
+            longest = "%.1f" % latencies[-1]
+        else:
+            p50 = p95 = longest = "-"
+
+        print "%-5s %-24s %7d %10d %9s %9s %9s" % (direction, msg_type or "?", entry['count'], entry['bytes'],
+                                                  p50, p95, longest)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Summarise a Cast protocol trace")
+    parser.add_argument("trace", help="trace file written with --trace")
+    args = parser.parse_args()
+
+    print_summary(summarise(load_trace(args.trace)))
+
+
+if __name__ == "__main__":
+    main()
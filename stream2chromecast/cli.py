@@ -0,0 +1,270 @@
+"""
+The stream2chromecast command line interface.
+
+Only the modules a command needs are imported, and only once it has been parsed, so that the control
+commands (pause, volup, status, ...) start quickly - see benchmarks/bench_startup.py.
+
+version 0.1
+
+"""
+
+
+# Copyright (C) 2014-2016 Pat Carter
+#
+# This file is part of Stream2chromecast.
+#
+# Stream2chromecast is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Stream2chromecast is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Stream2chromecast.  If not, see <http://www.gnu.org/licenses/>.
+
+
+
+import argparse
+import importlib
+
+
+def parse_args(argv=None):
+    device_parser = argparse.ArgumentParser(add_help=False)
+    device_group = device_parser.add_argument_group("device")
+    device_group.add_argument("-d", "--device_name",
+                              help="specify an Chromecast device by name (or ip address) explicitly: "
+                                   "e.g. to play a file on a specific device", default=None)
+
+    server_parser = argparse.ArgumentParser(add_help=False)
+    server_group = server_parser.add_argument_group("server")
+    server_group.add_argument("-p", "--server_port",
+                              help="specify the port from which the media is streamed. "
+                                   "This can be useful in a firewalled environment", default=None)
+    server_group.add_argument("--stats-interval", type=float, default=None,
+                              help="print the statistics of each stream every STATS_INTERVAL seconds "
+                                   "(they are always available from the server at /metrics)")
+
+    subtitles_parser = argparse.ArgumentParser(add_help=False)
+    subtitles_group = subtitles_parser.add_argument_group("subtitles")
+    subtitles_group.add_argument("-s", "--subtitles",
+                                 help="specify subtitles: a WebVTT, SRT or ASS/SSA file. "
+                                      "They are converted to WebVTT and served from the media server.",
+                                 default=None)
+    subtitles_group.add_argument("--subtitles-track", type=int,
+                                 help="show the subtitle track embedded in the media file with this index "
+                                      "(counting from 0). Extracting it needs ffmpeg or avconv.",
+                                 default=None)
+    subtitles_group.add_argument("--subtitles-port",
+                                 help="no longer used - subtitles are served from the media server's port",
+                                 default=None)
+    subtitles_group.add_argument("--subtitles-language",
+                                 help="specify the subtitles language. "
+                                      "The language format is defined by RFC 5646.",
+                                 default=None)
+
+    transcoder_parser = argparse.ArgumentParser(add_help=False)
+    transcoder_group = transcoder_parser.add_argument_group("transcoder")
+    transcoder_group.add_argument("--transcode", action="store_true",
+                                  help="Play an unsupported media type (e.g. an mpg file) "
+                                        "using ffmpeg or avconv as a realtime transcoder "
+                                       "(requires ffmpeg or avconv to be installed)")
+    transcoder_group.add_argument("--transcoder", choices=["ffmpeg", "avconv"], default="ffmpeg")
+    transcoder_group.add_argument("--transcode_options",
+                                  help="option to supply custom parameters to the "
+                                       "transcoder (ffmpeg or avconv)", default=None)
+    transcoder_group.add_argument("--transcode_bufsize", type=int,
+                                  help="pecify the buffer size of the data returned from the transcoder. "
+                                       "Increasing this can help when on a slow network.", default=0)
+
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--no-daemon", action="store_true",
+                        help="run the command in this process even if a daemon is running")
+    parser.add_argument("--discovery", choices=["ssdp", "mdns", "both"], default="ssdp",
+                        help="how to search the network for devices: SSDP/DIAL, mDNS (_googlecast._tcp) or both")
+    parser.add_argument("--timings", action="store_true",
+                        help="print how long each stage of the command took")
+    parser.add_argument("--timings-json", metavar="FILE", default=None,
+                        help="append each timed stage to FILE as a line of JSON (- for stderr)")
+    parser.add_argument("--trace", metavar="FILE", default=None,
+                        help="append every message exchanged with the device to FILE as a line of JSON")
+    subparsers = parser.add_subparsers()
+
+    daemon_parser = subparsers.add_parser("daemon", parents=[server_parser],
+                                          help="Run a daemon which streams media and keeps device connections "
+                                               "open for the other commands")
+    daemon_parser.add_argument("--stop", action="store_true", help="stop the running daemon")
+    daemon_parser.add_argument("--status-max-age", type=float, default=0,
+                               help="seconds for which a device's status is reused to answer status commands "
+                                    "instead of asking the device again")
+    daemon_parser.add_argument("--discovery-service", action="store_true",
+                               help="keep a live table of the devices on the network, so that devices are "
+                                    "found without searching")
+    daemon_parser.set_defaults(function="stream2chromecast:start_daemon")
+
+    devices_list_parser = subparsers.add_parser("devices_list",
+                                                help="Search for all Chromecast devices on the network")
+    devices_list_parser.set_defaults(function="stream2chromecast:list_devices")
+
+    play_parser = subparsers.add_parser("play", parents=[device_parser, server_parser, subtitles_parser, transcoder_parser],
+                                        help= "Play a file")
+    play_parser.add_argument("filename", help="The file to play - or the title of a file in the library, "
+                                              "or a glob pattern matching one")
+    play_parser.set_defaults(function="stream2chromecast:play")
+
+    play_url = subparsers.add_parser("playurl", parents=[device_parser, server_parser, transcoder_parser],
+                                     help="Play remote file using a URL (e.g. a web video)")
+    play_url.add_argument("url", help="The url to play")
+    play_url.add_argument("--proxy", action="store_true",
+                          help="download the resource into a local cache and stream it to the device from there, "
+                               "so that a slow origin doesn't cause rebuffering and replays come from disk "
+                               "(implied by --transcode)")
+    play_url.add_argument("--cache-size", type=int, default=None, metavar="MB",
+                          help="size limit of the download cache - the least recently played are removed "
+                               "first (default 2048)")
+    play_url.set_defaults(function="stream2chromecast:playurl")
+
+    scan_parser = argparse.ArgumentParser(add_help=False)
+    scan_group = scan_parser.add_argument_group("scanning")
+    scan_group.add_argument("--transcoder", choices=["ffmpeg", "avconv"], default="ffmpeg",
+                            help="probe the files with ffprobe or avprobe")
+    scan_group.add_argument("-j", "--jobs", type=int, default=None,
+                            help="files probed at once (default: the number of processors, at least 4)")
+
+    library_parser = subparsers.add_parser("library",
+                                           help="Index the media in a set of directories, so that files can be "
+                                                "played by title without being probed")
+    library_subparsers = library_parser.add_subparsers()
+
+    library_add = library_subparsers.add_parser("add", parents=[scan_parser],
+                                                help="add directories to the library and index them")
+    library_add.add_argument("directories", nargs="+", metavar="directory")
+    library_add.set_defaults(function="library:add_directories")
+
+    library_remove = library_subparsers.add_parser("remove", help="remove directories from the library")
+    library_remove.add_argument("directories", nargs="+", metavar="directory")
+    library_remove.set_defaults(function="library:remove_directories")
+
+    library_scan = library_subparsers.add_parser("scan", parents=[scan_parser],
+                                                 help="index the files added or changed since the last scan")
+    library_scan.set_defaults(function="library:scan")
+
+    library_list = library_subparsers.add_parser("list", help="list the files in the library")
+    library_list.add_argument("pattern", nargs="?", default=None,
+                              help="list only the files matching a title or glob pattern")
+    library_list.set_defaults(function="library:list_media")
+
+    pause_parser = subparsers.add_parser("pause", parents=[device_parser],
+                                         help="Pause the current file playing")
+    pause_parser.set_defaults(function="controls:pause")
+
+    continue_parser = subparsers.add_parser("continue", parents=[device_parser],
+                                            help="Continue (Unpause) the current file playing")
+    continue_parser.set_defaults(function="controls:unpause")
+
+    stop_parser = subparsers.add_parser("stop", parents=[device_parser],
+                                        help="Stop the current file playing")
+    stop_parser.set_defaults(function="controls:stop")
+
+    status_parser = subparsers.add_parser("status", parents=[device_parser],
+                                          help="Display Chromecast status")
+    status_parser.set_defaults(function="controls:get_status")
+
+    watch_parser = subparsers.add_parser("watch", parents=[device_parser],
+                                         help="Display player state changes as they happen")
+    watch_parser.add_argument("--until-idle", action="store_true",
+                              help="exit once the player becomes idle")
+    watch_parser.set_defaults(function="controls:watch")
+
+    setvol_parser = subparsers.add_parser("setvol", parents=[device_parser],
+                                          help="Set the volume")
+    setvol_parser.add_argument("volume", type=float, help="value between 0 & 1.0  (e.g. 0.5 = half volume)")
+    setvol_parser.set_defaults(function="controls:set_volume")
+
+    volume_up_parser = subparsers.add_parser("volup", parents=[device_parser],
+                                             help="Increase volume by 0.1")
+    volume_up_parser.set_defaults(function="controls:volume_up")
+
+    volume_down_parser = subparsers.add_parser("voldown", parents=[device_parser],
+                                               help="Decrease volume by 0.1")
+    volume_down_parser.set_defaults(function="controls:volume_down")
+
+    mute_parser = subparsers.add_parser("mute", parents=[device_parser],
+                                        help="Mute the volume")
+    mute_parser.set_defaults(volume=0)
+    mute_parser.set_defaults(function="controls:set_volume")
+
+    batch_parser = subparsers.add_parser("batch", parents=[device_parser],
+                                         help="Run a script of commands (one per line) over kept-alive "
+                                              "device connections")
+    batch_parser.add_argument("script", nargs="?", default="-",
+                              help="the file containing the commands (default: read from stdin)")
+    batch_parser.add_argument("--keep-going", action="store_true",
+                              help="carry on after a command fails")
+    batch_parser.set_defaults(function="batch:run_batch")
+
+    return parser.parse_args(argv)
+
+def load_function(function):
+    """ import the module implementing a command - function is given as "module:function name" """
+
+    module_name, function_name = function.split(":")
+    module = importlib.import_module(__name__.rpartition(".")[0] + "." + module_name)
+
+    return getattr(module, function_name)
+
+
+def run():
+    args = parse_args()
+    args_dict = vars(args)
+    function = args_dict.pop("function")
+    function_name = function.split(":")[1]
+    no_daemon = args_dict.pop("no_daemon")
+
+    # the modules used by only some commands are imported when needed, to keep startup quick
+    discovery = args_dict.pop("discovery")
+    if discovery != "ssdp":
+        from . import cc_device_finder
+        if discovery == "both":
+            cc_device_finder.DISCOVERY_METHODS = ("ssdp", "mdns")
+        else:
+            cc_device_finder.DISCOVERY_METHODS = (discovery,)
+
+    timings = args_dict.pop("timings")
+    timings_json = args_dict.pop("timings_json")
+    trace = args_dict.pop("trace")
+
+    timing = None
+    if timings or timings_json:
+        from . import timing
+        timing.enable(json_path=timings_json)
+
+    cc_tracer = None
+    if trace:
+        from . import cc_tracer
+        cc_tracer.start(trace)
+
+    try:
+        if not no_daemon and function_name != "start_daemon":
+            # hand the command to the daemon if one is running
+            from . import daemon_client
+            if daemon_client.forward_command(function_name, args_dict):
+                return
+
+        load_function(function)(**args_dict)
+    finally:
+        if timing is not None:
+            if timings:
+                timing.print_summary()
+            timing.disable()
+
+        if cc_tracer is not None:
+            cc_tracer.stop()
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,92 @@
+"""
+The playback and volume control commands, kept apart from the streaming code so that they start quickly.
+
+version 0.1
+
+"""
+
+
+# Copyright (C) 2014-2016 Pat Carter
+#
+# This file is part of Stream2chromecast.
+#
+# Stream2chromecast is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Stream2chromecast is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Stream2chromecast.  If not, see <http://www.gnu.org/licenses/>.
+
+
+
+import time
+
+from .cc_media_controller import CCMediaController
+
+
+def pause(device_name=None):
+    """ pause playback """
+    CCMediaController(device_name=device_name).pause()
+
+
+def unpause(device_name=None):
+    """ continue playback """
+    CCMediaController(device_name=device_name).play()
+
+
+def stop(device_name=None):
+    """ stop playback and quit the media player app on the chromecast """
+    CCMediaController(device_name=device_name).stop()
+
+
+def get_status(device_name=None):
+    """ print the status of the chromecast device """
+    print CCMediaController(device_name=device_name).get_status()
+
+
+def watch(device_name=None, until_idle=False):
+    """ print the player events pushed by the chromecast device """
+
+    def print_event(event):
+        timestamp = time.strftime("%H:%M:%S")
+
+        if event['type'] == "STATE":
+            idle_reason = ""
+            if event['state'] == "IDLE" and event['media_status'] is not None:
+                idle_reason = event['media_status'].get("idleReason", "")
+
+            print timestamp, event['state'], idle_reason
+
+        elif event['type'] == "ERROR":
+            print timestamp, "ERROR", event['error']
+
+        else:
+            print timestamp, event['type']
+
+        return until_idle and (event['type'] == "CLOSED" or event.get('state') == "IDLE")
+
+    try:
+        CCMediaController(device_name=device_name).watch(print_event)
+    except KeyboardInterrupt:
+        print
+
+
+def volume_up(device_name=None):
+    """ raise the volume by 0.1 """
+    CCMediaController(device_name=device_name).set_volume_up()
+
+
+def volume_down(device_name=None):
+    """ lower the volume by 0.1 """
+    CCMediaController(device_name=device_name).set_volume_down()
+
+
+def set_volume(volume, device_name=None):
+    """ set the volume to level between 0 and 1 """
+    CCMediaController(device_name=device_name).set_volume(volume)
@@ -0,0 +1,497 @@
+"""
+A long running daemon owning one streaming server and the connections to the Chromecast devices.
+
+The command line interface hands its commands to the daemon over a local unix socket when one is running,
+so discovery results, probe data and device connections are kept between commands.
+
+version 0.1
+
+"""
+
+
+# Copyright (C) 2014-2016 Pat Carter
+#
+# This file is part of Stream2chromecast.
+#
+# Stream2chromecast is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Stream2chromecast is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Stream2chromecast.  If not, see <http://www.gnu.org/licenses/>.
+
+
+
+import itertools
+import json
+import os
+import select
+import socket
+import SocketServer
+import stat
+import threading
+import traceback
+import urllib
+
+from . import cc_discovery_service
+from . import library
+from .daemon_client import COMMANDS, SOCKET_PATH, connect, is_private, send_command
+from . import stream2chromecast
+from . import stream_metrics
+from . import url_proxy
+from . import webvtt
+from .cc_media_controller import CCMediaController
+
+# seconds between looks for newly opened device connections to keep alive
+KEEPALIVE_INTERVAL = 1
+
+
+class MediaRequestHandler(url_proxy.ProxyRequestHandler):
+    """ Handle HTTP requests for the media files and proxied resources registered with the daemon's
+        streaming server """
+
+    def get_filepath(self):
+        if self.path in self.server.proxied:
+            return url_proxy.ProxyRequestHandler.get_filepath(self)
+
+        media = self.server.media.get(self.path)
+        if media is None:
+            return None
+
+        self.content_type = media['content_type']
+        self.transcode = media['transcoder_command'] is not None
+        if self.transcode:
+            self.transcoder_command = media['transcoder_command']
+            self.transcode_options = media['transcode_options']
+            self.bufsize = media['bufsize']
+
+        return media['filepath']
+
+    def send_headers(self, filepath=None):
+        if self.resource is not None:
+            url_proxy.ProxyRequestHandler.send_headers(self, filepath)
+        else:
+            stream2chromecast.RequestHandler.send_headers(self, filepath)
+
+    def write_response(self, filepath):
+        if self.resource is not None:
+            url_proxy.ProxyRequestHandler.write_response(self, filepath)
+        elif self.transcode:
+            stream2chromecast.TranscodingRequestHandler.write_response(self, filepath)
+        else:
+            stream2chromecast.RequestHandler.write_response(self, filepath)
+
+
+class CommandRequestHandler(SocketServer.StreamRequestHandler):
+    """ Handle a single JSON encoded command sent by the command line interface """
+
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline())
+        except ValueError:
+            response = {'error': "invalid request"}
+        else:
+            response = self.server.daemon.execute(request.get('command', ""), request.get('args', {}))
+
+        self.wfile.write(json.dumps(response) + "\n")
+
+
+class CommandServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+
+class Daemon(object):
+    """ carries out the commands for every device using one streaming server and kept-alive device connections """
+
+    def __init__(self, server_port=None, socket_path=SOCKET_PATH, status_max_age=0, discovery_service=False,
+                 stats_interval=None):
+        """ initialise 
+
+            status_max_age - seconds for which a device's reported status is reused to answer status commands
+            discovery_service - keep a live table of the devices on the network in the background
+            stats_interval - seconds between the printed statistics of each stream (None for no statistics)
+        """
+
+        port = 0
+        if server_port is not None:
+            port = int(server_port)
+
+        self.server = stream2chromecast.StreamingServer(("", port), MediaRequestHandler)
+
+        self.socket_path = socket_path
+        self.status_max_age = status_max_age
+        self.discovery_service = discovery_service
+        self.stats_interval = stats_interval
+        self.command_server = None
+        self.stopping = threading.Event()
+
+        self.lock = threading.Lock()
+        self.controllers = {}    # device name -> (CCMediaController, lock)
+        self.device_media = {}   # device host -> url paths registered for the current playback
+        self.mimetypes = {}      # (filepath, mtime, probe command) -> mimetype
+        self.transcoders = {}    # preferred transcoder -> (transcoder command, probe command)
+        self.media_ids = itertools.count(1)
+
+    def get_controller(self, device_name):
+        """ return the connection to a device and the lock serialising its use, connecting if necessary """
+
+        with self.lock:
+            if device_name in self.controllers:
+                return self.controllers[device_name]
+
+        # discovery can be slow, so it is done without holding the lock
+        cast = CCMediaController(device_name=device_name, persistent=True, status_max_age=self.status_max_age)
+
+        with self.lock:
+            return self.controllers.setdefault(device_name, (cast, threading.Lock()))
+
+    def keep_connections(self):
+        """ answer the heartbeats of the devices and record the status they push between commands, so that the
+            device connections stay open and the stored status stays current """
+
+        while not self.stopping.is_set():
+            with self.lock:
+                controllers = self.controllers.values()
+
+            # data already decrypted by the TLS layer isn't seen by select
+            ready = [(cast, lock) for cast, lock in controllers if cast.sock is not None and cast.sock.pending() > 0]
+
+            if len(ready) == 0:
+                socks = dict((cast.sock, (cast, lock)) for cast, lock in controllers if cast.sock is not None)
+                if len(socks) == 0:
+                    self.stopping.wait(KEEPALIVE_INTERVAL)
+                    continue
+
+                try:
+                    readable = select.select(socks.keys(), [], [], KEEPALIVE_INTERVAL)[0]
+                except (select.error, socket.error, ValueError):
+                    # a connection was closed by a command while waiting
+                    continue
+
+                ready = [socks[sock] for sock in readable]
+
+            for cast, lock in ready:
+                # a command in progress reads its own messages, whatever it leaves is handled once it has finished
+                with lock:
+                    cast.read_pending()
+
+    def get_transcoder_cmds(self, preferred_transcoder):
+        """ establish the transcoder to use, remembering the result """
+
+        with self.lock:
+            if preferred_transcoder not in self.transcoders:
+                self.transcoders[preferred_transcoder] = stream2chromecast.get_transcoder_cmds(preferred_transcoder)
+
+            return self.transcoders[preferred_transcoder]
+
+    def get_mimetype(self, filename, probe_cmd):
+        """ find the container format of a file, reusing the result while the file is unchanged """
+
+        key = (filename, os.path.getmtime(filename), probe_cmd)
+
+        if key not in self.mimetypes:
+            self.mimetypes[key] = stream2chromecast.get_mimetype(filename, probe_cmd)
+
+        return self.mimetypes[key]
+
+    def register_media(self, host, filepath, content_type, transcoder_command=None, transcode_options="", bufsize=0):
+        """ make a file available from the streaming server and return its url path """
+
+        path = "/%d/%s" % (next(self.media_ids), urllib.quote(os.path.basename(filepath)))
+
+        self.server.media[path] = {'filepath': filepath,
+                                   'content_type': content_type,
+                                   'transcoder_command': transcoder_command,
+                                   'transcode_options': transcode_options,
+                                   'bufsize': bufsize}
+
+        self.device_media.setdefault(host, []).append(path)
+
+        return path
+
+    def release_media(self, host):
+        """ stop serving the files registered for a device's previous playback """
+
+        for path in self.device_media.pop(host, []):
+            self.server.media.pop(path, None)
+            self.server.subtitles.pop(path, None)
+            self.server.proxied.pop(path, None)
+
+    def play(self, filename, transcode=False, transcoder=None, transcode_options=None,
+             transcode_bufsize=0, device_name=None, server_port=None,
+             subtitles=None, subtitles_port=None, subtitles_language=None, subtitles_track=None,
+             stats_interval=None):
+        """ play a local file (or a file in the library, by title or glob pattern) on the chromecast without
+            waiting for playback to finish - the daemon's own stats interval applies to its streams, and subtitles
+            are served from its streaming server """
+
+        try:
+            filename, entry = stream2chromecast.find_media(filename)
+        except library.LibraryError as e:
+            return {'error': str(e)}
+
+        output = []
+
+        cast, lock = self.get_controller(device_name)
+
+        transcoder_cmd, probe_cmd = self.get_transcoder_cmds(transcoder)
+
+        # files in the library have already been probed
+        if entry is not None:
+            mimetype = entry['mimetype']
+
+            if entry['transcode'] and not transcode:
+                output.append("the library shows the device can't play this file as it is - transcoding it")
+                transcode = True
+        else:
+            mimetype = self.get_mimetype(filename, probe_cmd)
+
+        transcoding = None
+        if transcode:
+            transcoding = stream2chromecast.get_transcoding(transcoder_cmd, transcode_options, transcode_bufsize)
+            if transcoding is None:
+                output.append(stream2chromecast.NO_TRANSCODER)
+
+        if transcoding is not None:
+            mimetype = stream2chromecast.TranscodingRequestHandler.content_type
+
+        with lock:
+            webserver_ip = cast.get_status()['client'][0]
+            base_url = "http://%s:%d" % (webserver_ip, self.server.server_port)
+
+            with self.lock:
+                self.release_media(cast.host)
+                url = base_url + self.register_media(cast.host, filename, mimetype, **(transcoding or {}))
+
+                sub = None
+                if subtitles or subtitles_track is not None:
+                    try:
+                        sub_data = stream2chromecast.get_subtitles(filename, subtitles, subtitles_track,
+                                                                   transcoder_cmd)
+                    except webvtt.SubtitlesError as e:
+                        output.append(str(e))
+                    else:
+                        path = self.server.add_subtitles(sub_data)
+                        self.device_media.setdefault(cast.host, []).append(path)
+                        sub = base_url + path
+
+            output.append("Playing: %s" % filename)
+            output.append("URL & content-type: %s %s" % (url, mimetype))
+
+            cast.load(url, mimetype, sub, subtitles_language)
+
+        return {'output': output}
+
+    def playurl(self, url, device_name=None, proxy=False, cache_size=None, transcode=False, transcoder=None,
+                transcode_options=None, transcode_bufsize=0, server_port=None, stats_interval=None):
+        """ play a remote HTTP resource on the chromecast without waiting for playback to finish - proxied
+            resources are streamed from the daemon's cache """
+
+        if not proxy and not transcode:
+            mimetype = stream2chromecast.get_url_mimetype(url)
+
+            cast, lock = self.get_controller(device_name)
+            with lock:
+                cast.load(url, mimetype, None, None)
+
+            return {'output': ["Playing: %s" % url]}
+
+        output = []
+
+        cache = url_proxy.get_cache(max_bytes=url_proxy.CACHE_SIZE if cache_size is None
+                                    else cache_size * 1024 * 1024)
+        resource = cache.get(url)
+        resource.start()
+
+        cast, lock = self.get_controller(device_name)
+
+        try:
+            resource.wait_for_headers()
+        except url_proxy.ProxyError as e:
+            return {'error': str(e)}
+
+        mimetype = resource.content_type or "video/mp4"
+
+        transcoding = None
+        if transcode:
+            transcoder_cmd, probe_cmd = self.get_transcoder_cmds(transcoder)
+            transcoding = stream2chromecast.get_transcoding(transcoder_cmd, transcode_options, transcode_bufsize)
+            if transcoding is None:
+                output.append(stream2chromecast.NO_TRANSCODER)
+
+        if transcoding is not None:
+            mimetype = stream2chromecast.TranscodingRequestHandler.content_type
+
+        with lock:
+            webserver_ip = cast.get_status()['client'][0]
+
+            with self.lock:
+                self.release_media(cast.host)
+
+                # a transcoded resource is registered twice - as the transcoder's input and its output
+                registered = set(self.server.proxied)
+                path = url_proxy.add_proxied(self.server, resource, **(transcoding or {}))
+                self.device_media.setdefault(cast.host, []).extend(set(self.server.proxied) - registered)
+
+            proxy_url = "http://%s:%d%s" % (webserver_ip, self.server.server_port, path)
+
+            output.append("Playing: %s" % url)
+            output.append("URL & content-type: %s %s" % (proxy_url, mimetype))
+
+            cast.load(proxy_url, mimetype, None, None)
+
+        return {'output': output}
+
+    def control(self, device_name, operation, *args):
+        """ run a CCMediaController operation on a device """
+
+        cast, lock = self.get_controller(device_name)
+        with lock:
+            return {'result': getattr(cast, operation)(*args)}
+
+    def pause(self, device_name=None):
+        return self.control(device_name, "pause")
+
+    def unpause(self, device_name=None):
+        return self.control(device_name, "play")
+
+    def stop(self, device_name=None):
+        return self.control(device_name, "stop")
+
+    def get_status(self, device_name=None):
+        return self.control(device_name, "get_status")
+
+    def volume_up(self, device_name=None):
+        return self.control(device_name, "set_volume_up")
+
+    def volume_down(self, device_name=None):
+        return self.control(device_name, "set_volume_down")
+
+    def set_volume(self, volume, device_name=None):
+        return self.control(device_name, "set_volume", volume)
+
+    def list_devices(self):
+        """ search the network for devices, or list the devices known to the discovery service """
+
+        service = cc_discovery_service.get_service()
+        if service is not None:
+            devices = sorted(service.get_devices(), key=lambda info: info['ip'])
+
+            output = ["%d devices found" % len(devices)]
+            for info in devices:
+                output.append(stream2chromecast.format_device_info(info['ip'], info))
+
+            return {'output': output, 'result': devices}
+
+        device_ips, device_infos = stream2chromecast.discover_devices()
+
+        output = ["%d devices found" % len(device_ips)]
+        for device_ip in device_ips:
+            output.append(stream2chromecast.format_device_info(device_ip, device_infos[device_ip]))
+
+        return {'output': output}
+
+    def shutdown(self):
+        """ stop the daemon once the response has been sent """
+
+        thread = threading.Thread(target=self.command_server.shutdown)
+        thread.daemon = True
+        thread.start()
+
+        return {'output': ["daemon stopping"]}
+
+    def execute(self, command, args):
+        """ run a command received from the command line interface, returning the response to be sent back """
+
+        if command not in COMMANDS:
+            return {'error': "unknown command: %s" % command}
+
+        try:
+            return getattr(self, command)(**args)
+        except SystemExit as e:
+            # the device connection code exits on errors it can't recover from
+            return {'error': str(e.code)}
+        except Exception as e:
+            traceback.print_exc()
+            return {'error': "%s: %s" % (e.__class__.__name__, e)}
+
+    def serve(self):
+        """ run the streaming server and accept commands until shut down """
+
+        if self.discovery_service:
+            cc_discovery_service.start_service()
+
+        if self.stats_interval:
+            stream_metrics.start_reporter(self.stats_interval)
+
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        thread = threading.Thread(target=self.keep_connections)
+        thread.daemon = True
+        thread.start()
+
+        remove_stale_socket(self.socket_path)
+
+        self.command_server = CommandServer(self.socket_path, CommandRequestHandler)
+        self.command_server.daemon = self
+        os.chmod(self.socket_path, stat.S_IRUSR | stat.S_IWUSR)
+
+        print "streaming on port:", self.server.server_port
+        print "metrics at: http://localhost:%d%s" % (self.server.server_port, stream_metrics.METRICS_PATH)
+        print "accepting commands on:", self.socket_path
+
+        try:
+            self.command_server.serve_forever()
+        finally:
+            self.command_server.server_close()
+            os.remove(self.socket_path)
+            self.server.shutdown()
+            self.stopping.set()
+
+            for cast, lock in self.controllers.values():
+                cast.close_socket(force=True)
+
+            cc_discovery_service.stop_service()
+
+
+def make_socket_dir(socket_path):
+    """ create the directory for the socket, readable only by this user, and check no one else can use it """
+
+    socket_dir = os.path.dirname(socket_path)
+    if not os.path.exists(socket_dir):
+        os.mkdir(socket_dir, stat.S_IRWXU)
+
+    if not is_private(socket_dir):
+        raise SystemExit("%s must belong to you and be closed to other users" % socket_dir)
+
+
+def remove_stale_socket(socket_path):
+    """ remove the socket left behind by a daemon which is no longer running """
+
+    make_socket_dir(socket_path)
+
+    sock = connect(socket_path)
+    if sock is not None:
+        sock.close()
+        raise SystemExit("a daemon is already running on %s" % socket_path)
+
+    if os.path.lexists(socket_path):
+        if os.lstat(socket_path).st_uid != os.getuid():
+            raise SystemExit("%s belongs to another user" % socket_path)
+
+        os.remove(socket_path)
+
+
+def run_daemon(server_port=None, status_max_age=0, discovery_service=False, stats_interval=None):
+    """ run the daemon in the foreground """
+
+    Daemon(server_port=server_port, status_max_age=status_max_age, discovery_service=discovery_service,
+           stats_interval=stats_interval).serve()
@@ -0,0 +1,110 @@
+"""
+The command line interface's side of the daemon: finding a running daemon and handing it commands.
+
+Kept apart from the daemon itself so that forwarding a command imports next to nothing.
+
+version 0.1
+
+"""
+
+
+# Copyright (C) 2014-2016 Pat Carter
+#
+# This file is part of Stream2chromecast.
+#
+# Stream2chromecast is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Stream2chromecast is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Stream2chromecast.  If not, see <http://www.gnu.org/licenses/>.
+
+
+
+import json
+import os
+import socket
+import stat
+import tempfile
+
+# the socket is kept in a directory only this user can use, so no one else can take its place
+SOCKET_DIR = os.environ.get("XDG_RUNTIME_DIR") or os.path.join(tempfile.gettempdir(),
+                                                               "stream2chromecast-%d" % os.getuid())
+SOCKET_PATH = os.path.join(SOCKET_DIR, "stream2chromecast.sock")
+
+COMMANDS = ("play", "playurl", "pause", "unpause", "stop", "get_status",
+            "volume_up", "volume_down", "set_volume", "list_devices", "shutdown")
+
+
+def is_private(path):
+    """ whether a file or directory belongs to this user and is closed to everyone else """
+
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return False
+
+    return st.st_uid == os.getuid() and st.st_mode & (stat.S_IRWXG | stat.S_IRWXO) == 0
+
+
+def connect(socket_path=SOCKET_PATH):
+    """ connect to a running daemon, returning None if there isn't one (or the socket isn't this user's own) """
+
+    if not is_private(os.path.dirname(socket_path)) or not is_private(socket_path):
+        return None
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except socket.error:
+        sock.close()
+        return None
+
+    return sock
+
+
+def send_command(command, args, socket_path=SOCKET_PATH):
+    """ send a command to a running daemon and return its response, or None if no daemon is running """
+
+    sock = connect(socket_path)
+    if sock is None:
+        return None
+
+    try:
+        sock.sendall(json.dumps({'command': command, 'args': args}) + "\n")
+        return json.loads(sock.makefile("rb").readline())
+    finally:
+        sock.close()
+
+
+def forward_command(command, args, socket_path=SOCKET_PATH):
+    """ hand a command line command to a running daemon, printing its output - returns False if no daemon is running """
+
+    if command not in COMMANDS:
+        return False
+
+    # the daemon does not share our working directory - a filename which isn't a file is a title in the library
+    for key in ("filename", "subtitles"):
+        if args.get(key) and (key != "filename" or os.path.exists(args[key])):
+            args[key] = os.path.abspath(args[key])
+
+    response = send_command(command, args, socket_path)
+    if response is None:
+        return False
+
+    for line in response.get('output', []):
+        print line
+
+    if response.get('error'):
+        raise SystemExit(response['error'])
+
+    if command == "get_status":
+        print response.get('result')
+
+    return True
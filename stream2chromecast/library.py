@@ -0,0 +1,519 @@
+"""
+An index of the media in a set of directories, so that files can be played by title and without being probed.
+
+The directories added to the library are scanned for media files, which are probed with ffprobe/avprobe in a
+pool of processes: the container's mimetype, the duration, the video & audio codecs, and whether the Chromecast
+can play the file as it is or it must be transcoded. The results are kept in an SQLite database. Scanning again
+only probes the files which are new or have changed since (by size and modification time), and drops those which
+have gone.
+
+play accepts a title or a glob pattern in place of a path, and takes the mimetype and transcoding decision of an
+indexed file from the index instead of probing it.
+
+    stream2chromecast.py library add ~/Videos /mnt/nas/films
+    stream2chromecast.py library scan
+    stream2chromecast.py library list "*bunny*"
+    stream2chromecast.py play "big buck bunny"
+
+version 0.1
+
+"""
+
+
+# Copyright (C) 2014-2016 Pat Carter
+#
+# This file is part of Stream2chromecast.
+#
+# Stream2chromecast is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Stream2chromecast is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Stream2chromecast.  If not, see <http://www.gnu.org/licenses/>.
+
+
+
+import json
+import mimetypes
+import os
+import re
+import subprocess
+import sys
+import time
+
+DB_FILE = "~/.cc_library.db"
+
+# seconds to wait for the database while another process is writing to it
+DB_TIMEOUT = 30
+
+# files probed at once by default, whatever the number of processors
+MIN_JOBS = 4
+
+# probe results written to the database in one transaction while scanning
+COMMIT_EVERY = 100
+
+# extensions of media files which the mimetypes module may not know
+MEDIA_EXTENSIONS = (".mp4", ".m4v", ".mov", ".mkv", ".webm", ".avi", ".mpg", ".mpeg", ".ts", ".m2ts", ".wmv",
+                    ".flv", ".ogv", ".3gp", ".mp3", ".m4a", ".aac", ".ogg", ".oga", ".opus", ".flac", ".wav",
+                    ".wma")
+
+# what the Chromecast plays without transcoding - containers (as named by ffprobe) and codecs
+NATIVE_FORMATS = ("mp4", "mov", "webm", "matroska", "mp3", "ogg", "wav", "flac")
+NATIVE_VIDEO_CODECS = ("h264", "vp8", "vp9")
+NATIVE_AUDIO_CODECS = ("aac", "mp3", "vorbis", "opus", "flac", "pcm_s16le")
+
+GLOB_CHARACTERS = re.compile(r"[*?\[]")
+GLOB_BRACKETS = re.compile(r"(\[[^\]]*\])")
+TITLE_SEPARATORS = re.compile(r"[\s._-]+")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS directories (
+    path TEXT PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS media (
+    path TEXT PRIMARY KEY,
+    directory TEXT NOT NULL,
+    title TEXT NOT NULL,
+    title_key TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    mimetype TEXT NOT NULL,
+    duration REAL,
+    container TEXT,
+    video_codec TEXT,
+    audio_codec TEXT,
+    transcode INTEGER,
+    indexed REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS media_title_key ON media (title_key);
+CREATE INDEX IF NOT EXISTS media_directory ON media (directory);
+"""
+
+COLUMNS = ("path", "directory", "title", "title_key", "size", "mtime", "mimetype", "duration", "container",
+           "video_codec", "audio_codec", "transcode", "indexed")
+
+INSERT_MEDIA = "INSERT OR REPLACE INTO media (%s) VALUES (%s)" % (", ".join(COLUMNS), ", ".join("?" * len(COLUMNS)))
+
+
+class LibraryError(Exception):
+    pass
+
+
+def encode_path(path):
+    """ paths are kept as the filesystem's bytes - those forwarded to the daemon arrive as unicode """
+
+    if isinstance(path, unicode):
+        path = path.encode("utf-8")
+
+    return path
+
+
+def connect(db_file=DB_FILE, create=True):
+    """ open the index - returns None if it doesn't exist and create is False """
+
+    path = os.path.expanduser(db_file)
+
+    if not create and not os.path.exists(path):
+        return None
+
+    # imported here so that playing a file doesn't pay for it when there is no library
+    import sqlite3
+
+    db = sqlite3.connect(path, timeout=DB_TIMEOUT)
+    db.text_factory = str
+    db.row_factory = sqlite3.Row
+    db.executescript(SCHEMA)
+
+    return db
+
+
+def title_key(title):
+    """ titles are matched ignoring case and the separators used in file names """
+
+    return TITLE_SEPARATORS.sub(" ", title.lower()).strip()
+
+
+def pattern_key(pattern):
+    """ title_key for a glob pattern, leaving its bracket expressions alone """
+
+    parts = GLOB_BRACKETS.split(pattern.lower())
+    parts[::2] = [TITLE_SEPARATORS.sub(" ", part) for part in parts[::2]]
+
+    return "".join(parts).strip()
+
+
+def is_media_file(filename):
+    extension = os.path.splitext(filename)[1].lower()
+    if extension in MEDIA_EXTENSIONS:
+        return True
+
+    guess = mimetypes.guess_type(filename)[0]
+
+    return guess is not None and (guess.startswith("video/") or guess.startswith("audio/"))
+
+
+def guess_mimetype(filename):
+    """ the mimetype by the file's extension - the default is video/mp4, as in stream2chromecast.get_mimetype """
+
+    guess = mimetypes.guess_type(filename)[0]
+    if guess is not None and (guess.startswith("video/") or guess.startswith("audio/")):
+        return guess
+
+    return "video/mp4"
+
+
+def needs_transcode(format_names, video_codec, audio_codec):
+    """ whether the Chromecast is unable to play a file with this container and codecs """
+
+    if not any(name in NATIVE_FORMATS for name in format_names):
+        return True
+
+    if video_codec is not None and video_codec not in NATIVE_VIDEO_CODECS:
+        return True
+
+    return audio_codec is not None and audio_codec not in NATIVE_AUDIO_CODECS
+
+
+def probe_file(work):
+    """ probe a media file - work is (path, probe command or None). Runs in the pool's processes, and
+        returns (path, dict of the probed columns) """
+
+    from . import stream2chromecast
+
+    path, probe_cmd = work
+
+    result = {'mimetype': guess_mimetype(path),
+              'duration': None,
+              'container': None,
+              'video_codec': None,
+              'audio_codec': None,
+              'transcode': None}
+
+    if probe_cmd is None:
+        return path, result
+
+    try:
+        process = subprocess.Popen([probe_cmd, "-v", "error", "-show_streams", "-show_format", "-of", "json", path],
+                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        output, errors = process.communicate()
+        info = json.loads(output)
+    except (OSError, ValueError):
+        return path, result
+
+    format_info = info.get("format", {})
+    format_names = [name for name in format_info.get("format_name", "").lower().split(",") if name != ""]
+    if len(format_names) == 0:
+        return path, result
+
+    for stream in info.get("streams", []):
+        # cover art in an audio file shows up as a video stream
+        if stream.get("disposition", {}).get("attached_pic") == 1:
+            continue
+
+        if stream.get("codec_type") == "video" and result['video_codec'] is None:
+            result['video_codec'] = stream.get("codec_name")
+        elif stream.get("codec_type") == "audio" and result['audio_codec'] is None:
+            result['audio_codec'] = stream.get("codec_name")
+
+    try:
+        result['duration'] = float(format_info.get("duration"))
+    except (TypeError, ValueError):
+        pass
+
+    result['container'] = ",".join(format_names)
+    result['mimetype'] = stream2chromecast.format_mimetype(format_names, result['video_codec'] is not None)
+    result['transcode'] = int(needs_transcode(format_names, result['video_codec'], result['audio_codec']))
+
+    return path, result
+
+
+def walk_media(directory):
+    """ yields the path and os.stat of each media file under a directory, skipping hidden files """
+
+    for root, dirs, files in os.walk(directory):
+        dirs[:] = [name for name in dirs if not name.startswith(".")]
+
+        for name in files:
+            if name.startswith(".") or not is_media_file(name):
+                continue
+
+            path = os.path.join(root, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+
+            yield path, stat
+
+
+def probe_all(work, jobs):
+    """ yields the results of probe_file for each item of work, probing in a pool of processes """
+
+    if jobs <= 1 or len(work) <= 1 or work[0][1] is None:
+        for item in work:
+            yield probe_file(item)
+        return
+
+    import multiprocessing
+
+    pool = multiprocessing.Pool(min(jobs, len(work)))
+    try:
+        for result in pool.imap_unordered(probe_file, work):
+            yield result
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def scan_directory(db, directory, probe_cmd=None, jobs=1):
+    """ bring the index of a directory up to date - returns the counts of files added, updated, removed and
+        unchanged """
+
+    indexed = {}
+    for row in db.execute("SELECT path, size, mtime FROM media WHERE directory = ?", (directory,)):
+        indexed[row['path']] = (row['size'], row['mtime'])
+
+    counts = {'added': 0, 'updated': 0, 'removed': 0, 'unchanged': 0}
+    found = {}
+    work = []
+
+    for path, stat in walk_media(directory):
+        found[path] = stat
+
+        if path not in indexed:
+            counts['added'] += 1
+        elif indexed[path] != (stat.st_size, stat.st_mtime):
+            counts['updated'] += 1
+        else:
+            counts['unchanged'] += 1
+            continue
+
+        work.append((path, probe_cmd))
+
+    gone = [path for path in indexed if path not in found]
+    counts['removed'] = len(gone)
+    db.executemany("DELETE FROM media WHERE path = ?", [(path,) for path in gone])
+
+    for count, (path, result) in enumerate(probe_all(work, jobs), 1):
+        stat = found[path]
+        title = os.path.splitext(os.path.basename(path))[0]
+
+        row = dict(result, path=path, directory=directory, title=title, title_key=title_key(title),
+                   size=stat.st_size, mtime=stat.st_mtime, indexed=time.time())
+        db.execute(INSERT_MEDIA, [row[column] for column in COLUMNS])
+
+        # keep what has been probed so far if the scan is interrupted
+        if count % COMMIT_EVERY == 0:
+            db.commit()
+
+    db.commit()
+
+    return counts
+
+
+def get_directories(db):
+    return [row['path'] for row in db.execute("SELECT path FROM directories ORDER BY path")]
+
+
+def find_all(db, name):
+    """ the index entries matching a title or glob pattern - a pattern containing a / is matched against the
+        whole path, otherwise against the title """
+
+    name = encode_path(name)
+
+    if GLOB_CHARACTERS.search(name) is not None:
+        if "/" in name:
+            rows = db.execute("SELECT * FROM media WHERE path GLOB ? ORDER BY path", (name,))
+        else:
+            rows = db.execute("SELECT * FROM media WHERE title_key GLOB ? ORDER BY path", (pattern_key(name),))
+
+        return [dict(row) for row in rows]
+
+    rows = db.execute("SELECT * FROM media WHERE title_key = ? ORDER BY path", (title_key(name),)).fetchall()
+
+    if len(rows) == 0:
+        pattern = "%" + title_key(name).replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+        rows = db.execute("SELECT * FROM media WHERE title_key LIKE ? ESCAPE '\\' ORDER BY path", (pattern,))
+
+    return [dict(row) for row in rows]
+
+
+def is_current(entry):
+    """ whether the indexed file is still there and unchanged """
+
+    try:
+        stat = os.stat(entry['path'])
+    except OSError:
+        return False
+
+    return (stat.st_size, stat.st_mtime) == (entry['size'], entry['mtime'])
+
+
+def find(name, db_file=DB_FILE):
+    """ the index entry of the file a title or glob pattern refers to. A title must match a single file - a
+        pattern matching several refers to the first in path order. Raises LibraryError if there is none """
+
+    db = connect(db_file, create=False)
+    if db is None:
+        raise LibraryError("media file %s not found" % name)
+
+    try:
+        entries = [entry for entry in find_all(db, name) if os.path.isfile(entry['path'])]
+    finally:
+        db.close()
+
+    if len(entries) == 0:
+        raise LibraryError("media file %s not found" % name)
+
+    if len(entries) > 1 and GLOB_CHARACTERS.search(encode_path(name)) is None:
+        paths = "\n".join("    %s" % entry['path'] for entry in entries[:10])
+        more = "\n    ... %d more" % (len(entries) - 10) if len(entries) > 10 else ""
+        raise LibraryError("%d files in the library match %s:\n%s%s" % (len(entries), name, paths, more))
+
+    return entries[0]
+
+
+def get_entry(filepath, db_file=DB_FILE):
+    """ the index entry of a file if it is indexed and hasn't changed since, otherwise None """
+
+    db = connect(db_file, create=False)
+    if db is None:
+        return None
+
+    try:
+        row = db.execute("SELECT * FROM media WHERE path = ?", (encode_path(filepath),)).fetchone()
+    finally:
+        db.close()
+
+    if row is None or not is_current(dict(row)):
+        return None
+
+    return dict(row)
+
+
+# Commands
+
+def default_jobs():
+    """ probing mostly waits on the disk (or the network, for a share), so a few run at once even on one
+        processor """
+
+    import multiprocessing
+
+    try:
+        return max(multiprocessing.cpu_count(), MIN_JOBS)
+    except NotImplementedError:
+        return MIN_JOBS
+
+
+def scan_directories(db, directories, transcoder=None, jobs=None):
+    from . import stream2chromecast
+
+    probe_cmd = stream2chromecast.get_transcoder_cmds(preferred_transcoder=transcoder)[1]
+    if probe_cmd is None:
+        print "ffprobe/avprobe is not installed - files are indexed by their extension and not probed"
+
+    if jobs is None:
+        jobs = default_jobs()
+
+    for directory in directories:
+        start = time.time()
+        counts = scan_directory(db, directory, probe_cmd, jobs)
+
+        print "%s: %d added, %d updated, %d removed, %d unchanged (%.1fs)" % (
+            directory, counts['added'], counts['updated'], counts['removed'], counts['unchanged'],
+            time.time() - start)
+
+
+def add_directories(directories, transcoder=None, jobs=None):
+    """ add directories to the library and index them """
+
+    paths = []
+    for directory in directories:
+        if not os.path.isdir(directory):
+            sys.exit("directory %s not found" % directory)
+
+        paths.append(os.path.abspath(encode_path(directory)))
+
+    db = connect()
+    try:
+        db.executemany("INSERT OR IGNORE INTO directories (path) VALUES (?)", [(path,) for path in paths])
+        db.commit()
+
+        scan_directories(db, paths, transcoder, jobs)
+    finally:
+        db.close()
+
+
+def remove_directories(directories):
+    """ remove directories and their files from the library """
+
+    db = connect()
+    try:
+        for directory in directories:
+            path = os.path.abspath(encode_path(directory))
+
+            if db.execute("DELETE FROM directories WHERE path = ?", (path,)).rowcount == 0:
+                print "%s is not in the library" % path
+                continue
+
+            removed = db.execute("DELETE FROM media WHERE directory = ?", (path,)).rowcount
+            print "%s: %d files removed" % (path, removed)
+
+        db.commit()
+    finally:
+        db.close()
+
+
+def scan(transcoder=None, jobs=None):
+    """ bring the index of every directory in the library up to date """
+
+    db = connect()
+    try:
+        directories = get_directories(db)
+        if len(directories) == 0:
+            sys.exit("the library is empty - add directories with: library add DIRECTORY")
+
+        scan_directories(db, directories, transcoder, jobs)
+    finally:
+        db.close()
+
+
+def format_duration(seconds):
+    if seconds is None:
+        return "?"
+
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+
+    return "%d:%02d:%02d" % (hours, minutes, seconds)
+
+
+def list_media(pattern=None):
+    """ list the library's directories and files - or those matching a title or glob pattern """
+
+    db = connect()
+    try:
+        if pattern is None:
+            for directory in get_directories(db):
+                print "directory:", directory
+            print
+
+            entries = [dict(row) for row in db.execute("SELECT * FROM media ORDER BY path")]
+        else:
+            entries = find_all(db, pattern)
+    finally:
+        db.close()
+
+    transcode_flags = {None: "?", 0: "", 1: "transcode"}
+
+    for entry in entries:
+        print "%-40s %9s %-12s %-9s %s" % (entry['title'], format_duration(entry['duration']), entry['mimetype'],
+                                           transcode_flags[entry['transcode']], entry['path'])
+
+    print "%d files" % len(entries)
@@ -0,0 +1,225 @@
+"""
+Reads media files ahead of the streaming server, so that slow storage (such as NFS or SMB shares) doesn't stall
+the stream.
+
+A Prefetcher reads the file in a background thread into a bounded buffer, which the request thread empties as the
+client takes the data. The kernel is told that the file will be read sequentially, and the range about to be read
+is passed to it as a readahead hint. The size of the buffer - the read-ahead window - adapts to the storage: it
+grows whenever a read is slow, so that the next latency spike is covered, and shrinks back slowly while reads
+are fast.
+
+version 0.1
+
+"""
+
+
+# Copyright (C) 2014-2016 Pat Carter
+#
+# This file is part of Stream2chromecast.
+#
+# Stream2chromecast is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Stream2chromecast is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Stream2chromecast.  If not, see <http://www.gnu.org/licenses/>.
+
+
+
+import collections
+import os
+import threading
+import time
+
+# amount read from the file in one go
+BLOCK_SIZE = 65536
+
+# bounds of the read-ahead window (bytes)
+INITIAL_WINDOW = 2 * 1024 * 1024
+MIN_WINDOW = 512 * 1024
+MAX_WINDOW = 64 * 1024 * 1024
+
+# a read taking longer than this (seconds) is a latency spike, and doubles the window
+SLOW_READ = 0.05
+
+# fast reads in a row after which the window is shrunk by an eighth
+SHRINK_AFTER = 256
+
+POSIX_FADV_SEQUENTIAL = 2
+POSIX_FADV_WILLNEED = 3
+
+# the first bytes of the ISO base media (MP4/MOV) boxes a file can start with - these files may need their end
+# to be read before their start, so can't be fed to the transcoder as a stream
+ISO_BOX_TYPES = ("ftyp", "moov", "mdat", "free", "skip", "wide", "pnot")
+
+_fadvise = None
+
+
+def _load_fadvise():
+    """ returns a function passing advice about a file's access pattern to the kernel, which does nothing on
+        platforms without posix_fadvise """
+
+    import ctypes
+    import ctypes.util
+
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        posix_fadvise = getattr(libc, "posix_fadvise64", None) or libc.posix_fadvise
+        posix_fadvise.argtypes = [ctypes.c_int, ctypes.c_longlong, ctypes.c_longlong, ctypes.c_int]
+    except (OSError, AttributeError):
+        return lambda fd, offset, length, advice: None
+
+    def fadvise(fd, offset, length, advice):
+        posix_fadvise(fd, offset, length, advice)
+
+    return fadvise
+
+
+def advise(fd, offset, length, advice):
+    """ posix_fadvise - the hint is only advice, so errors are ignored """
+
+    global _fadvise
+
+    if _fadvise is None:
+        _fadvise = _load_fadvise()
+
+    _fadvise(fd, offset, length, advice)
+
+
+def is_streamable(filepath):
+    """ whether a file can be read from start to end by the transcoder, so may be fed to it through a pipe """
+
+    try:
+        with open(filepath, "rb") as f:
+            header = f.read(8)
+    except IOError:
+        return False
+
+    return header[4:8] not in ISO_BOX_TYPES
+
+
+class Prefetcher(object):
+    """ reads a file ahead of its consumer in a background thread """
+
+    def __init__(self, filepath, offset=0, block_size=BLOCK_SIZE):
+        self.file = open(filepath, "rb")
+        self.file.seek(offset)
+        self.fd = self.file.fileno()
+        self.block_size = block_size
+
+        self.cond = threading.Condition()
+        self.blocks = collections.deque()
+        self.buffered = 0       # bytes read ahead, not yet taken by the consumer
+        self.window = INITIAL_WINDOW
+        self.position = offset  # position in the file of the next read
+        self.hinted = offset    # end of the range last passed to the kernel as a readahead hint
+        self.eof = False
+        self.error = None
+        self.closed = False
+
+        # statistics
+        self.read_latency = 0.0  # smoothed time taken by a read (seconds)
+        self.slow_reads = 0
+        self.consumer_waits = 0  # times the consumer found the buffer empty
+        self.fast_reads = 0
+
+        advise(self.fd, offset, 0, POSIX_FADV_SEQUENTIAL)
+
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        try:
+            while True:
+                with self.cond:
+                    while self.buffered >= self.window and not self.closed:
+                        self.cond.wait()
+
+                    if self.closed:
+                        return
+
+                    window = self.window
+
+                # keep the kernel's readahead a window ahead of the reads
+                if self.position + window // 2 > self.hinted:
+                    advise(self.fd, self.position, window, POSIX_FADV_WILLNEED)
+                    self.hinted = self.position + window
+
+                start = time.time()
+                data = self.file.read(self.block_size)
+                self.adapt(time.time() - start)
+
+                with self.cond:
+                    if self.closed:
+                        return
+
+                    if len(data) == 0:
+                        self.eof = True
+                        self.cond.notify_all()
+                        return
+
+                    self.blocks.append(data)
+                    self.buffered += len(data)
+                    self.position += len(data)
+                    self.cond.notify_all()
+        except (IOError, OSError) as e:
+            with self.cond:
+                self.error = e
+                self.cond.notify_all()
+        finally:
+            self.file.close()
+
+    def adapt(self, latency):
+        """ resize the window after a read which took latency seconds """
+
+        self.read_latency = self.read_latency * 0.8 + latency * 0.2
+
+        with self.cond:
+            if latency > SLOW_READ:
+                self.slow_reads += 1
+                self.fast_reads = 0
+                self.window = min(self.window * 2, MAX_WINDOW)
+            else:
+                self.fast_reads += 1
+                if self.fast_reads >= SHRINK_AFTER:
+                    self.fast_reads = 0
+                    self.window = max(self.window - self.window // 8, MIN_WINDOW)
+
+            self.cond.notify_all()
+
+    def read(self):
+        """ the next block of the file - an empty string at the end, or once closed """
+
+        with self.cond:
+            if len(self.blocks) == 0 and not self.eof and self.error is None and not self.closed:
+                self.consumer_waits += 1
+
+            while len(self.blocks) == 0 and not self.eof and self.error is None and not self.closed:
+                self.cond.wait()
+
+            if len(self.blocks) == 0:
+                if self.error is not None:
+                    raise self.error
+                return ""
+
+            data = self.blocks.popleft()
+            self.buffered -= len(data)
+            self.cond.notify_all()
+
+        return data
+
+    def close(self):
+        """ stop reading ahead """
+
+        with self.cond:
+            self.closed = True
+            self.blocks.clear()
+            self.buffered = 0
+            self.cond.notify_all()
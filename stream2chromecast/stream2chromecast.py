@@ -30,9 +30,8 @@ version: 0.6.2
 VERSION = "0.6.2"
 
 
-import argparse
 import BaseHTTPServer
-import httplib
+import itertools
 import mimetypes
 import os
 import signal
@@ -41,33 +40,70 @@ import sys
 import tempfile
 import time
 import urllib
-import urlparse
 import socket
+import SocketServer
 import errno
 from threading import Thread
 
 from . import cc_device_finder
+from . import library
+from . import prefetch
+from . import stream_metrics
+from . import timing
+from . import transcode_session
+from . import webvtt
 from .cc_media_controller import CCMediaController
+from .cli import parse_args, run
+from .controls import get_status, pause, set_volume, stop, unpause, volume_down, volume_up, watch
 
 PIDFILE = os.path.join(tempfile.gettempdir(), "stream2chromecast_%s.pid") 
 
-FFMPEG = 'ffmpeg -i "%s" -preset ultrafast -f mp4 -frag_duration 3000 -b:v 2000k -loglevel error %s -'
+NO_TRANSCODER = "No transcoder is installed. Attempting standard playback"
+
+FFMPEG = 'ffmpeg -i "%s" -preset ultrafast -f mp4 -frag_duration 3000 -b:v 2000k -loglevel error -nostats -progress pipe:2 %s -'
 AVCONV = 'avconv -i "%s" -preset ultrafast -f mp4 -frag_duration 3000 -b:v 2000k -loglevel error %s -'
 
 
 class RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
     content_type = "video/mp4"
+    suppress_socket_error_report = None
 
     """ Handle HTTP requests for files which do not need transcoding """
 
+    def get_filepath(self):
+        """ map the requested path to the file to be sent - only the files registered with the server are
+            served """
+
+        media = self.server.media.get(self.path)
+        if media is None:
+            return None
+
+        return media['filepath']
+
     def do_GET(self):
-        filepath = urllib.unquote_plus(self.path)
+        if self.path == stream_metrics.METRICS_PATH:
+            self.send_metrics()
+            return
+
+        subtitles = getattr(self.server, "subtitles", {}).get(self.path)
+        if subtitles is not None:
+            self.send_subtitles(subtitles)
+            return
+
+        filepath = self.get_filepath()
+        if filepath is None:
+            self.send_error(404)
+            return
+
+        timing.mark("media_request", path=self.path)
         
         self.suppress_socket_error_report = None
 
         self.send_headers(filepath)
 
         print "sending file"
+        self.stream = stream_metrics.start_stream(self.path, self.client_address[0])
+        disconnected = False
         try:
             self.write_response(filepath)
         except socket.error, e:
@@ -75,9 +111,55 @@ class RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
                 if e[0] in (errno.EPIPE, errno.ECONNRESET):
                    print "disconnected"
                    self.suppress_socket_error_report = True
+                   disconnected = True
                    return
 
             raise
+        finally:
+            stream_metrics.end_stream(self.stream, disconnected)
+
+    def send_metrics(self):
+        """ send the streaming statistics in the Prometheus text format """
+
+        body = stream_metrics.format_metrics()
+
+        self.send_response(200)
+        self.send_header("Content-type", stream_metrics.CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_OPTIONS(self):
+        """ answer the CORS preflight the receiver may make before fetching subtitles """
+
+        self.keep_alive()
+        self.send_response(200)
+        self.send_cors_headers()
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def send_subtitles(self, data):
+        """ send a WebVTT document - the connection is kept open, as the receiver may fetch it again """
+
+        self.keep_alive()
+        self.send_response(200)
+        self.send_header("Content-type", webvtt.CONTENT_TYPE)
+        self.send_cors_headers()
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def keep_alive(self):
+        """ respond with HTTP/1.1, leaving the connection open for the client's next request """
+
+        self.protocol_version = "HTTP/1.1"
+        if self.request_version == "HTTP/1.1" and self.headers.get("Connection", "").lower() != "close":
+            self.close_connection = 0
+
+    def send_cors_headers(self):
+        self.send_header("Access-Control-Allow-Origin", "*")
+        self.send_header("Access-Control-Allow-Methods", "GET, OPTIONS")
+        self.send_header("Access-Control-Allow-Headers", "Content-Type")
 
 
     def handle_one_request(self):
@@ -103,18 +185,31 @@ class RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
         self.send_header("Transfer-Encoding", "chunked")
         self.end_headers()
 
+    def write_chunk(self, data):
+        """ write a block of data using the chunked transfer encoding """
+        start = time.time()
+
+        chunk_size = "%0.2X" % len(data)
+        self.wfile.write(chunk_size)
+        self.wfile.write("\r\n")
+        self.wfile.write(data)
+        self.wfile.write("\r\n")
+
+        self.stream.record_write(len(data), time.time() - start)
+
     def write_response(self, filepath):
-        with open(filepath, "rb") as f:
+        # the file is read ahead in another thread, so that slow storage doesn't hold up the client
+        prefetcher = prefetch.Prefetcher(filepath)
+        self.stream.prefetcher = prefetcher
+        try:
             while True:
-                line = f.read(1024)
-                if len(line) == 0:
+                data = prefetcher.read()
+                if len(data) == 0:
                     break
 
-                chunk_size = "%0.2X" % len(line)
-                self.wfile.write(chunk_size)
-                self.wfile.write("\r\n")
-                self.wfile.write(line)
-                self.wfile.write("\r\n")
+                self.write_chunk(data)
+        finally:
+            prefetcher.close()
 
         self.wfile.write("0")
         self.wfile.write("\r\n\r\n")
@@ -130,28 +225,56 @@ class TranscodingRequestHandler(RequestHandler):
         if self.bufsize != 0:
             print "transcode buffer size:", self.bufsize
         
-        ffmpeg_command = self.transcoder_command % (filepath, self.transcode_options) 
-        
-        ffmpeg_process = subprocess.Popen(ffmpeg_command, stdout=subprocess.PIPE, shell=True, bufsize=self.bufsize)       
+        # files which the transcoder can read from start to end are read ahead and fed to it through a pipe
+        input_path = None
+        if os.path.isfile(filepath) and prefetch.is_streamable(filepath):
+            input_path = filepath
+            ffmpeg_command = self.transcoder_command % ("pipe:0", self.transcode_options)
+        else:
+            ffmpeg_command = self.transcoder_command % (filepath, self.transcode_options)
 
-        for line in ffmpeg_process.stdout:
-            chunk_size = "%0.2X" % len(line)
-            self.wfile.write(chunk_size)
-            self.wfile.write("\r\n")
-            self.wfile.write(line)
-            self.wfile.write("\r\n")
+        # clients requesting the same file with the same options share one transcoder process
+        session = transcode_session.attach(ffmpeg_command, self.bufsize, input_path)
+        self.stream.transcode_session = session
+        try:
+            reader = session.reader()
+            try:
+                for line in reader:
+                    self.write_chunk(line)
+            finally:
+                # the transcoder is held back until every reader has moved on or closed
+                reader.close()
+        finally:
+            transcode_session.detach(session)
 
         self.wfile.write("0")
         self.wfile.write("\r\n\r\n")
 
 
 
-class SubRequestHandler(RequestHandler):
-    """ Handle HTTP requests for subtitles files """
-    content_type = "text/vtt;charset=utf-8"
+class StreamingServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """ HTTP server handling each media request in its own thread, so several clients can stream at once """
+    daemon_threads = True
+
+    def __init__(self, server_address, RequestHandlerClass):
+        BaseHTTPServer.HTTPServer.__init__(self, server_address, RequestHandlerClass)
+
+        self.media = {}      # url path -> the media served there: its 'filepath' and how it is sent
+        self.subtitles = {}  # url path -> WebVTT document
+        self.subtitles_ids = itertools.count(1)
+        self.proxied = {}    # url path -> remote resource served from the cache (see url_proxy)
+
+    def add_subtitles(self, data):
+        """ serve a WebVTT document and return its url path """
 
+        path = "/subtitles/%d.vtt" % next(self.subtitles_ids)
+        self.subtitles[path] = data
 
+        return path
 
+
+
+@timing.timed()
 def get_transcoder_cmds(preferred_transcoder=None):
     """ establish which transcoder utility to use depending on what is installed """
     probe_cmd = None
@@ -183,6 +306,20 @@ def get_transcoder_cmds(preferred_transcoder=None):
     return transcoder_cmd, probe_cmd
 
 
+def get_transcoding(transcoder_cmd, transcode_options=None, transcode_bufsize=0):
+    """ how media is transcoded with transcoder_cmd (as found by get_transcoder_cmds) - the transcoder_command,
+        transcode_options and bufsize of TranscodingRequestHandler, which are also the keyword arguments of
+        url_proxy.add_proxied and the daemon's register_media. None if no transcoder is installed """
+
+    commands = {'ffmpeg': FFMPEG, 'avconv': AVCONV}
+    if transcoder_cmd not in commands:
+        return None
+
+    return {'transcoder_command': commands[transcoder_cmd],
+            'transcode_options': transcode_options or "",
+            'bufsize': transcode_bufsize}
+
+
 def is_transcoder_installed(transcoder_application):
     """ check for an installation of either ffmpeg or avconv """
     try:
@@ -210,6 +347,7 @@ def save_pid(device_ip):
         pidfile.write("%d" % os.getpid())
 
 
+@timing.timed()
 def get_mimetype(filename, ffprobe_cmd=None):
     """ find the container format of the file """
     # default value
@@ -259,6 +397,12 @@ def get_mimetype(filename, ffprobe_cmd=None):
     if format_name is None:
         return mimetype
 
+    return format_mimetype(format_name, has_video)
+
+
+def format_mimetype(format_name, has_video):
+    """ the mimetype of a container - format_name is the list of names ffprobe/avprobe gives for it """
+
     if has_video:
         mimetype = "video/"
     else:
@@ -281,17 +425,19 @@ def get_mimetype(filename, ffprobe_cmd=None):
     
             
             
+@timing.timed()
 def play(filename, transcode=False, transcoder=None, transcode_options=None,
          transcode_bufsize=0, device_name=None, server_port=None,
-         subtitles=None, subtitles_port=None, subtitles_language=None):
-    """ play a local file on the chromecast """
+         subtitles=None, subtitles_port=None, subtitles_language=None, subtitles_track=None, stats_interval=None):
+    """ play a local file on the chromecast - filename may also be the title of a file in the library, or a
+        glob pattern matching one """
 
     print_ident()
 
-    if os.path.isfile(filename):
-        filename = os.path.abspath(filename)
-    else:
-        sys.exit("media file %s not found" % filename)
+    try:
+        filename, entry = find_media(filename)
+    except library.LibraryError as e:
+        sys.exit(str(e))
 
     cast = CCMediaController(device_name=device_name)
 
@@ -302,7 +448,15 @@ def play(filename, transcode=False, transcoder=None, transcode_options=None,
 
     transcoder_cmd, probe_cmd = get_transcoder_cmds(preferred_transcoder=transcoder)
 
-    mimetype = get_mimetype(filename, probe_cmd)
+    # files in the library have already been probed
+    if entry is not None:
+        mimetype = entry['mimetype']
+
+        if entry['transcode'] and not transcode:
+            print "the library shows the device can't play this file as it is - transcoding it"
+            transcode = True
+    else:
+        mimetype = get_mimetype(filename, probe_cmd)
 
     status = cast.get_status()
     webserver_ip = status['client'][0]
@@ -311,65 +465,95 @@ def play(filename, transcode=False, transcoder=None, transcode_options=None,
 
     req_handler = RequestHandler
 
+    transcoding = None
     if transcode:
-        if transcoder_cmd in ("ffmpeg", "avconv"):
-            req_handler = TranscodingRequestHandler
-            
-            if transcoder_cmd == "ffmpeg":  
-                req_handler.transcoder_command = FFMPEG
-            else:
-                req_handler.transcoder_command = AVCONV
-                
-            if transcode_options is not None:    
-                req_handler.transcode_options = transcode_options
-                
-            req_handler.bufsize = transcode_bufsize
-        else:
-            print "No transcoder is installed. Attempting standard playback"
-            req_handler.content_type = mimetype    
+        transcoding = get_transcoding(transcoder_cmd, transcode_options, transcode_bufsize)
+        if transcoding is None:
+            print NO_TRANSCODER
+
+    if transcoding is not None:
+        req_handler = TranscodingRequestHandler
+
+        for name, value in transcoding.items():
+            setattr(req_handler, name, value)
     else:
         req_handler.content_type = mimetype    
         
     
-    # create a webserver to handle a single request for the media file on either a free port or on a specific port if passed in the port parameter   
+    # create a webserver to handle requests for the media file on either a free port or on a specific port if passed in the port parameter   
     port = 0    
     
     if server_port is not None:
         port = int(server_port)
 
-    server = BaseHTTPServer.HTTPServer((webserver_ip, port), req_handler)
+    with timing.span("start_server"):
+        server = StreamingServer((webserver_ip, port), req_handler)
 
-    thread = Thread(target=server.handle_request)
-    thread.start()
+        thread = Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
 
-    url = "http://%s:%s/%s" % (webserver_ip, str(server.server_port), urllib.quote_plus(filename, "/"))
+    path = "/" + urllib.quote_plus(filename, "/")
+    server.media[path] = {'filepath': filename}
 
-    print "URL & content-type: ", url, req_handler.content_type
+    url = "http://%s:%s%s" % (webserver_ip, str(server.server_port), path)
 
+    if stats_interval:
+        stream_metrics.start_reporter(stats_interval)
 
-    # create another webserver to handle a request for the subtitles file, if specified in the subtitles parameter
-    sub = None
+    print "URL & content-type: ", url, req_handler.content_type
 
-    if subtitles:
-        if os.path.isfile(subtitles):
-            sub_port = 0
 
-            if subtitles_port is not None:
-                sub_port = int(subtitles_port)
+    # serve the subtitles, if specified in the subtitles or subtitles_track parameters, from the same webserver
+    sub = None
 
-            sub_server = BaseHTTPServer.HTTPServer((webserver_ip, sub_port), SubRequestHandler)
-            thread2 = Thread(target=sub_server.handle_request)
-            thread2.start()
+    if subtitles_port is not None:
+        print "the subtitles port is no longer used - subtitles are served from port", server.server_port
 
-            sub = "http://%s:%s%s" % (webserver_ip, str(sub_server.server_port), urllib.quote_plus(subtitles, "/"))
-            print "sub URL: ", sub
+    if subtitles or subtitles_track is not None:
+        try:
+            sub_data = get_subtitles(filename, subtitles, subtitles_track, transcoder_cmd)
+        except webvtt.SubtitlesError as e:
+            print e
         else:
-            print "Subtitles file %s not found" % subtitles
+            sub = "http://%s:%s%s" % (webserver_ip, str(server.server_port), server.add_subtitles(sub_data))
+            print "sub URL: ", sub
 
 
     load(cast, url, req_handler.content_type, sub, subtitles_language)
 
 
+def find_media(filename):
+    """ the path of the file to play and its library entry (None if it isn't indexed or has changed since) -
+        a filename which isn't an existing file is looked up in the library by title or glob pattern. Raises
+        library.LibraryError if it isn't found """
+
+    with timing.span("library_lookup"):
+        if os.path.isfile(filename):
+            filename = os.path.abspath(filename)
+            return filename, library.get_entry(filename)
+
+        entry = library.find(filename)
+
+        return entry['path'], entry
+
+
+def get_subtitles(filename, subtitles=None, subtitles_track=None, transcoder_cmd=None):
+    """ the subtitles for a media file as a WebVTT document: the subtitles file (WebVTT, SRT or ASS/SSA), or the
+        subtitle track embedded in the media file - raises webvtt.SubtitlesError if they can't be had """
+
+    try:
+        if subtitles_track is not None:
+            return webvtt.get_webvtt(filename, subtitles_track, transcoder_cmd)
+
+        if not os.path.isfile(subtitles):
+            raise webvtt.SubtitlesError("Subtitles file %s not found" % subtitles)
+
+        return webvtt.get_webvtt(subtitles)
+    except (IOError, OSError) as e:
+        raise webvtt.SubtitlesError("unable to read subtitles: %s" % e)
+
+
 def load(cast, url, mimetype, sub=None, sub_language=None):
     """ load a chromecast instance with a url and wait for idle state """
     try:
@@ -380,10 +564,8 @@ def load(cast, url, mimetype, sub=None, sub_language=None):
         # wait for playback to complete before exiting
         print "waiting for player to finish - press ctrl-c to stop..."
 
-        idle = False
-        while not idle:
-            time.sleep(1)
-            idle = cast.is_idle()
+        with timing.span("wait_until_idle"):
+            cast.wait_until_idle()
 
     except KeyboardInterrupt:
         print
@@ -394,95 +576,156 @@ def load(cast, url, mimetype, sub=None, sub_language=None):
         print "done"
 
 
-def playurl(url, device_name=None):
-    """ play a remote HTTP resource on the chromecast """
+@timing.timed()
+def playurl(url, device_name=None, proxy=False, cache_size=None, transcode=False, transcoder=None,
+            transcode_options=None, transcode_bufsize=0, server_port=None, stats_interval=None):
+    """ play a remote HTTP resource on the chromecast - with proxy, the resource is downloaded into a local cache
+        and streamed to the device from there (transcoded if transcode is set) """
 
     print_ident()
 
-    url_parsed = urlparse.urlparse(url)
+    if not proxy and not transcode:
+        mimetype = get_url_mimetype(url)
 
-    scheme = url_parsed.scheme
-    host = url_parsed.netloc
-    path = url.split(host, 1)[-1]
+        cast = CCMediaController(device_name=device_name)
+        load(cast, url, mimetype)
+        return
 
-    conn = None
-    if scheme == "https":
-        conn = httplib.HTTPSConnection(host)
-    else:
-        conn = httplib.HTTPConnection(host)
+    from . import url_proxy
 
-    conn.request("HEAD", path)
+    cache = url_proxy.get_cache(max_bytes=url_proxy.CACHE_SIZE if cache_size is None else cache_size * 1024 * 1024)
+    resource = cache.get(url)
 
-    resp = conn.getresponse()
+    # start downloading while the device is found
+    resource.start()
 
-    if resp.status != 200:
-        sys.exit("HTTP error:" + resp.status + " - " + resp.reason)
+    cast = CCMediaController(device_name=device_name)
 
-    print "Found HTTP resource"
+    kill_old_pid(cast.host)
+    save_pid(cast.host)
 
-    headers = resp.getheaders()
+    webserver_ip = cast.get_status()['client'][0]
 
-    mimetype = None
+    try:
+        resource.wait_for_headers()
+    except url_proxy.ProxyError as e:
+        sys.exit(str(e))
 
-    for header in headers:
-        if len(header) > 1:
-            if header[0].lower() == "content-type":
-                mimetype = header[1]
+    mimetype = resource.content_type or "video/mp4"
+    print "content-type:", mimetype
+    if resource.complete:
+        print "playing from the cache"
 
-    if mimetype != None:
-        print "content-type:", mimetype
-    else:
-        mimetype = "video/mp4"
-        print "resource does not specify mimetype - using default:", mimetype
+    transcoding = None
+    if transcode:
+        transcoder_cmd, probe_cmd = get_transcoder_cmds(preferred_transcoder=transcoder)
+        transcoding = get_transcoding(transcoder_cmd, transcode_options, transcode_bufsize)
+        if transcoding is None:
+            print NO_TRANSCODER
 
-    cast = CCMediaController(device_name=device_name)
-    load(cast, url, mimetype)
+    if transcoding is not None:
+        mimetype = TranscodingRequestHandler.content_type
 
+    port = 0
+    if server_port is not None:
+        port = int(server_port)
 
-def pause(device_name=None):
-    """ pause playback """
-    CCMediaController(device_name=device_name).pause()
+    with timing.span("start_server"):
+        server = StreamingServer((webserver_ip, port), url_proxy.ProxyRequestHandler)
 
+        thread = Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
 
-def unpause(device_name=None):
-    """ continue playback """
-    CCMediaController(device_name=device_name).play()
+    path = url_proxy.add_proxied(server, resource, **(transcoding or {}))
+    proxy_url = "http://%s:%s%s" % (webserver_ip, str(server.server_port), path)
 
+    if stats_interval:
+        stream_metrics.start_reporter(stats_interval)
 
-def stop(device_name=None):
-    """ stop playback and quit the media player app on the chromecast """
-    CCMediaController(device_name=device_name).stop()
+    print "URL & content-type: ", proxy_url, mimetype
 
+    load(cast, proxy_url, mimetype)
 
-def get_status(device_name=None):
-    """ print the status of the chromecast device """
-    print CCMediaController(device_name=device_name).get_status()
 
+@timing.timed()
+def get_url_mimetype(url):
+    """ check that a remote HTTP resource exists and find its content type """
 
-def volume_up(device_name=None):
-    """ raise the volume by 0.1 """
-    CCMediaController(device_name=device_name).set_volume_up()
+    from . import url_probe
 
+    try:
+        result = url_probe.probe(url)
+    except url_probe.ProbeError as e:
+        sys.exit(str(e))
 
-def volume_down(device_name=None):
-    """ lower the volume by 0.1 """
-    CCMediaController(device_name=device_name).set_volume_down()
+    print "Found HTTP resource"
 
+    if result['url'] != url:
+        print "redirects to:", result['url']
 
-def set_volume(volume, device_name=None):
-    """ set the volume to level between 0 and 1 """
-    CCMediaController(device_name=device_name).set_volume(volume)
+    mimetype = result['content_type']
+
+    if mimetype is not None:
+        print "content-type:", mimetype
+    else:
+        mimetype = url_probe.DEFAULT_MIMETYPE
+        print "resource does not specify mimetype - using default:", mimetype
+
+    return mimetype
 
 
 def list_devices():
     print "Searching for devices, please wait..."
-    device_ips = cc_device_finder.search_network(device_limit=None, time_limit=10)
+    device_ips, device_infos = discover_devices()
 
     print "%d devices found" % len(device_ips)
 
     for device_ip in device_ips:
-        print device_ip, ":", cc_device_finder.get_device_name(device_ip)
+        print format_device_info(device_ip, device_infos[device_ip])
+
+
+def discover_devices(time_limit=10):
+    """ search the network for devices - returns their ip addresses and a map of ip addresses to device info """
+    device_ips = []
+    device_infos = {}
 
+    for device_ip, info in cc_device_finder.iter_discover(time_limit=time_limit):
+        device_ips.append(device_ip)
+        device_infos[device_ip] = info
+
+    # fetch the details of the devices found by SSDP
+    missing = [device_ip for device_ip in device_ips if device_infos[device_ip] is None]
+    device_infos.update(cc_device_finder.get_device_infos(missing))
+
+    cc_device_finder.update_cache(device_infos.values())
+
+    return device_ips, device_infos
+
+
+def format_device_info(device_ip, info):
+    """ describe a device found on the network """
+    if info is None:
+        return "%s : " % device_ip
+
+    description = "%s : %s" % (device_ip, info['name'])
+    if info['model']:
+        description += " (%s)" % info['model']
+
+    return description
+
+
+def start_daemon(server_port=None, stop=False, status_max_age=0, discovery_service=False, stats_interval=None):
+    """ run the streaming daemon in the foreground, or stop a running daemon """
+    from . import daemon
+
+    if stop:
+        if daemon.send_command("shutdown", {}) is None:
+            print "no daemon is running"
+        return
+
+    daemon.run_daemon(server_port=server_port, status_max_age=status_max_age, discovery_service=discovery_service,
+                      stats_interval=stats_interval)
 
 
 def print_ident():
@@ -500,107 +743,5 @@ def print_ident():
     print
 
 
-def parse_args():
-    device_parser = argparse.ArgumentParser(add_help=False)
-    device_group = device_parser.add_argument_group("device")
-    device_group.add_argument("-d", "--device_name",
-                              help="specify an Chromecast device by name (or ip address) explicitly: "
-                                   "e.g. to play a file on a specific device", default=None)
-
-    server_parser = argparse.ArgumentParser(add_help=False)
-    server_group = server_parser.add_argument_group("server")
-    server_group.add_argument("-p", "--server_port",
-                              help="specify the port from which the media is streamed. "
-                                   "This can be useful in a firewalled environment", default=None)
-
-    subtitles_parser = argparse.ArgumentParser(add_help=False)
-    subtitles_group = subtitles_parser.add_argument_group("subtitles")
-    subtitles_group.add_argument("-s", "--subtitles",
-                                 help="specify subtitles. Only WebVTT format is supported.",
-                                 default=None)
-    subtitles_group.add_argument("--subtitles-port",
-                                 help="specify the port from which the subtitles is streamed. "
-                                      "This can be useful in a firewalled environment.",
-                                 default=None)
-    subtitles_group.add_argument("--subtitles-language",
-                                 help="specify the subtitles language. "
-                                      "The language format is defined by RFC 5646.",
-                                 default=None)
-
-    transcoder_parser = argparse.ArgumentParser(add_help=False)
-    transcoder_group = transcoder_parser.add_argument_group("transcoder")
-    transcoder_group.add_argument("--transcode", action="store_true",
-                                  help="Play an unsupported media type (e.g. an mpg file) "
-                                        "using ffmpeg or avconv as a realtime transcoder "
-                                       "(requires ffmpeg or avconv to be installed)")
-    transcoder_group.add_argument("--transcoder", choices=["ffmpeg", "avconv"], default="ffmpeg")
-    transcoder_group.add_argument("--transcode_options",
-                                  help="option to supply custom parameters to the "
-                                       "transcoder (ffmpeg or avconv)", default=None)
-    transcoder_group.add_argument("--transcode_bufsize", type=int,
-                                  help="pecify the buffer size of the data returned from the transcoder. "
-                                       "Increasing this can help when on a slow network.", default=0)
-
-
-    parser = argparse.ArgumentParser()
-    subparsers = parser.add_subparsers()
-
-    devices_list_parser = subparsers.add_parser("devices_list",
-                                                help="Search for all Chromecast devices on the network")
-    devices_list_parser.set_defaults(function=list_devices)
-
-    play_parser = subparsers.add_parser("play", parents=[device_parser, server_parser, subtitles_parser, transcoder_parser],
-                                        help= "Play a file")
-    play_parser.add_argument("filename", help="The file to play")
-    play_parser.set_defaults(function=play)
-
-    play_url = subparsers.add_parser("playurl", parents=[device_parser],
-                                     help="Play remote file using a URL (e.g. a web video)")
-    play_url.add_argument("url", help="The url to play")
-    play_url.set_defaults(function=playurl)
-
-    pause_parser = subparsers.add_parser("pause", parents=[device_parser],
-                                         help="Pause the current file playing")
-    pause_parser.set_defaults(function=pause)
-
-    continue_parser = subparsers.add_parser("continue", parents=[device_parser],
-                                            help="Continue (Unpause) the current file playing")
-    continue_parser.set_defaults(function=unpause)
-
-    stop_parser = subparsers.add_parser("stop", parents=[device_parser],
-                                        help="Stop the current file playing")
-    stop_parser.set_defaults(function=stop)
-
-    status_parser = subparsers.add_parser("status", parents=[device_parser],
-                                          help="Display Chromecast status")
-    status_parser.set_defaults(function=get_status)
-
-    setvol_parser = subparsers.add_parser("setvol", parents=[device_parser],
-                                          help="Set the volume")
-    setvol_parser.add_argument("volume", type=float, help="value between 0 & 1.0  (e.g. 0.5 = half volume)")
-    setvol_parser.set_defaults(function=set_volume)
-
-    volume_up_parser = subparsers.add_parser("volup", parents=[device_parser],
-                                             help="Increase volume by 0.1")
-    volume_up_parser.set_defaults(function=volume_up)
-
-    volume_down_parser = subparsers.add_parser("voldown", parents=[device_parser],
-                                               help="Decrease volume by 0.1")
-    volume_down_parser.set_defaults(function=volume_down)
-
-    mute_parser = subparsers.add_parser("mute", parents=[device_parser],
-                                        help="Mute the volume")
-    mute_parser.set_defaults(volume=0)
-    mute_parser.set_defaults(function=set_volume)
-
-    return parser.parse_args()
-
-def run():
-    args = parse_args()
-    args_dict = vars(args)
-    func = args_dict.pop("function")
-    func(**args_dict)
-        
-            
 if __name__ == "__main__":
     run()
@@ -0,0 +1,320 @@
+"""
+Collects statistics about the media streams sent by the streaming server and the transcoders feeding them.
+
+The streaming server serves the statistics at /metrics in the Prometheus text format, and a reporter thread
+can print a line for each stream at intervals: the bytes sent, the rate at which the client is taking the data,
+the time spent blocked writing to the client, stalls, and for transcoded streams the transcoder's frame rate
+and speed relative to real time and the fill of its output buffer.
+
+version 0.1
+
+"""
+
+
+# Copyright (C) 2014-2016 Pat Carter
+#
+# This file is part of Stream2chromecast.
+#
+# Stream2chromecast is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Stream2chromecast is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Stream2chromecast.  If not, see <http://www.gnu.org/licenses/>.
+
+
+
+import itertools
+import sys
+import threading
+import time
+
+from . import transcode_session
+
+METRICS_PATH = "/metrics"
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# a single write to the client blocking for longer than this (seconds) counts as a stall
+STALL_THRESHOLD = 1.0
+
+# a client requesting the same path within this many seconds of its last stream ending is reconnecting
+RECONNECT_WINDOW = 30
+
+_lock = threading.Lock()
+_stream_ids = itertools.count(1)
+_streams = {}  # stream id -> StreamStats, while the stream is being sent
+_recently_ended = {}  # (client ip, path) -> time the last stream for it ended
+_totals = {'streams': 0, 'bytes_sent': 0, 'write_blocked_seconds': 0.0, 'stalls': 0,
+           'disconnects': 0, 'reconnects': 0}
+
+
+class StreamStats(object):
+    """ the statistics of one stream being sent to a client """
+
+    def __init__(self, path, client_ip):
+        self.id = next(_stream_ids)
+        self.path = path
+        self.client_ip = client_ip
+        self.started = time.time()
+
+        self.bytes_sent = 0
+        self.write_blocked = 0.0
+        self.stalls = 0
+        self.transcode_session = None
+        self.prefetcher = None
+
+    def record_write(self, length, duration):
+        """ count a block written to the client, which took duration seconds to be accepted """
+
+        self.bytes_sent += length
+        self.write_blocked += duration
+
+        if duration > STALL_THRESHOLD:
+            self.stalls += 1
+
+    def throughput(self):
+        """ the average rate (bytes per second) at which the client has taken the stream """
+
+        elapsed = time.time() - self.started
+        if elapsed <= 0:
+            return 0.0
+
+        return self.bytes_sent / elapsed
+
+
+def start_stream(path, client_ip):
+    """ register a stream which is starting - returns its StreamStats """
+
+    stream = StreamStats(path, client_ip)
+
+    with _lock:
+        _streams[stream.id] = stream
+        _totals['streams'] += 1
+
+        if _recently_ended.pop((client_ip, path), 0) > time.time() - RECONNECT_WINDOW:
+            _totals['reconnects'] += 1
+
+    return stream
+
+
+def end_stream(stream, disconnected=False):
+    """ move a finished stream's statistics into the totals """
+
+    with _lock:
+        _streams.pop(stream.id, None)
+
+        _totals['bytes_sent'] += stream.bytes_sent
+        _totals['write_blocked_seconds'] += stream.write_blocked
+        _totals['stalls'] += stream.stalls
+        if disconnected:
+            _totals['disconnects'] += 1
+
+        now = time.time()
+        _recently_ended[(stream.client_ip, stream.path)] = now
+
+        for key, ended in _recently_ended.items():
+            if ended < now - RECONNECT_WINDOW:
+                del _recently_ended[key]
+
+
+def get_streams():
+    """ the streams currently being sent """
+
+    with _lock:
+        return sorted(_streams.values(), key=lambda stream: stream.id)
+
+
+def transcoder_speed(session):
+    """ the transcoder's speed relative to real time as a float, or None if it hasn't reported it """
+
+    speed = session.progress.get("speed", "").rstrip("x")
+
+    try:
+        return float(speed)
+    except ValueError:
+        return None
+
+
+def transcoder_fps(session):
+    try:
+        return float(session.progress.get("fps", ""))
+    except ValueError:
+        return None
+
+
+def buffer_fill(session):
+    """ the fraction of the session's output buffer in use """
+
+    return float(session.buffered_bytes) / session.buffer_limit
+
+
+# Prometheus text format
+
+def stream_prefetcher(stream):
+    """ the prefetcher reading a stream's file ahead - directly, or for its transcoder - if there is one """
+
+    if stream.prefetcher is not None:
+        return stream.prefetcher
+
+    if stream.transcode_session is not None:
+        return stream.transcode_session.prefetcher
+
+    return None
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def format_metric(lines, name, metric_type, help_text, samples):
+    """ add a metric's HELP and TYPE lines and its samples - a list of (labels dict, value) """
+
+    lines.append("# HELP stream2chromecast_%s %s" % (name, help_text))
+    lines.append("# TYPE stream2chromecast_%s %s" % (name, metric_type))
+
+    for labels, value in samples:
+        label_text = ""
+        if len(labels) > 0:
+            label_text = "{%s}" % ",".join('%s="%s"' % (key, escape_label(labels[key])) for key in sorted(labels))
+
+        lines.append("stream2chromecast_%s%s %s" % (name, label_text, repr(float(value))))
+
+
+def format_metrics():
+    """ the current statistics in the Prometheus text exposition format """
+
+    streams = get_streams()
+    sessions = transcode_session.get_sessions()
+
+    with _lock:
+        totals = dict(_totals)
+
+    # the totals include the streams still being sent
+    for stream in streams:
+        totals['bytes_sent'] += stream.bytes_sent
+        totals['write_blocked_seconds'] += stream.write_blocked
+        totals['stalls'] += stream.stalls
+
+    lines = []
+
+    format_metric(lines, "streams_active", "gauge", "Streams currently being sent.", [({}, len(streams))])
+    format_metric(lines, "streams_total", "counter", "Streams started.", [({}, totals['streams'])])
+    format_metric(lines, "bytes_sent_total", "counter", "Media bytes sent to clients.",
+                  [({}, totals['bytes_sent'])])
+    format_metric(lines, "write_blocked_seconds_total", "counter",
+                  "Time spent waiting for clients to accept data.", [({}, totals['write_blocked_seconds'])])
+    format_metric(lines, "stalls_total", "counter",
+                  "Writes blocked for longer than the stall threshold (%gs)." % STALL_THRESHOLD, [({}, totals['stalls'])])
+    format_metric(lines, "disconnects_total", "counter", "Streams ended by the client before the end.",
+                  [({}, totals['disconnects'])])
+    format_metric(lines, "reconnects_total", "counter",
+                  "Streams requested again by the same client within %d seconds." % RECONNECT_WINDOW,
+                  [({}, totals['reconnects'])])
+
+    def stream_labels(stream):
+        return {'stream': stream.id, 'path': stream.path, 'client': stream.client_ip}
+
+    format_metric(lines, "stream_bytes_sent", "gauge", "Bytes sent on each active stream.",
+                  [(stream_labels(stream), stream.bytes_sent) for stream in streams])
+    format_metric(lines, "stream_throughput_bytes_per_second", "gauge",
+                  "Average rate at which each active stream's client has taken data.",
+                  [(stream_labels(stream), stream.throughput()) for stream in streams])
+    format_metric(lines, "stream_write_blocked_seconds", "gauge",
+                  "Time each active stream has spent waiting for its client.",
+                  [(stream_labels(stream), stream.write_blocked) for stream in streams])
+    format_metric(lines, "stream_stalls", "gauge", "Stalled writes on each active stream.",
+                  [(stream_labels(stream), stream.stalls) for stream in streams])
+
+    prefetched = [(stream, stream_prefetcher(stream)) for stream in streams if stream_prefetcher(stream) is not None]
+    format_metric(lines, "stream_readahead_bytes", "gauge", "File data read ahead of each active stream.",
+                  [(stream_labels(stream), prefetcher.buffered) for stream, prefetcher in prefetched])
+    format_metric(lines, "stream_readahead_window_bytes", "gauge",
+                  "Size of the read-ahead window of each active stream.",
+                  [(stream_labels(stream), prefetcher.window) for stream, prefetcher in prefetched])
+    format_metric(lines, "stream_readahead_slow_reads", "gauge",
+                  "File reads slow enough to widen the read-ahead window, on each active stream.",
+                  [(stream_labels(stream), prefetcher.slow_reads) for stream, prefetcher in prefetched])
+
+    format_metric(lines, "transcoders_active", "gauge", "Transcoder processes running.", [({}, len(sessions))])
+    format_metric(lines, "transcoder_clients", "gauge", "Streams fed by each transcoder.",
+                  [({'transcoder': session.id}, session.clients) for session in sessions])
+    format_metric(lines, "transcoder_buffer_bytes", "gauge", "Transcoder output held in memory.",
+                  [({'transcoder': session.id}, session.buffered_bytes) for session in sessions])
+    format_metric(lines, "transcoder_buffer_fill_ratio", "gauge", "Fraction of the transcoder buffer in use.",
+                  [({'transcoder': session.id}, buffer_fill(session)) for session in sessions])
+    format_metric(lines, "transcoder_fps", "gauge", "Frames per second reported by the transcoder.",
+                  [({'transcoder': session.id}, transcoder_fps(session)) for session in sessions
+                   if transcoder_fps(session) is not None])
+    format_metric(lines, "transcoder_speed_ratio", "gauge",
+                  "Transcoding speed relative to real time (below 1 the device will rebuffer).",
+                  [({'transcoder': session.id}, transcoder_speed(session)) for session in sessions
+                   if transcoder_speed(session) is not None])
+
+    return "\n".join(lines) + "\n"
+
+
+# Periodic stats lines
+
+def format_stats_lines(previous):
+    """ a line for each active stream - previous maps stream ids to (time, bytes sent) at the last report
+        and is updated, so that each line shows the rate since then """
+
+    lines = []
+    now = time.time()
+
+    streams = get_streams()
+    for stream in streams:
+        last_time, last_bytes = previous.get(stream.id, (stream.started, 0))
+        rate = (stream.bytes_sent - last_bytes) / max(now - last_time, 1e-6)
+        previous[stream.id] = (now, stream.bytes_sent)
+
+        line = "stream %d %s: %.1f MB sent, %.0f kB/s, blocked %.1fs, %d stalls" % (
+            stream.id, stream.path, stream.bytes_sent / 1e6, rate / 1e3, stream.write_blocked, stream.stalls)
+
+        session = stream.transcode_session
+        if session is not None:
+            fps = transcoder_fps(session)
+            speed = transcoder_speed(session)
+            line += ", transcoder %s fps %s, buffer %.0f%%" % ("?" if fps is None else "%.0f" % fps,
+                                                               "?" if speed is None else "%.2fx" % speed,
+                                                               buffer_fill(session) * 100)
+
+        prefetcher = stream_prefetcher(stream)
+        if prefetcher is not None:
+            line += ", readahead %.1f/%.1f MB" % (prefetcher.buffered / 1e6, prefetcher.window / 1e6)
+        lines.append(line)
+
+    active = set(stream.id for stream in streams)
+    for stream_id in previous.keys():
+        if stream_id not in active:
+            del previous[stream_id]
+
+    return lines
+
+
+def start_reporter(interval, out=None):
+    """ print the stats lines every interval seconds from a background thread """
+
+    if out is None:
+        out = sys.stdout
+
+    def report():
+        previous = {}
+        while True:
+            time.sleep(interval)
+            for line in format_stats_lines(previous):
+                print >> out, line
+            out.flush()
+
+    thread = threading.Thread(target=report)
+    thread.daemon = True
+    thread.start()
+
+    return thread
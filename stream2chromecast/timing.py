@@ -0,0 +1,230 @@
+"""
+Records how long each stage of a command takes, to show where the time goes when playback is slow to start.
+
+Stages are wrapped in spans (the span context manager or the timed decorator). Spans started while another
+is open on the same thread are nested within it. Nothing is recorded until timing is enabled, so the
+instrumentation costs next to nothing otherwise.
+
+When enabled, each finished span can be written to a file as a line of JSON, and a summary of the spans
+can be printed at the end of the command.
+
+version 0.1
+
+"""
+
+
+# Copyright (C) 2014-2016 Pat Carter
+#
+# This file is part of Stream2chromecast.
+#
+# Stream2chromecast is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Stream2chromecast is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Stream2chromecast.  If not, see <http://www.gnu.org/licenses/>.
+
+
+
+import functools
+import json
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+# spans listed individually in the summary - any more are only counted in the totals
+SUMMARY_SPANS = 100
+
+_enabled = False
+_origin = None
+_json_file = None
+_spans = []
+_lock = threading.Lock()
+_local = threading.local()
+
+
+def enable(json_path=None):
+    """ start recording spans - if json_path is given each span is also appended to it as a line of JSON
+        ("-" writes to stderr) """
+
+    global _enabled, _origin, _json_file
+
+    if json_path == "-":
+        _json_file = sys.stderr
+    elif json_path is not None:
+        _json_file = open(json_path, "a")
+
+    _origin = time.time()
+    _enabled = True
+
+
+def disable():
+    """ stop recording spans """
+
+    global _enabled, _json_file
+
+    _enabled = False
+
+    if _json_file is not None and _json_file is not sys.stderr:
+        _json_file.close()
+    _json_file = None
+
+
+def is_enabled():
+    return _enabled
+
+
+def get_spans():
+    """ the spans finished so far, in the order they were started """
+
+    with _lock:
+        return sorted(_spans, key=lambda span: span['offset_ms'])
+
+
+def record(entry):
+    """ store a finished span and write it to the JSON lines file """
+
+    with _lock:
+        _spans.append(entry)
+
+        if _json_file is not None:
+            _json_file.write(json.dumps(entry, sort_keys=True) + "\n")
+            _json_file.flush()
+
+
+def _stack():
+    if not hasattr(_local, "stack"):
+        _local.stack = []
+
+    return _local.stack
+
+
+@contextmanager
+def span(name, **attrs):
+    """ time the enclosed block as the named stage - attrs are recorded with it """
+
+    if not _enabled:
+        yield
+        return
+
+    stack = _stack()
+    parent = stack[-1] if len(stack) > 0 else None
+    stack.append(name)
+
+    start = time.time()
+    error = None
+    try:
+        yield
+    except BaseException as e:
+        error = e.__class__.__name__
+        raise
+    finally:
+        duration = time.time() - start
+        stack.pop()
+
+        entry = {'name': name,
+                 'start': start,
+                 'offset_ms': (start - _origin) * 1000,
+                 'duration_ms': duration * 1000,
+                 'depth': len(stack),
+                 'parent': parent,
+                 'thread': threading.current_thread().name}
+        if error is not None:
+            entry['error'] = error
+        if len(attrs) > 0:
+            entry['attrs'] = attrs
+
+        record(entry)
+
+
+def mark(name, **attrs):
+    """ record an instant, such as the device's first request for the media """
+
+    if not _enabled:
+        return
+
+    now = time.time()
+    entry = {'name': name,
+             'start': now,
+             'offset_ms': (now - _origin) * 1000,
+             'duration_ms': 0.0,
+             'depth': len(_stack()),
+             'parent': None,
+             'thread': threading.current_thread().name,
+             'mark': True}
+    if len(attrs) > 0:
+        entry['attrs'] = attrs
+
+    record(entry)
+
+
+def timed(name=None):
+    """ decorator timing each call of a function as a span (named after the function by default) """
+
+    def decorator(func):
+        span_name = name or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+
+            with span(span_name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def print_summary(out=None):
+    """ print the spans as an indented timeline, followed by the total time spent in each stage """
+
+    if out is None:
+        out = sys.stderr
+
+    spans = get_spans()
+    if len(spans) == 0:
+        return
+
+    print >> out
+    print >> out, "timings (ms):"
+    print >> out, "%10s %10s  %s" % ("start", "duration", "stage")
+
+    for entry in spans[:SUMMARY_SPANS]:
+        duration = "" if entry.get('mark') else "%.1f" % entry['duration_ms']
+        label = "  " * entry['depth'] + entry['name']
+        if 'error' in entry:
+            label += " (%s)" % entry['error']
+
+        print >> out, "%10.1f %10s  %s" % (entry['offset_ms'], duration, label)
+
+    if len(spans) > SUMMARY_SPANS:
+        print >> out, "... %d more" % (len(spans) - SUMMARY_SPANS)
+
+    totals = {}
+    order = []
+    for entry in spans:
+        if entry.get('mark'):
+            continue
+        if entry['name'] not in totals:
+            totals[entry['name']] = [0, 0.0, 0.0]
+            order.append(entry['name'])
+
+        total = totals[entry['name']]
+        total[0] += 1
+        total[1] += entry['duration_ms']
+        total[2] = max(total[2], entry['duration_ms'])
+
+    print >> out
+    print >> out, "%-30s %6s %10s %10s %10s" % ("stage", "count", "total", "mean", "max")
+    for name in order:
+        count, total, longest = totals[name]
+        print >> out, "%-30s %6d %10.1f %10.1f %10.1f" % (name, count, total, total / count, longest)
@@ -0,0 +1,315 @@
+"""
+Shares a single transcoder process between all the HTTP clients streaming the same content.
+
+version 0.1
+
+"""
+
+
+# Copyright (C) 2014-2016 Pat Carter
+#
+# This file is part of Stream2chromecast.
+#
+# Stream2chromecast is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Stream2chromecast is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Stream2chromecast.  If not, see <http://www.gnu.org/licenses/>.
+
+
+
+import itertools
+import os
+import re
+import subprocess
+import sys
+import threading
+import time
+
+from . import prefetch
+
+# amount read from the transcoder in one go when no buffer size is specified
+CHUNK_SIZE = 65536
+
+# amount of the input file written to the transcoder in one go - large writes keep the cost of feeding it small
+FEED_BLOCK_SIZE = 1024 * 1024
+
+# transcoder output kept in memory - the transcoder is held back while the slowest client is this far behind
+BUFFER_LIMIT = 64 * 1024 * 1024
+
+# output formats a client can start playing part way through - others (such as fragmented MP4, which needs its
+# initialisation segment) must be read from the start
+JOINABLE_FORMATS = ("mpegts", "mp3", "adts")
+
+OUTPUT_FORMAT = re.compile(r"-f\s+(\S+)")
+
+# keys of the progress reports written by ffmpeg -progress
+PROGRESS_KEYS = ("frame", "fps", "bitrate", "total_size", "out_time_us", "out_time_ms", "out_time",
+                 "dup_frames", "drop_frames", "speed", "progress")
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+_session_ids = itertools.count(1)
+
+
+class TranscodeSession(object):
+    """ a running transcoder process whose output is buffered and fanned out to each attached client """
+
+    def __init__(self, command, bufsize=0, buffer_limit=BUFFER_LIMIT, input_path=None):
+        """ start the transcoder - if input_path is given, the file is read ahead and fed to the transcoder's
+            stdin """
+
+        self.id = next(_session_ids)
+        self.command = command
+        self.input_path = input_path
+        self.prefetcher = None
+        self.bufsize = bufsize
+        self.started = time.time()
+        self.buffer_limit = buffer_limit
+
+        self.clients = 0
+
+        # the last -f option is the output format
+        formats = OUTPUT_FORMAT.findall(command)
+        self.joinable = len(formats) > 0 and formats[-1] in JOINABLE_FORMATS
+
+        self.chunks = []
+        self.first_index = 0  # stream position (in chunks) of self.chunks[0]
+        self.buffered_bytes = 0
+        self.start_dropped = False
+
+        self.positions = {}   # reader id -> stream position (in chunks) of the next chunk it will read
+        self.reader_ids = itertools.count(1)
+
+        self.finished = False
+        self.closed = False
+        self.cond = threading.Condition()
+
+        # the latest progress report from the transcoder (see read_progress)
+        self.progress = {}
+
+        stdin = None
+        if input_path is not None:
+            self.prefetcher = prefetch.Prefetcher(input_path, block_size=FEED_BLOCK_SIZE)
+            stdin = subprocess.PIPE
+
+        self.process = subprocess.Popen(command, stdin=stdin, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                        shell=True, bufsize=bufsize)
+
+        targets = [self.pump, self.read_progress]
+        if self.prefetcher is not None:
+            targets.append(self.feed)
+
+        for target in targets:
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+
+    def read_chunk(self):
+        """ read the next block of output from the transcoder """
+
+        if self.bufsize != 0:
+            return self.process.stdout.read(self.bufsize)
+
+        return os.read(self.process.stdout.fileno(), CHUNK_SIZE)
+
+    def pump(self):
+        """ copy the transcoder output into the shared buffer until it ends or the session is closed """
+
+        try:
+            while not self.closed:
+                data = self.read_chunk()
+                if len(data) == 0:
+                    break
+
+                with self.cond:
+                    self.chunks.append(data)
+                    self.buffered_bytes += len(data)
+                    self.cond.notify_all()
+
+                    # over the limit, the oldest output is dropped once no client needs it - until then the
+                    # transcoder is held back
+                    while self.buffered_bytes > self.buffer_limit and len(self.chunks) > 1 and not self.closed:
+                        if self.oldest_needed():
+                            self.cond.wait()
+                            continue
+
+                        self.buffered_bytes -= len(self.chunks.pop(0))
+                        self.first_index += 1
+                        self.start_dropped = True
+        finally:
+            with self.cond:
+                self.finished = True
+                self.cond.notify_all()
+
+            # closing the pipe stops the transcoder if it is still writing
+            self.process.stdout.close()
+            self.process.wait()
+
+    def oldest_needed(self):
+        """ whether a client has still to read the oldest chunk held - called with the condition held """
+
+        # a client which has attached but not started reading starts at the beginning
+        if self.clients > len(self.positions) and not self.start_dropped:
+            return True
+
+        return any(position <= self.first_index for position in self.positions.values())
+
+    def feed(self):
+        """ copy the input file from the prefetcher to the transcoder """
+
+        try:
+            while not self.closed:
+                data = self.prefetcher.read()
+                if len(data) == 0:
+                    break
+
+                self.process.stdin.write(data)
+        except (IOError, OSError):
+            # the transcoder has exited, or the file can no longer be read
+            pass
+        finally:
+            self.prefetcher.close()
+
+            try:
+                self.process.stdin.close()
+            except (IOError, OSError):
+                pass
+
+    def read_progress(self):
+        """ collect the transcoder's progress reports (ffmpeg -progress pipe:2) from its stderr,
+            passing anything else it writes there on to ours """
+
+        report = {}
+
+        for line in iter(self.process.stderr.readline, ""):
+            key, sep, value = line.strip().partition("=")
+
+            if sep == "" or key not in PROGRESS_KEYS:
+                sys.stderr.write(line)
+                continue
+
+            report[key] = value.strip()
+
+            # "progress" ends each report
+            if key == "progress":
+                self.progress = report
+                report = {}
+
+        self.process.stderr.close()
+
+    def reader(self):
+        """ the transcoder output for a single client, as an iterator of chunks - to be closed when the client is
+            done with it """
+
+        with self.cond:
+            # a client can only join part way through a format which can be played from there (see attach)
+            if self.start_dropped:
+                index = self.first_index + len(self.chunks)
+            else:
+                index = 0
+
+            reader_id = next(self.reader_ids)
+            self.positions[reader_id] = index
+
+        return self.read_chunks(reader_id, index)
+
+    def read_chunks(self, reader_id, index):
+        try:
+            while True:
+                with self.cond:
+                    while index >= self.first_index + len(self.chunks) and not self.finished and not self.closed:
+                        self.cond.wait()
+
+                    if index >= self.first_index + len(self.chunks):
+                        return
+
+                    chunk = self.chunks[index - self.first_index]
+                    self.positions[reader_id] = index + 1
+
+                    # the transcoder may be waiting for this client to move on
+                    if self.buffered_bytes > self.buffer_limit:
+                        self.cond.notify_all()
+
+                index += 1
+                yield chunk
+        finally:
+            with self.cond:
+                del self.positions[reader_id]
+                self.cond.notify_all()
+
+    def close(self):
+        """ stop the transcoder """
+
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+        if self.prefetcher is not None:
+            self.prefetcher.close()
+
+        if self.process.poll() is None:
+            try:
+                self.process.terminate()
+            except OSError:
+                pass
+
+
+def get_sessions():
+    """ the running sessions """
+
+    with _sessions_lock:
+        return list(_sessions.values())
+
+
+def attach(command, bufsize=0, input_path=None):
+    """ return the session running the transcoder command (on input_path, if the input is fed to it),
+        starting one if there is none """
+
+    key = (command, input_path)
+
+    with _sessions_lock:
+        session = _sessions.get(key)
+
+        if session is not None:
+            with session.cond:
+                # once the start has been dropped, only a live stream in a format which can be joined part way
+                # through is shared
+                if session.start_dropped and (session.finished or not session.joinable):
+                    session = None
+                else:
+                    session.clients += 1
+
+        if session is None:
+            session = TranscodeSession(command, bufsize, input_path=input_path)
+            _sessions[key] = session
+
+            with session.cond:
+                session.clients += 1
+
+    return session
+
+
+def detach(session):
+    """ release a client's hold on a session, stopping the transcoder when the last client leaves """
+
+    with _sessions_lock:
+        with session.cond:
+            session.clients -= 1
+            session.cond.notify_all()
+
+        if session.clients > 0:
+            return
+
+        key = (session.command, session.input_path)
+        if _sessions.get(key) is session:
+            del _sessions[key]
+
+    session.close()
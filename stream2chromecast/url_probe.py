@@ -0,0 +1,384 @@
+"""
+Finds out what a remote HTTP resource is before it is played: where it redirects to, its content type and length,
+and whether the server accepts range requests.
+
+A HEAD request is made first, falling back to a GET for the first few bytes when the server doesn't support HEAD.
+When the server gives no useful content type, the container is recognised from those first bytes. Redirects are
+followed, and connections are kept open and reused for later requests to the same server (the pool is shared with
+url_proxy). The results are cached for a while, in memory and in a file, so playing the same URL again doesn't
+probe it again.
+
+version 0.1
+
+"""
+
+
+# Copyright (C) 2014-2016 Pat Carter
+#
+# This file is part of Stream2chromecast.
+#
+# Stream2chromecast is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Stream2chromecast is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Stream2chromecast.  If not, see <http://www.gnu.org/licenses/>.
+
+
+
+import httplib
+import json
+import os
+import socket
+import threading
+import time
+import urlparse
+
+# file holding the probe results between runs
+CACHE_FILE = "~/.cc_probe_cache"
+
+# seconds for which a probe result is reused
+PROBE_TTL = 10 * 60
+
+# probe results kept in the cache file - the oldest are dropped beyond this
+CACHE_MAX_ENTRIES = 500
+
+# bytes fetched to recognise the container when the server doesn't say what it is
+SNIFF_BYTES = 512
+
+# seconds to wait for a server to respond
+REQUEST_TIMEOUT = 30
+
+# idle connections kept open to each server
+MAX_IDLE_CONNECTIONS = 4
+
+MAX_REDIRECTS = 5
+
+# content types which say nothing about the container
+GENERIC_CONTENT_TYPES = ("", "application/octet-stream", "binary/octet-stream", "application/binary",
+                         "application/x-download", "application/force-download", "text/plain")
+
+# statuses of a HEAD request meaning the server doesn't support HEAD, rather than that the resource is missing
+HEAD_UNSUPPORTED = (400, 403, 405, 501)
+
+DEFAULT_MIMETYPE = "video/mp4"
+
+_cache = None  # url -> probe result, loaded from the cache file when first needed
+_cache_lock = threading.Lock()
+
+
+class ProbeError(Exception):
+    pass
+
+
+class ConnectionPool(object):
+    """ keep-alive connections to the origins, reused for later requests to the same host """
+
+    def __init__(self, max_idle=MAX_IDLE_CONNECTIONS, timeout=REQUEST_TIMEOUT):
+        self.max_idle = max_idle
+        self.timeout = timeout
+        self.idle = {}  # (scheme, host) -> idle connections
+        self.lock = threading.Lock()
+
+    def new_connection(self, scheme, host):
+        if scheme == "https":
+            return httplib.HTTPSConnection(host, timeout=self.timeout)
+
+        return httplib.HTTPConnection(host, timeout=self.timeout)
+
+    def connect(self, scheme, host):
+        """ an idle connection to the host if there is one, otherwise a new one - returns (connection, reused) """
+
+        with self.lock:
+            connections = self.idle.get((scheme, host), [])
+            if len(connections) > 0:
+                return connections.pop(), True
+
+        return self.new_connection(scheme, host), False
+
+    def release(self, scheme, host, conn, resp):
+        """ return a connection for reuse - only once its response has been read to the end """
+
+        if resp.will_close or not resp.isclosed():
+            conn.close()
+            return
+
+        with self.lock:
+            connections = self.idle.setdefault((scheme, host), [])
+            if len(connections) < self.max_idle:
+                connections.append(conn)
+                return
+
+        conn.close()
+
+    def request(self, method, url, headers=None):
+        """ make a request, following redirects - returns a Response """
+
+        for redirect in range(MAX_REDIRECTS + 1):
+            url_parsed = urlparse.urlparse(url)
+            if url_parsed.scheme not in ("http", "https"):
+                raise ProbeError("unsupported url: %s" % url)
+
+            path = url_parsed.path or "/"
+            if url_parsed.query:
+                path += "?" + url_parsed.query
+
+            conn, reused = self.connect(url_parsed.scheme, url_parsed.netloc)
+            try:
+                conn.request(method, path, headers=headers or {})
+                resp = conn.getresponse()
+            except (httplib.HTTPException, socket.error):
+                conn.close()
+                if not reused:
+                    raise
+
+                # the origin closed the idle connection - try again on a new one
+                conn = self.new_connection(url_parsed.scheme, url_parsed.netloc)
+                conn.request(method, path, headers=headers or {})
+                resp = conn.getresponse()
+
+            response = Response(self, url_parsed.scheme, url_parsed.netloc, conn, resp, url)
+
+            if resp.status in (301, 302, 303, 307, 308) and resp.getheader("Location"):
+                response.close()
+                url = urlparse.urljoin(url, resp.getheader("Location"))
+                continue
+
+            return response
+
+        raise ProbeError("too many redirects: %s" % url)
+
+
+class Response(object):
+    """ a response from the origin, whose connection goes back to the pool once it has been read """
+
+    def __init__(self, pool, scheme, host, conn, resp, url):
+        self.pool = pool
+        self.scheme = scheme
+        self.host = host
+        self.conn = conn
+        self.resp = resp
+        self.url = url
+
+        self.status = resp.status
+        self.reason = resp.reason
+
+    def getheader(self, name, default=None):
+        return self.resp.getheader(name, default)
+
+    def read(self, size):
+        return self.resp.read(size)
+
+    def close(self):
+        """ release the connection - a partly read response is discarded along with its connection """
+
+        if self.status in (301, 302, 303, 307, 308) or self.resp.length == 0:
+            # redirects have short bodies and HEAD responses none - reading them to the end keeps the connection
+            try:
+                self.resp.read()
+            except (httplib.HTTPException, socket.error):
+                pass
+
+        self.pool.release(self.scheme, self.host, self.conn, self.resp)
+
+
+pool = ConnectionPool()
+
+
+def sniff_container(data):
+    """ the mimetype of a container recognised from its first bytes, or None """
+
+    if data[4:8] == "ftyp":
+        if data[8:12] in ("M4A ", "M4B "):
+            return "audio/mp4"
+        return "video/mp4"
+
+    if data.startswith("\x1a\x45\xdf\xa3"):
+        # EBML - WebM is Matroska with a different doctype
+        if "webm" in data[:64]:
+            return "video/webm"
+        return "video/x-matroska"
+
+    if data.startswith("ID3") or data[:2] in ("\xff\xfb", "\xff\xf3", "\xff\xf2"):
+        return "audio/mpeg"
+
+    if data[:2] in ("\xff\xf1", "\xff\xf9"):
+        return "audio/aac"
+
+    if data.startswith("OggS"):
+        return "audio/ogg"
+
+    if data.startswith("fLaC"):
+        return "audio/flac"
+
+    if data.startswith("RIFF") and data[8:12] == "WAVE":
+        return "audio/wav"
+
+    if data.startswith("RIFF") and data[8:12] == "AVI ":
+        return "video/x-msvideo"
+
+    if len(data) > 188 and data[0] == "\x47" and data[188] == "\x47":
+        return "video/mp2t"
+
+    if data.startswith("#EXTM3U"):
+        return "application/x-mpegurl"
+
+    for signature, mimetype in (("\x89PNG", "image/png"), ("\xff\xd8\xff", "image/jpeg"), ("GIF8", "image/gif")):
+        if data.startswith(signature):
+            return mimetype
+
+    return None
+
+
+def is_generic(response):
+    """ whether a response's content type says nothing about the container """
+
+    content_type = response.getheader("Content-Type") or ""
+
+    return content_type.split(";")[0].strip().lower() in GENERIC_CONTENT_TYPES
+
+
+def read_cache_file():
+    try:
+        with open(os.path.expanduser(CACHE_FILE), "r") as f:
+            entries = json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+    if not isinstance(entries, dict):
+        return {}
+
+    return entries
+
+
+def write_cache_file(entries):
+    """ write the cache atomically, so that other processes never read a partly written file """
+
+    import tempfile
+
+    filepath = os.path.expanduser(CACHE_FILE)
+
+    try:
+        fd, temp_path = tempfile.mkstemp(prefix=".cc_probe_cache", dir=os.path.dirname(filepath))
+        with os.fdopen(fd, "w") as f:
+            json.dump(entries, f)
+        os.rename(temp_path, filepath)
+    except (IOError, OSError):
+        pass
+
+
+def cached_probe(url):
+    """ the cached probe result for a url, or None if there isn't one which is recent enough """
+
+    global _cache
+
+    with _cache_lock:
+        if _cache is None:
+            _cache = read_cache_file()
+
+        result = _cache.get(url)
+
+    if result is None or result['time'] < time.time() - PROBE_TTL:
+        return None
+
+    return result
+
+
+def store_probe(url, result):
+    global _cache
+
+    with _cache_lock:
+        if _cache is None:
+            _cache = read_cache_file()
+
+        now = time.time()
+        entries = dict((key, entry) for key, entry in _cache.items() if entry['time'] >= now - PROBE_TTL)
+        entries[url] = result
+
+        if len(entries) > CACHE_MAX_ENTRIES:
+            newest = sorted(entries.items(), key=lambda item: item[1]['time'])[-CACHE_MAX_ENTRIES:]
+            entries = dict(newest)
+
+        _cache = entries
+        write_cache_file(entries)
+
+
+def clear_cache():
+    """ forget the probe results, in memory and in the cache file """
+
+    global _cache
+
+    with _cache_lock:
+        _cache = {}
+        write_cache_file({})
+
+
+def read_sniff_bytes(response):
+    """ up to SNIFF_BYTES from the start of a response """
+
+    data = ""
+    while len(data) < SNIFF_BYTES:
+        block = response.read(SNIFF_BYTES - len(data))
+        if len(block) == 0:
+            break
+        data += block
+
+    return data
+
+
+def probe(url, use_cache=True):
+    """ find out what a remote resource is - returns a dict with the url it redirects to ('url'), its
+        'content_type' (as given by the server, or recognised from its first bytes), 'length' (None if unknown)
+        and whether the server 'accepts_ranges'. Raises ProbeError if the resource can't be reached """
+
+    if use_cache:
+        result = cached_probe(url)
+        if result is not None:
+            return result
+
+    try:
+        response = pool.request("HEAD", url)
+        response.close()
+
+        sniffed = None
+        if response.status in HEAD_UNSUPPORTED or (response.status < 400 and is_generic(response)):
+            # ask for the first bytes instead - enough to recognise the container
+            response = pool.request("GET", url, {'Range': "bytes=0-%d" % (SNIFF_BYTES - 1)})
+            try:
+                if response.status in (200, 206):
+                    sniffed = sniff_container(read_sniff_bytes(response))
+            finally:
+                response.close()
+    except (httplib.HTTPException, socket.error) as e:
+        raise ProbeError("unable to reach %s: %s" % (url, str(e) or e.__class__.__name__))
+
+    if response.status not in (200, 206):
+        raise ProbeError("HTTP error: %d - %s" % (response.status, response.reason))
+
+    content_type = response.getheader("Content-Type")
+    if is_generic(response):
+        content_type = sniffed
+
+    length = None
+    if response.status == 206:
+        total = (response.getheader("Content-Range") or "").rpartition("/")[2]
+        if total.isdigit():
+            length = int(total)
+    elif response.getheader("Content-Length", "").isdigit():
+        length = int(response.getheader("Content-Length"))
+
+    result = {'url': response.url,
+              'content_type': content_type,
+              'length': length,
+              'accepts_ranges': response.status == 206 or response.getheader("Accept-Ranges", "") == "bytes",
+              'time': time.time()}
+
+    store_probe(url, result)
+
+    return result
@@ -0,0 +1,621 @@
+"""
+A caching read-through proxy for playing remote HTTP resources.
+
+Instead of handing the remote URL to the device, the resource is downloaded by the local streaming server into
+a cache directory and served to the device from there. The download runs ahead of playback over pooled
+keep-alive connections (see url_probe), resuming after dropped connections, so a slow or flaky origin doesn't
+make the device rebuffer. Range requests are answered from the cache, or for positions far beyond the downloaded
+data, passed through to the origin. The cache is limited in size, with the least recently played resources
+removed first, and a resource which has been downloaded completely is played again from disk once the origin
+has confirmed (by its ETag or Last-Modified date) that it hasn't changed.
+
+A proxied resource can also be fed to the transcoder, for remote formats which the device doesn't support.
+
+version 0.1
+
+"""
+
+
+# Copyright (C) 2014-2016 Pat Carter
+#
+# This file is part of Stream2chromecast.
+#
+# Stream2chromecast is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Stream2chromecast is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Stream2chromecast.  If not, see <http://www.gnu.org/licenses/>.
+
+
+
+import hashlib
+import httplib
+import itertools
+import json
+import os
+import re
+import socket
+import threading
+import time
+
+from . import stream2chromecast
+from .url_probe import ProbeError, pool
+
+# directory holding the downloaded resources
+CACHE_DIR = "~/.cc_url_cache"
+
+# total size of the downloaded resources (bytes) beyond which the least recently played are removed
+CACHE_SIZE = 2 * 1024 * 1024 * 1024
+
+# amount downloaded from the origin or sent to the device in one go
+BLOCK_SIZE = 65536
+
+# amount downloaded between checks that the cache still fits its size limit
+EVICT_INTERVAL = 16 * 1024 * 1024
+
+# attempts to resume a download after losing the connection to the origin
+FETCH_RETRIES = 5
+
+# seconds to wait for the origin to respond, or for data needed by the device to be downloaded
+FETCH_TIMEOUT = 30
+
+# a range starting this far beyond the downloaded data is fetched from the origin instead of waiting
+SEEK_AHEAD_LIMIT = 8 * 1024 * 1024
+
+RANGE_HEADER = re.compile(r"bytes=(\d*)-(\d*)$")
+
+
+class ProxyError(Exception):
+    pass
+
+
+class CachedResource(object):
+    """ a remote resource being downloaded into the cache, which can be read from while it downloads """
+
+    def __init__(self, cache, url):
+        self.cache = cache
+        self.url = url
+        self.origin_url = url   # where the url redirects to, once known
+
+        key = hashlib.sha1(url.encode("utf-8") if isinstance(url, unicode) else url).hexdigest()
+        self.data_path = os.path.join(cache.directory, key + ".data")
+        self.meta_path = os.path.join(cache.directory, key + ".json")
+
+        self.cond = threading.Condition()
+        self.length = None
+        self.content_type = None
+        self.etag = None
+        self.last_modified = None
+        self.downloaded = 0     # bytes downloaded from the start of the resource
+        self.complete = False
+        self.headers_known = False
+        self.error = None
+
+        self.fetching = False
+        self.validated = False  # whether a complete download has been checked against the origin
+        self.validating = False
+        self.users = 0          # requests being served from the resource
+
+        self.load_metadata()
+
+    def load_metadata(self):
+        try:
+            with open(self.meta_path, "r") as f:
+                meta = json.load(f)
+        except (IOError, ValueError):
+            return
+
+        if meta.get('url') != self.url or not os.path.exists(self.data_path):
+            return
+
+        self.length = meta['length']
+        self.content_type = meta['content_type']
+        self.etag = meta['etag']
+        self.last_modified = meta.get('last_modified')
+        self.downloaded = min(meta['downloaded'], os.path.getsize(self.data_path))
+        self.complete = meta['complete'] and self.downloaded == (self.length or self.downloaded)
+        self.headers_known = True
+
+    def save_metadata(self):
+        with self.cond:
+            meta = {'url': self.url,
+                    'length': self.length,
+                    'content_type': self.content_type,
+                    'etag': self.etag,
+                    'last_modified': self.last_modified,
+                    'downloaded': self.downloaded,
+                    'complete': self.complete}
+
+        try:
+            with open(self.meta_path, "w") as f:
+                json.dump(meta, f)
+        except IOError:
+            pass
+
+    def start(self):
+        """ start downloading the resource in the background, unless it is downloading, or downloaded and known to
+            be current - a complete download is checked against the origin first """
+
+        with self.cond:
+            if self.fetching:
+                return
+
+            if self.complete:
+                # a resource without an ETag or Last-Modified date can't be checked
+                if self.validated or (self.etag is None and self.last_modified is None):
+                    return
+
+                self.validating = True
+
+            self.fetching = True
+            self.error = None
+
+        thread = threading.Thread(target=self.fetch)
+        thread.daemon = True
+        thread.start()
+
+    def expire(self):
+        """ check a complete download is still current with the origin before it is next played """
+
+        with self.cond:
+            self.validated = False
+
+    def fetch(self):
+        """ download the resource, resuming where the connection was lost """
+
+        failures = 0
+        try:
+            while True:
+                try:
+                    self.download()
+                    return
+                except (httplib.HTTPException, socket.error, IOError) as e:
+                    if self.keep_cached_copy(e):
+                        return
+
+                    failures += 1
+                    if failures > FETCH_RETRIES:
+                        self.fail("download failed: %s" % (str(e) or e.__class__.__name__))
+                        return
+
+                    time.sleep(min(0.25 * 2 ** failures, 5))
+                except (ProxyError, ProbeError) as e:
+                    if not self.keep_cached_copy(e):
+                        self.fail(str(e))
+                    return
+        finally:
+            with self.cond:
+                self.fetching = False
+                self.validating = False
+                self.cond.notify_all()
+
+            self.save_metadata()
+            self.cache.evict()
+
+    def keep_cached_copy(self, error):
+        """ when the origin can't confirm that a complete download is current, the copy in the cache is played
+            - returns whether that is the case """
+
+        if not self.validating:
+            return False
+
+        print "unable to check %s is current: %s" % (self.url, str(error) or error.__class__.__name__)
+        with self.cond:
+            self.validated = True
+
+        return True
+
+    def fail(self, error):
+        with self.cond:
+            self.error = error
+            self.cond.notify_all()
+
+    def download(self):
+        headers = {}
+        if self.validating:
+            # the origin answers 304 if the complete download is still current, or sends the new version
+            if self.etag:
+                headers['If-None-Match'] = self.etag
+            if self.last_modified:
+                headers['If-Modified-Since'] = self.last_modified
+        elif self.downloaded > 0:
+            headers['Range'] = "bytes=%d-" % self.downloaded
+            if self.etag or self.last_modified:
+                headers['If-Range'] = self.etag or self.last_modified
+
+        response = pool.request("GET", self.origin_url, headers)
+        self.origin_url = response.url
+        try:
+            if response.status == 304 and self.validating:
+                with self.cond:
+                    self.validated = True
+                return
+
+            if response.status == 206 and self.downloaded > 0 and not self.validating:
+                offset = self.downloaded
+                total = response.getheader("Content-Range", "").rpartition("/")[2]
+                length = int(total) if total.isdigit() else None
+            elif response.status == 200:
+                # the origin doesn't support ranges, or the resource has changed - start again
+                offset = 0
+                content_length = response.getheader("Content-Length")
+                length = int(content_length) if content_length is not None else None
+            else:
+                raise ProxyError("HTTP error: %d - %s" % (response.status, response.reason))
+
+            with self.cond:
+                self.length = length
+                self.content_type = response.getheader("Content-Type") or self.content_type
+                self.etag = response.getheader("ETag")
+                self.last_modified = response.getheader("Last-Modified")
+                self.downloaded = offset
+                self.complete = False
+                self.validated = True
+                self.headers_known = True
+                self.cond.notify_all()
+
+            # make room for the whole resource, if its length is known, before downloading it
+            self.cache.evict()
+            next_evict = offset + EVICT_INTERVAL
+
+            with open(self.data_path, "r+b" if offset > 0 else "wb") as f:
+                f.seek(offset)
+                f.truncate()
+
+                while True:
+                    data = response.read(BLOCK_SIZE)
+                    if len(data) == 0:
+                        break
+
+                    f.write(data)
+                    f.flush()
+
+                    with self.cond:
+                        self.downloaded += len(data)
+                        self.cond.notify_all()
+
+                    if self.downloaded >= next_evict:
+                        self.cache.evict()
+                        next_evict = self.downloaded + EVICT_INTERVAL
+
+            if self.length is not None and self.downloaded < self.length:
+                raise httplib.IncompleteRead("", self.length - self.downloaded)
+
+            with self.cond:
+                self.length = self.downloaded
+                self.complete = True
+                self.cond.notify_all()
+        finally:
+            response.close()
+
+    def wait(self, predicate, timeout=FETCH_TIMEOUT):
+        """ wait (holding self.cond) until predicate() is true, the download fails or the time runs out """
+
+        deadline = time.time() + timeout
+        while not predicate():
+            if self.error is not None and not self.fetching:
+                raise ProxyError(self.error)
+
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise ProxyError("timed out waiting for %s" % self.url)
+
+            self.cond.wait(remaining)
+
+    def wait_for_headers(self, timeout=FETCH_TIMEOUT):
+        """ wait until the length and content type of the resource are known """
+
+        self.start()
+
+        with self.cond:
+            self.wait(lambda: self.headers_known and not self.validating, timeout)
+
+    def read(self, f, offset, size, timeout=FETCH_TIMEOUT):
+        """ read up to size bytes at offset from the open data file f, waiting for them to be downloaded
+            - returns an empty string at the end of the resource """
+
+        with self.cond:
+            if offset >= self.downloaded and not self.complete:
+                self.start()
+            self.wait(lambda: offset < self.downloaded or self.complete, timeout)
+
+            size = min(size, self.downloaded - offset)
+
+        if size <= 0:
+            return ""
+
+        f.seek(offset)
+        return f.read(size)
+
+    def in_use(self):
+        with self.cond:
+            return self.fetching or self.users > 0
+
+
+class Cache(object):
+    """ the downloaded resources, limited in total size - the least recently played are removed first """
+
+    def __init__(self, directory=CACHE_DIR, max_bytes=CACHE_SIZE):
+        self.directory = os.path.expanduser(directory)
+        self.max_bytes = max_bytes
+        self.resources = {}  # url -> CachedResource
+        self.lock = threading.Lock()
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+    def get(self, url):
+        with self.lock:
+            if url not in self.resources:
+                self.resources[url] = CachedResource(self, url)
+
+            resource = self.resources[url]
+
+        # the metadata file's modification time records when the resource was last played
+        resource.save_metadata()
+        resource.expire()
+
+        return resource
+
+    def evict(self):
+        """ remove the least recently played resources until the cache fits its size limit - a resource being
+            downloaded counts at its full length, if that is known """
+
+        with self.lock:
+            lengths = dict((resource.data_path, resource.length) for resource in self.resources.values()
+                           if resource.fetching and resource.length is not None)
+
+        entries = []
+        total = 0
+        for name in os.listdir(self.directory):
+            if not name.endswith(".data"):
+                continue
+
+            data_path = os.path.join(self.directory, name)
+            meta_path = data_path[:-len(".data")] + ".json"
+            try:
+                size = max(os.path.getsize(data_path), lengths.get(data_path, 0))
+                last_played = os.path.getmtime(meta_path) if os.path.exists(meta_path) else 0
+            except OSError:
+                continue
+
+            entries.append((last_played, data_path, meta_path, size))
+            total += size
+
+        with self.lock:
+            in_use = set(resource.data_path for resource in self.resources.values() if resource.in_use())
+
+        for last_played, data_path, meta_path, size in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if data_path in in_use:
+                continue
+
+            for path in (data_path, meta_path):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            total -= size
+
+            with self.lock:
+                for url, resource in self.resources.items():
+                    if resource.data_path == data_path:
+                        del self.resources[url]
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_cache(directory=CACHE_DIR, max_bytes=CACHE_SIZE):
+    """ the cache in a directory, shared by the whole process """
+
+    with _caches_lock:
+        if directory not in _caches:
+            _caches[directory] = Cache(directory, max_bytes)
+
+        cache = _caches[directory]
+        cache.max_bytes = max_bytes
+
+        return cache
+
+
+_proxied_ids = itertools.count(1)
+
+
+def add_proxied(server, resource, transcoder_command=None, transcode_options="", bufsize=0):
+    """ serve a cached resource from a streaming server, transcoded if transcoder_command is given
+        - returns the url path """
+
+    path = "/proxy/%d" % next(_proxied_ids)
+    server.proxied[path] = {'resource': resource, 'transcoder_command': None}
+
+    if transcoder_command is None:
+        return path
+
+    # the transcoder reads the resource through the proxy too
+    host = server.server_address[0]
+    if host in ("", "0.0.0.0"):
+        host = "127.0.0.1"
+
+    transcode_path = path + "/transcode"
+    server.proxied[transcode_path] = {'resource': resource,
+                                      'transcoder_command': transcoder_command,
+                                      'transcode_options': transcode_options,
+                                      'bufsize': bufsize,
+                                      'source_url': "http://%s:%d%s" % (host, server.server_port, path)}
+
+    return transcode_path
+
+
+def parse_range(header, length):
+    """ the (first, last) bytes of a Range header's single range, or None if it is absent or can't be satisfied """
+
+    match = RANGE_HEADER.match((header or "").strip())
+    if match is None or length is None:
+        return None
+
+    first, last = match.groups()
+    if first == "":
+        if last == "":
+            return None
+        first, last = max(length - int(last), 0), length - 1
+    else:
+        first = int(first)
+        last = min(int(last), length - 1) if last != "" else length - 1
+
+    if first > last:
+        return None
+
+    return first, last
+
+
+class ProxyRequestHandler(stream2chromecast.TranscodingRequestHandler):
+    """ Handle HTTP requests for proxied remote resources, sending them from the cache """
+
+    resource = None
+    transcode = False
+    failed = False
+
+    def get_filepath(self):
+        proxied = self.server.proxied.get(self.path)
+        if proxied is None:
+            return None
+
+        self.resource = proxied['resource']
+        self.transcode = proxied['transcoder_command'] is not None
+
+        if self.transcode:
+            self.transcoder_command = proxied['transcoder_command']
+            self.transcode_options = proxied['transcode_options']
+            self.bufsize = proxied['bufsize']
+            return proxied['source_url']
+
+        return self.resource.url
+
+    def send_headers(self, filepath=None):
+        if self.transcode:
+            stream2chromecast.TranscodingRequestHandler.send_headers(self, filepath)
+            return
+
+        resource = self.resource
+        try:
+            resource.wait_for_headers()
+        except ProxyError as e:
+            print e
+            self.failed = True
+            self.send_error(502)
+            return
+
+        self.range = parse_range(self.headers.get("Range"), resource.length)
+        self.origin_response = None
+
+        if self.range is not None and not resource.complete and \
+                self.range[0] > resource.downloaded + SEEK_AHEAD_LIMIT:
+            # far beyond the download - pass the request to the origin rather than wait
+            try:
+                self.origin_response = pool.request("GET", resource.origin_url,
+                                                    {'Range': "bytes=%d-%d" % self.range})
+            except (ProbeError, httplib.HTTPException, socket.error) as e:
+                print "unable to fetch range from the origin:", e
+
+            # an origin which ignores the range is left to the background download
+            if self.origin_response is not None and self.origin_response.status != 206:
+                self.origin_response.close()
+                self.origin_response = None
+
+        self.keep_alive()
+
+        if self.range is not None:
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes %d-%d/%d" % (self.range[0], self.range[1], resource.length))
+            self.send_header("Content-Length", str(self.range[1] - self.range[0] + 1))
+        else:
+            self.send_response(200)
+            if resource.length is not None:
+                self.send_header("Content-Length", str(resource.length))
+            else:
+                self.send_header("Transfer-Encoding", "chunked")
+
+        self.send_header("Content-type", resource.content_type or self.content_type)
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Access-Control-Allow-Origin", "*")
+        self.end_headers()
+
+    def write_response(self, filepath):
+        if self.transcode:
+            stream2chromecast.TranscodingRequestHandler.write_response(self, filepath)
+            return
+
+        if self.failed:
+            return
+
+        resource = self.resource
+        chunked = self.range is None and resource.length is None
+
+        if self.range is not None:
+            offset, end = self.range[0], self.range[1] + 1
+        else:
+            offset, end = 0, None
+
+        with resource.cond:
+            resource.users += 1
+        try:
+            if self.origin_response is not None:
+                self.relay(self.origin_response, end - offset)
+                return
+
+            with open(resource.data_path, "rb") as f:
+                while end is None or offset < end:
+                    size = BLOCK_SIZE if end is None else min(BLOCK_SIZE, end - offset)
+                    try:
+                        data = resource.read(f, offset, size)
+                    except ProxyError as e:
+                        print e
+                        self.close_connection = 1
+                        return
+
+                    if len(data) == 0:
+                        break
+
+                    if chunked:
+                        self.write_chunk(data)
+                    else:
+                        self.write_data(data)
+                    offset += len(data)
+        finally:
+            with resource.cond:
+                resource.users -= 1
+
+        if chunked:
+            self.wfile.write("0")
+            self.wfile.write("\r\n\r\n")
+
+    def relay(self, response, length):
+        """ send a response from the origin on to the device """
+
+        try:
+            while length > 0:
+                data = response.read(min(BLOCK_SIZE, length))
+                if len(data) == 0:
+                    # the origin sent less than it promised, so the device's response can't be completed
+                    self.close_connection = 1
+                    break
+
+                self.write_data(data)
+                length -= len(data)
+        finally:
+            response.close()
+
+    def write_data(self, data):
+        start = time.time()
+        self.wfile.write(data)
+        self.stream.record_write(len(data), time.time() - start)
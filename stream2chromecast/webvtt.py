@@ -0,0 +1,294 @@
+"""
+Converts subtitles to WebVTT, the only subtitles format the Chromecast accepts.
+
+SRT and ASS/SSA files are converted in-process, WebVTT files are passed through with their line endings
+normalised, and subtitle tracks embedded in a media file are extracted with ffmpeg/avconv. Conversions are
+cached in memory and on disk, keyed by the source file's path, size and modification time, so replaying a file
+doesn't convert its subtitles (or run the transcoder to extract them) again.
+
+version 0.1
+
+"""
+
+
+# Copyright (C) 2014-2016 Pat Carter
+#
+# This file is part of Stream2chromecast.
+#
+# Stream2chromecast is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Stream2chromecast is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Stream2chromecast.  If not, see <http://www.gnu.org/licenses/>.
+
+
+
+import hashlib
+import os
+import re
+import subprocess
+import threading
+
+CONTENT_TYPE = "text/vtt;charset=utf-8"
+
+# directory holding the converted subtitles between runs
+CACHE_DIR = "~/.cc_subtitles_cache"
+
+# converted files kept in the cache directory - the least recently used are removed beyond this
+CACHE_MAX_FILES = 200
+
+EXTRACT_COMMAND = '%s -loglevel error -i "%s" -map 0:s:%d -f webvtt -'
+
+SRT_TIMING = re.compile(r"(\d+):(\d{1,2}):(\d{1,2})[,.](\d{1,3})\s*-->\s*(\d+):(\d{1,2}):(\d{1,2})[,.](\d{1,3})")
+ASS_TIME = re.compile(r"(\d+):(\d{1,2}):(\d{1,2})[.:](\d{1,2})")
+ASS_OVERRIDE = re.compile(r"\{[^}]*\}")
+SRT_FONT_TAG = re.compile(r"</?font[^>]*>", re.IGNORECASE)
+BARE_AMPERSAND = re.compile(r"&(?!#?\w+;)")
+
+_cache = {}  # cache key -> WebVTT document
+_cache_lock = threading.Lock()
+
+
+class SubtitlesError(Exception):
+    pass
+
+
+def decode_text(data):
+    """ subtitles files come in all sorts of encodings - decode as utf-8 if possible, otherwise cp1252 """
+
+    if data.startswith("\xef\xbb\xbf"):
+        data = data[3:]
+
+    try:
+        text = data.decode("utf-8")
+    except UnicodeDecodeError:
+        text = data.decode("cp1252", "replace")
+
+    return text.replace("\r\n", "\n").replace("\r", "\n")
+
+
+def format_time(milliseconds):
+    hours, milliseconds = divmod(milliseconds, 3600000)
+    minutes, milliseconds = divmod(milliseconds, 60000)
+    seconds, milliseconds = divmod(milliseconds, 1000)
+
+    return "%02d:%02d:%02d.%03d" % (hours, minutes, seconds, milliseconds)
+
+
+def to_milliseconds(hours, minutes, seconds, fraction):
+    """ convert the parts of a timestamp - the fraction is the digits after the decimal point """
+
+    return ((int(hours) * 60 + int(minutes)) * 60 + int(seconds)) * 1000 + int(fraction.ljust(3, "0")[:3])
+
+
+def format_cues(cues):
+    """ a WebVTT document from a list of (start ms, end ms, text) """
+
+    lines = [u"WEBVTT", u""]
+
+    for start, end, text in cues:
+        # a cue's text ends at the first blank line, and can't contain the timing arrow
+        text = u"\n".join(line for line in text.replace(u"-->", u"->").split(u"\n") if line.strip() != u"")
+        if text == u"":
+            continue
+
+        lines.append(u"%s --> %s" % (format_time(start), format_time(end)))
+        lines.append(text)
+        lines.append(u"")
+
+    return u"\n".join(lines).encode("utf-8")
+
+
+def srt_to_webvtt(text):
+    cues = []
+
+    for block in re.split(r"\n\s*\n", text):
+        lines = block.strip("\n").split("\n")
+
+        # the timing line is usually preceded by the cue number
+        for index, line in enumerate(lines):
+            match = SRT_TIMING.match(line.strip())
+            if match is not None:
+                parts = match.groups()
+                cue_text = SRT_FONT_TAG.sub(u"", u"\n".join(lines[index + 1:]))
+                cue_text = BARE_AMPERSAND.sub(u"&amp;", cue_text)
+                cues.append((to_milliseconds(*parts[:4]), to_milliseconds(*parts[4:]), cue_text))
+                break
+
+    return format_cues(cues)
+
+
+def ass_to_webvtt(text):
+    cues = []
+    fields = None
+    in_events = False
+
+    for line in text.split("\n"):
+        line = line.strip()
+
+        if line.startswith("["):
+            in_events = line.lower() == "[events]"
+            continue
+
+        if not in_events or ":" not in line:
+            continue
+
+        kind, value = line.split(":", 1)
+
+        if kind == "Format":
+            fields = [field.strip().lower() for field in value.split(",")]
+
+        elif kind == "Dialogue" and fields is not None:
+            # the text is the last field, and may contain commas
+            values = [item.strip() for item in value.split(",", len(fields) - 1)]
+            if len(values) != len(fields):
+                continue
+
+            event = dict(zip(fields, values))
+            start = ASS_TIME.match(event.get("start", ""))
+            end = ASS_TIME.match(event.get("end", ""))
+            if start is None or end is None:
+                continue
+
+            cue_text = ASS_OVERRIDE.sub(u"", event.get("text", u""))
+            cue_text = cue_text.replace(u"\\N", u"\n").replace(u"\\n", u"\n").replace(u"\\h", u" ")
+            cue_text = cue_text.replace(u"&", u"&amp;").replace(u"<", u"&lt;").replace(u">", u"&gt;")
+
+            cues.append((to_milliseconds(*start.groups()), to_milliseconds(*end.groups()), cue_text))
+
+    if fields is None:
+        raise SubtitlesError("no events found in the subtitles")
+
+    cues.sort(key=lambda cue: cue[0])
+
+    return format_cues(cues)
+
+
+def normalise_webvtt(text):
+    if not text.startswith(u"WEBVTT"):
+        raise SubtitlesError("not a WebVTT file")
+
+    return text.encode("utf-8")
+
+
+def convert_file(filepath):
+    """ convert a subtitles file to WebVTT, by its extension or failing that its content """
+
+    with open(filepath, "rb") as f:
+        text = decode_text(f.read())
+
+    extension = os.path.splitext(filepath)[1].lower()
+
+    if extension == ".vtt" or text.startswith(u"WEBVTT"):
+        return normalise_webvtt(text)
+
+    if extension in (".ass", ".ssa") or u"[Script Info]" in text[:1000]:
+        return ass_to_webvtt(text)
+
+    if extension == ".srt" or SRT_TIMING.search(text) is not None:
+        return srt_to_webvtt(text)
+
+    raise SubtitlesError("unrecognised subtitles format: %s" % filepath)
+
+
+def extract_track(filepath, track, transcoder_cmd):
+    """ extract a subtitle track embedded in a media file as WebVTT """
+
+    if transcoder_cmd is None:
+        raise SubtitlesError("extracting embedded subtitles needs ffmpeg or avconv")
+
+    process = subprocess.Popen(EXTRACT_COMMAND % (transcoder_cmd, filepath, track), shell=True,
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    output, errors = process.communicate()
+
+    if process.returncode != 0 or not output.startswith("WEBVTT"):
+        raise SubtitlesError("unable to extract subtitle track %d: %s" % (track, errors.strip()))
+
+    return output
+
+
+def cache_key(filepath, track):
+    stat = os.stat(filepath)
+
+    # paths forwarded to the daemon arrive as unicode
+    if isinstance(filepath, unicode):
+        filepath = filepath.encode("utf-8")
+
+    return "%s\0%d\0%d\0%s" % (os.path.abspath(filepath), stat.st_size, stat.st_mtime, track)
+
+
+def cache_path(key):
+    return os.path.join(os.path.expanduser(CACHE_DIR), hashlib.sha1(key).hexdigest() + ".vtt")
+
+
+def read_cache(key):
+    try:
+        with open(cache_path(key), "rb") as f:
+            data = f.read()
+    except IOError:
+        return None
+
+    # mark the file as recently used
+    os.utime(cache_path(key), None)
+
+    return data
+
+
+def write_cache(key, data):
+    """ store a conversion on disk - failing to do so only means it will be converted again """
+
+    import tempfile
+
+    path = cache_path(key)
+    directory = os.path.dirname(path)
+
+    try:
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        fd, temp_path = tempfile.mkstemp(prefix=".vtt", dir=directory)
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.rename(temp_path, path)
+
+        cached = [os.path.join(directory, name) for name in os.listdir(directory) if name.endswith(".vtt")]
+        if len(cached) > CACHE_MAX_FILES:
+            cached.sort(key=os.path.getmtime)
+            for old_path in cached[:len(cached) - CACHE_MAX_FILES]:
+                os.remove(old_path)
+    except (IOError, OSError):
+        pass
+
+
+def get_webvtt(filepath, track=None, transcoder_cmd=None):
+    """ the subtitles of a file as a WebVTT document - filepath is a subtitles file, or with track a media file
+        from which that subtitle track (counting from 0) is extracted. Raises SubtitlesError if they can't
+        be converted """
+
+    key = cache_key(filepath, track)
+
+    with _cache_lock:
+        if key in _cache:
+            return _cache[key]
+
+    data = read_cache(key)
+
+    if data is None:
+        if track is None:
+            data = convert_file(filepath)
+        else:
+            data = extract_track(filepath, track, transcoder_cmd)
+
+        write_cache(key, data)
+
+    with _cache_lock:
+        _cache[key] = data
+
+    return data